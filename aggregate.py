@@ -0,0 +1,209 @@
+#!/usr/local/miniconda/bin/python
+"""Collect the per-session CSV and regional statistics tables into a Parquet dataset.
+
+The sources are a batch run directory (the output folders of its completed
+sessions) or any local mirror of gear outputs. Each table kind (brainvols,
+regionstats, ...) becomes a dataset partitioned by subject and session:
+
+    <dataset>/<table>/subject=<label>/session=<label>/part-0.parquet
+
+The size and modification time of every source file are kept in a state
+file, so a later aggregation only reads and rewrites the sessions whose
+files changed.
+
+    aggregate.py <batch output dir or mirror> <dataset dir> [--workers N]
+
+Needs pyarrow, which is not installed in the gear image.
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import logging
+import argparse
+from pathlib import PosixPath
+from concurrent.futures import ThreadPoolExecutor
+from antsct_utils import cpu_budget
+from batch_run import BatchState, COMPLETE
+from regional_stats import STATS_SUFFIX
+
+logger = logging.getLogger('antsct-gear')
+
+STATE_FILE = '_aggregate_state.json'
+BATCH_STATE = 'batch_state.json'
+TABLE_PATTERNS = ['*.csv', '*' + STATS_SUFFIX]
+# the leading BIDS entities of an output file name, e.g. sub-01_ses-02_run-1_
+ENTITIES_RE = re.compile(r'^((?:[a-zA-Z]+-[a-zA-Z0-9]+_)+)')
+NULL_VALUES = ['', 'n/a', 'NA', 'NaN', 'nan']
+# columns of the regional statistics written by regional_stats.py; names are strings even for
+# label sets without a dseg table, where they are the label numbers
+STATS_COLUMNS = [('label_set', 'string'), ('index', 'int64'), ('name', 'string'), ('voxels', 'int64'),
+                 ('volume_mm3', 'float64'), ('thickness_voxels', 'int64'), ('thickness_mean', 'float64'),
+                 ('thickness_median', 'float64'), ('thickness_std', 'float64')]
+
+
+def table_name(path):
+    """Name of the table a file belongs to: its name without the session entities and extension."""
+    name = PosixPath(path).name
+    if name.endswith(STATS_SUFFIX):
+        return STATS_SUFFIX[1:].split('.')[0]
+    match = ENTITIES_RE.match(name)
+    stem = name[match.end():] if match else name
+    return stem.split('.')[0]
+
+
+def file_session(path, default=(None, None)):
+    """Return the (subject, session) labels from a file name, falling back to default."""
+    match = ENTITIES_RE.match(path.name)
+    entities = dict(re.findall(r'(sub|ses)-([a-zA-Z0-9]+)', match.group(1))) if match else {}
+    return entities.get('sub', default[0]), entities.get('ses', default[1])
+
+
+def find_sessions(source):
+    """Return {(subject, session): [table files]} for a batch run directory or an output mirror."""
+    source = PosixPath(source)
+    folders = []
+    if (source / BATCH_STATE).exists():
+        for entry in BatchState(source / BATCH_STATE).sessions.values():
+            if entry.get('status') == COMPLETE and entry.get('output_dir'):
+                folders.append((PosixPath(entry['output_dir']), (entry.get('subject'), entry.get('session'))))
+    else:
+        folders.append((source, (None, None)))
+
+    sessions = {}
+    seen = set()
+    for folder, default in folders:
+        pattern_files = (p for pattern in TABLE_PATTERNS for p in folder.rglob(pattern))
+        for path in sorted(pattern_files):
+            if path.name.startswith('.') or not path.is_file():
+                continue
+            key = file_session(path, default)
+            if None in key:
+                logger.warning("Skipping %s: no subject/session in its name", path)
+                continue
+            # loose copies and the derivatives tree hold the same file
+            if (key, path.name) in seen:
+                continue
+            seen.add((key, path.name))
+            sessions.setdefault(key, []).append(path)
+    return sessions
+
+
+def signature(files):
+    """{file name: [size, mtime]} of the files of a session."""
+    result = {}
+    for path in files:
+        stat = path.stat()
+        result[path.name] = [stat.st_size, stat.st_mtime_ns]
+    return result
+
+
+def column_types(path):
+    """Arrow types of the regional statistics columns, shared by all label sets and sessions."""
+    import pyarrow as pa
+    if not path.name.endswith(STATS_SUFFIX):
+        return {}
+    with path.open() as f:
+        header = f.readline().rstrip('\n').split('\t')
+    types = dict((column, pa.float64()) for column in header if column.startswith('fraction_'))
+    types.update((column, getattr(pa, kind)()) for column, kind in STATS_COLUMNS)
+    return types
+
+
+def read_table(path):
+    """Read a CSV or TSV into an Arrow table with a source_file column."""
+    import pyarrow as pa
+    from pyarrow import csv
+    delimiter = '\t' if path.name.endswith('.tsv') else ','
+    table = csv.read_csv(str(path), parse_options=csv.ParseOptions(delimiter=delimiter),
+                         convert_options=csv.ConvertOptions(null_values=NULL_VALUES, strings_can_be_null=True,
+                                                            column_types=column_types(path)))
+    return table.append_column('source_file', pa.array([path.name] * table.num_rows, pa.string()))
+
+
+def _concat(tables):
+    import pyarrow as pa
+    if len(tables) == 1:
+        return tables[0]
+    if int(pa.__version__.split('.')[0]) < 14:
+        return pa.concat_tables(tables, promote=True)
+    return pa.concat_tables(tables, promote_options='default')
+
+
+def partition_dir(dataset, table, subject, session):
+    return PosixPath(dataset) / table / 'subject={}'.format(subject) / 'session={}'.format(session)
+
+
+def write_session(dataset, subject, session, files, previous_tables=()):
+    """Write the tables of one session into their partitions; return the table names written."""
+    import pyarrow.parquet as pq
+    grouped = {}
+    for path in files:
+        grouped.setdefault(table_name(path), []).append(path)
+    for table, paths in grouped.items():
+        folder = partition_dir(dataset, table, subject, session)
+        folder.mkdir(parents=True, exist_ok=True)
+        tmp = folder / '.part-0.parquet.tmp'
+        pq.write_table(_concat([read_table(p) for p in paths]), str(tmp))
+        os.replace(str(tmp), str(folder / 'part-0.parquet'))
+    # tables the session no longer has
+    for table in set(previous_tables) - set(grouped):
+        shutil.rmtree(str(partition_dir(dataset, table, subject, session)), ignore_errors=True)
+    return sorted(grouped)
+
+
+def aggregate(source, dataset, workers=None):
+    """Bring the dataset up to date with the sources; return the number of sessions rewritten."""
+    dataset = PosixPath(dataset)
+    dataset.mkdir(parents=True, exist_ok=True)
+    state_path = dataset / STATE_FILE
+    state = {}
+    if state_path.exists():
+        with state_path.open() as f:
+            state = json.load(f)
+
+    changed = []
+    sessions = find_sessions(source)
+    for (subject, session), files in sorted(sessions.items()):
+        key = '{}/{}'.format(subject, session)
+        files_now = signature(files)
+        if state.get(key, {}).get('files') != files_now:
+            changed.append((key, subject, session, files, files_now))
+    logger.info("%d sessions found, %d changed since the last aggregation", len(sessions), len(changed))
+
+    with ThreadPoolExecutor(max_workers=workers or cpu_budget()) as pool:
+        futures = [(key, files_now, pool.submit(write_session, dataset, subject, session, files,
+                                                state.get(key, {}).get('tables', [])))
+                   for key, subject, session, files, files_now in changed]
+        for key, files_now, future in futures:
+            try:
+                state[key] = {'files': files_now, 'tables': future.result()}
+            except Exception as e:
+                # left out of the state, so the session is tried again next time
+                logger.warning("Skipping session %s: %s", key, e)
+
+    tmp = state_path.with_name(state_path.name + '.tmp')
+    with tmp.open('w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(str(tmp), str(state_path))
+    return len(changed)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Aggregate per-session CSV outputs into a Parquet dataset.')
+    parser.add_argument('source', help='Batch run output directory, or a local mirror of gear outputs.')
+    parser.add_argument('dataset', help='Parquet dataset directory, updated in place.')
+    parser.add_argument('--workers', type=int, help='Sessions written in parallel (default: the CPU quota).')
+    args = parser.parse_args(argv)
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        parser.error('pyarrow is required: pip install pyarrow')
+    aggregate(args.source, args.dataset, args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""Helpers shared by the single-session gear and the batch driver."""
+import os
+import time
+import resource
+from contextlib import contextmanager
+from shutil import copy2
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+# Rough peak memory of one antsCorticalThickness.sh job
+MEMORY_PER_JOB = 4 * 1024 ** 3
+THREAD_VARIABLES = ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'ITK_DEFAULT_GLOBAL_NUMBER_OF_THREADS',
+                    'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+
+def bids_filters(subjects, sessions, bids_sub=None, bids_ses=None, bids_acq=None, bids_run=None):
+    """Build the layout.get() filters used to find the input T1w image."""
+    filters = {}
+    if bids_sub:
+        filters["subject"] = [bids_sub]
+    else:
+        filters["subject"] = subjects
+    if bids_ses:
+        filters["session"] = [bids_ses]
+    else:
+        filters["session"] = sessions
+
+    if bids_acq:
+        filters["acquisition"] = bids_acq
+
+    if bids_run:
+        filters["run"] = bids_run
+
+    return filters
+
+
+def find_anat(layout, filters):
+    """Return all anatomical NIfTI files in the layout matching the filters."""
+    return layout.get(return_type='file', extension=['.nii', '.nii.gz'], **filters)
+
+
+def bids_prefix(anat_input):
+    """Generate the output file root from a BIDS anatomical file name."""
+    basename = os.path.basename(str(anat_input)).split('.')[0]
+    return basename.replace('_T1w', '') + '_'
+
+
+def manual_prefix(subject_label, session_label):
+    """Generate the output file root from Flywheel subject and session labels."""
+    subject_label = subject_label.replace('_', 'x')
+    session_label = session_label.replace('_', 'x')
+    return 'sub-{}_ses-{}_'.format(subject_label, session_label)
+
+
+def build_command(anat_input, output_dir, prefix, denoise, num_threads, run_quick, trim_neck,
+                  mni_cort_labels=None, mni_labels=None):
+    """Return the runAntsCT_nonBIDS.pl command line as a list of arguments."""
+    cmd = ['/opt/scripts/runAntsCT_nonBIDS.pl',
+           '--anatomical-image {}'.format(anat_input),
+           '--output-dir {}'.format(output_dir),
+           '--output-file-root {}'.format(prefix),
+           '--denoise {}'.format(denoise),
+           '--num-threads {}'.format(num_threads),
+           '--run-quick {}'.format(run_quick),
+           '--trim-neck {}'.format(trim_neck)
+           ]
+    if mni_cort_labels:
+        cmd.append('--mni-cortical-labels {}'.format(" ".join(str(i) for i in mni_cort_labels)))
+
+    if mni_labels:
+        cmd.append('--mni-labels {}'.format(" ".join(str(i) for i in mni_labels)))
+
+    return cmd
+
+
+def link_or_copy(src, dest):
+    """Hard-link src to dest, falling back to a copy across file systems."""
+    try:
+        os.link(str(src), str(dest))
+    except OSError:
+        copy2(str(src), str(dest))
+
+
+def available_cores():
+    """Return the number of cores this process is allowed to run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _read_first(*paths):
+    for path in paths:
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            continue
+    return None
+
+
+def cgroup_cpu_limit(root=CGROUP_ROOT):
+    """Return the CPU quota of the container in cores, or None if there is none."""
+    quota = _read_first(os.path.join(root, 'cpu.max'))
+    if quota is not None:
+        # cgroup v2: "<quota> <period>" or "max <period>"
+        quota, period = (quota.split() + ['100000'])[:2]
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    quota = _read_first(os.path.join(root, 'cpu', 'cpu.cfs_quota_us'),
+                        os.path.join(root, 'cpu,cpuacct', 'cpu.cfs_quota_us'))
+    period = _read_first(os.path.join(root, 'cpu', 'cpu.cfs_period_us'),
+                         os.path.join(root, 'cpu,cpuacct', 'cpu.cfs_period_us'))
+    if quota is None or period is None or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def cgroup_memory_limit(root=CGROUP_ROOT):
+    """Return the memory limit in bytes of the container or the host, or None if unknown."""
+    limit = _read_first(os.path.join(root, 'memory.max'), os.path.join(root, 'memory', 'memory.limit_in_bytes'))
+    # cgroup v1 reports "no limit" as a number close to 2**63
+    if limit is not None and limit != 'max' and int(limit) < 2 ** 60:
+        return int(limit)
+    meminfo = _read_first('/proc/meminfo')
+    for line in (meminfo or '').splitlines():
+        if line.startswith('MemTotal:'):
+            return int(line.split()[1]) * 1024
+    return None
+
+
+def cpu_budget(root=CGROUP_ROOT):
+    """Number of cores the container may keep busy without being throttled."""
+    cores = available_cores()
+    quota = cgroup_cpu_limit(root)
+    if quota is not None:
+        cores = min(cores, int(quota))
+    return max(1, cores)
+
+
+def thread_count(requested):
+    """Threads for one ANTs-CT job; 0 or less sizes them from the container's CPU quota."""
+    requested = int(requested or 0)
+    if requested > 0:
+        return requested
+    return cpu_budget()
+
+
+def plan_resources(threads=0, jobs=None, memory_per_job=MEMORY_PER_JOB):
+    """Return (threads per job, concurrent jobs) that fit the container's CPU quota and memory.
+
+    When threads is 0 the jobs are sized first, then the cores are shared
+    between them.
+    """
+    cores = cpu_budget()
+    memory = cgroup_memory_limit()
+    memory_jobs = max(1, memory // memory_per_job) if memory else cores
+    threads = int(threads or 0)
+    if threads > 0:
+        jobs = jobs or max(1, min(cores // threads, memory_jobs))
+    else:
+        jobs = jobs or max(1, min(cores, memory_jobs))
+        threads = max(1, cores // jobs)
+    return threads, jobs
+
+
+def thread_environment(threads):
+    """Environment variables that limit ITK, ANTs and OpenMP to the given number of threads."""
+    return dict((name, str(threads)) for name in THREAD_VARIABLES)
+
+
+class cached_property(object):
+    """Compute an attribute on first access and store it on the instance."""
+
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.func.__name__] = self.func(obj)
+        return value
+
+
+def peak_rss():
+    """Peak resident memory of this process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PhaseTimer(object):
+    """Record the wall-clock time, CPU time and peak memory of named phases of a run."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.cpu_start = time.process_time()
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - start, time.process_time() - cpu_start, peak_rss()))
+
+    def report(self, logger):
+        """Log the phase timings and return them as a dict."""
+        total = time.time() - self.start
+        for name, seconds, cpu_seconds, _ in self.phases:
+            logger.info("Timing: %-24s %8.3f s (cpu %.3f s)", name, seconds, cpu_seconds)
+        logger.info("Timing: %-24s %8.3f s", 'total', total)
+        return {'phases': [{'name': name, 'seconds': seconds, 'cpu_seconds': cpu_seconds, 'peak_rss_bytes': rss}
+                           for name, seconds, cpu_seconds, rss in self.phases],
+                'total_seconds': total,
+                'cpu_seconds': time.process_time() - self.cpu_start,
+                'peak_rss_bytes': peak_rss()}
@@ -0,0 +1,248 @@
+#!/usr/local/miniconda/bin/python
+"""Write the gear's output zip directly from the produced files.
+
+Members are streamed into the archive from where the pipeline wrote them, so
+no staging copy of the output tree is needed. Files that are already
+compressed (.nii.gz, .png, ...) are stored as-is, and small text members
+(CSV, TSV, JSON, logs) are deflated in parallel worker threads.
+
+zipfile has no public API for adding already deflated data, so the archive
+is written by ZipWriter, a small writer of the zip format (with zip64 for
+large members and archives) that takes members stored, deflated while
+streamed, or deflated in advance.
+
+    archive_outputs.py bids <gear output dir> <zip> <source entities> [--loose-dir DIR]
+    archive_outputs.py dir <directory> <zip> [--exclude antsct] [--loose-dir DIR]
+"""
+import os
+import sys
+import time
+import zlib
+import struct
+import logging
+import argparse
+from pathlib import PosixPath
+from concurrent.futures import ThreadPoolExecutor
+from antsct_utils import link_or_copy, cpu_budget
+from bids_derivative import organize
+
+logger = logging.getLogger('antsct-gear')
+
+# Members with these extensions are stored without recompression
+STORED_EXTENSIONS = ('.gz', '.zip', '.png', '.jpg', '.jpeg', '.h5')
+# Text members up to this size are compressed in memory by the worker pool
+PARALLEL_LIMIT = 64 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+STORED = 0
+DEFLATED = 8
+# members and offsets from this size on get zip64 records, as in zipfile
+ZIP64_LIMIT = (1 << 31) - 1
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+END_RECORD = struct.Struct('<4s4H2LH')
+ZIP64_END_RECORD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+
+
+def _deflate(data):
+    """Raw deflate data (no zlib header) as zip members hold it; returns (compressed, crc)."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush(), zlib.crc32(data) & 0xffffffff
+
+
+def _dos_time(mtime=None):
+    t = time.localtime(mtime or time.time())
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+        (max(t.tm_year, 1980) - 1980 << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class ZipWriter(object):
+    """Appends members to a new zip file and writes the central directory on close."""
+
+    def __init__(self, path):
+        self.fp = open(str(path), 'wb')
+        self.entries = []
+        self.names = set()
+
+    def _local_header(self, name, method, dos_time, crc, compressed, size, zip64):
+        extra = struct.pack('<2H2Q', 1, 16, size, compressed) if zip64 else b''
+        return LOCAL_HEADER.pack(b'PK\x03\x04', 45 if zip64 else 20, 0x800, method, dos_time[0], dos_time[1], crc,
+                                 0xffffffff if zip64 else compressed, 0xffffffff if zip64 else size,
+                                 len(name), len(extra)) + name + extra
+
+    def _begin(self, arcname, method, mtime, size):
+        name = str(arcname).encode('utf-8')
+        if name in self.names:
+            raise ValueError('Duplicate zip member {}'.format(arcname))
+        self.names.add(name)
+        # with room for deflate growing incompressible data a little
+        return {'name': name, 'method': method, 'dos_time': _dos_time(mtime), 'offset': self.fp.tell(),
+                'zip64': size + size // 1000 + 1024 > ZIP64_LIMIT}
+
+    def _finish(self, entry, crc, compressed, size):
+        entry.update(crc=crc, compressed=compressed, size=size)
+        self.entries.append(entry)
+
+    def write_compressed(self, arcname, mtime, compressed, crc, size):
+        """Add a member deflated in advance."""
+        entry = self._begin(arcname, DEFLATED, mtime, size)
+        self.fp.write(self._local_header(entry['name'], DEFLATED, entry['dos_time'], crc, len(compressed), size,
+                                         entry['zip64']))
+        self.fp.write(compressed)
+        self._finish(entry, crc, len(compressed), size)
+
+    def write_file(self, source, arcname, method=STORED):
+        """Stream a file into a member, deflating it on the way with method=DEFLATED."""
+        stat = os.stat(str(source))
+        entry = self._begin(arcname, method, stat.st_mtime, stat.st_size)
+        header = self._local_header(entry['name'], method, entry['dos_time'], 0, 0, 0, entry['zip64'])
+        self.fp.write(header)
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if method == DEFLATED else None
+        crc, size, compressed = 0, 0, 0
+        with open(str(source), 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                if compressor is not None:
+                    block = compressor.compress(block)
+                compressed += len(block)
+                self.fp.write(block)
+        if compressor is not None:
+            block = compressor.flush()
+            compressed += len(block)
+            self.fp.write(block)
+        if not entry['zip64'] and max(size, compressed) > ZIP64_LIMIT:
+            raise ValueError('{} grew past the zip64 limit while it was written'.format(source))
+        # the header was written before the checksum and sizes were known
+        end = self.fp.tell()
+        self.fp.seek(entry['offset'])
+        self.fp.write(self._local_header(entry['name'], method, entry['dos_time'], crc & 0xffffffff, compressed,
+                                         size, entry['zip64']))
+        self.fp.seek(end)
+        self._finish(entry, crc & 0xffffffff, compressed, size)
+
+    def close(self):
+        start = self.fp.tell()
+        for entry in self.entries:
+            # values that don't fit in 32 bits move to the zip64 extra field, in this order
+            values = [entry['size'], entry['compressed'], entry['offset']]
+            wide = [entry['zip64'], entry['zip64'], entry['offset'] > ZIP64_LIMIT]
+            moved = [value for value, w in zip(values, wide) if w]
+            extra = struct.pack('<2H{}Q'.format(len(moved)), 1, 8 * len(moved), *moved) if moved else b''
+            size, compressed, offset = [0xffffffff if w else value for value, w in zip(values, wide)]
+            version = 45 if moved else 20
+            self.fp.write(CENTRAL_HEADER.pack(
+                b'PK\x01\x02', (3 << 8) | version, version, 0x800, entry['method'], entry['dos_time'][0],
+                entry['dos_time'][1], entry['crc'], compressed, size, len(entry['name']), len(extra), 0, 0, 0,
+                0o644 << 16, offset))
+            self.fp.write(entry['name'] + extra)
+        end = self.fp.tell()
+        count, size = len(self.entries), end - start
+        if count >= 0xffff or start > ZIP64_LIMIT or size > ZIP64_LIMIT:
+            self.fp.write(ZIP64_END_RECORD.pack(b'PK\x06\x06', 44, (3 << 8) | 45, 45, 0, 0, count, count, size, start))
+            self.fp.write(ZIP64_LOCATOR.pack(b'PK\x06\x07', 0, end, 1))
+            count, size, start = min(count, 0xffff), min(size, 0xffffffff), min(start, 0xffffffff)
+        self.fp.write(END_RECORD.pack(b'PK\x05\x06', 0, 0, count, count, size, start, 0))
+        self.fp.close()
+
+
+class ZipSink(object):
+    """Streams derivatives into a zip archive; same interface as bids_derivative.DirectorySink."""
+
+    def __init__(self, zip_path, prefix='', workers=None, loose_dir=None, loose_patterns=()):
+        self.zip = ZipWriter(zip_path)
+        self.prefix = PosixPath(prefix)
+        self.pool = ThreadPoolExecutor(max_workers=workers or cpu_budget())
+        self.pending = []
+        self.loose_dir = PosixPath(loose_dir) if loose_dir else None
+        self.loose_patterns = loose_patterns
+
+    def _arcname(self, relpath):
+        return str(self.prefix / relpath)
+
+    def _keep_loose(self, source, relpath):
+        """Hard-link members matching the loose patterns next to the archive."""
+        if self.loose_dir is not None and any(p in str(relpath) for p in self.loose_patterns):
+            self.loose_dir.mkdir(parents=True, exist_ok=True)
+            link_or_copy(source, self.loose_dir / PosixPath(relpath).name)
+
+    def add_file(self, source, relpath):
+        self._keep_loose(source, relpath)
+        arcname = self._arcname(relpath)
+        if str(source).endswith(STORED_EXTENSIONS):
+            self.zip.write_file(source, arcname, STORED)
+        elif os.path.getsize(str(source)) > PARALLEL_LIMIT:
+            self.zip.write_file(source, arcname, DEFLATED)
+        else:
+            mtime = os.path.getmtime(str(source))
+            self.pending.append((arcname, mtime, self.pool.submit(self._read_and_deflate, source)))
+
+    def add_text(self, text, relpath):
+        self.pending.append((self._arcname(relpath), None, self.pool.submit(self._deflate_bytes, text.encode())))
+
+    @staticmethod
+    def _deflate_bytes(data):
+        compressed, crc = _deflate(data)
+        return compressed, crc, len(data)
+
+    @staticmethod
+    def _read_and_deflate(source):
+        with open(str(source), 'rb') as f:
+            data = f.read()
+        return ZipSink._deflate_bytes(data)
+
+    def flush(self):
+        """Write the members compressed so far, in the order they were added."""
+        for arcname, mtime, future in self.pending:
+            compressed, crc, size = future.result()
+            self.zip.write_compressed(arcname, mtime, compressed, crc, size)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
+        self.zip.close()
+
+
+def archive_directory(directory, sink, exclude=()):
+    """Add the top-level files of directory to sink under their own names."""
+    count = 0
+    for entry in sorted(os.scandir(str(directory)), key=lambda e: e.name):
+        if entry.is_file() and not any(x in entry.name for x in exclude):
+            sink.add_file(entry.path, entry.name)
+            count += 1
+    return count
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Stream gear outputs into a zip archive.')
+    parser.add_argument('mode', choices=['bids', 'dir'])
+    parser.add_argument('input_dir')
+    parser.add_argument('zip_path')
+    parser.add_argument('source_entities', nargs='?', help='Output file root (bids mode).')
+    parser.add_argument('--prefix', default='', help='Folder name of the members inside the zip.')
+    parser.add_argument('--exclude', nargs='*', default=[], help='Skip files whose names contain these (dir mode).')
+    parser.add_argument('--loose-dir', help='Also hard-link matching members into this directory.')
+    parser.add_argument('--loose-pattern', nargs='*', default=[], help='Substrings selecting loose members.')
+    parser.add_argument('--workers', type=int, help='Compression threads (default: the CPU quota).')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    sink = ZipSink(args.zip_path, args.prefix, args.workers, args.loose_dir, args.loose_pattern)
+    try:
+        if args.mode == 'bids':
+            if not args.source_entities:
+                parser.error('bids mode needs the source entities')
+            organize(args.input_dir, sink, args.source_entities)
+        else:
+            archive_directory(args.input_dir, sink, args.exclude)
+    finally:
+        sink.close()
+    logger.info("Wrote %s (%d bytes) in %.1f s", args.zip_path, os.path.getsize(args.zip_path), time.time() - start)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
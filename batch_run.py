@@ -0,0 +1,280 @@
+#!/usr/local/miniconda/bin/python
+"""Run ANTs-CT on many Flywheel sessions from a single process.
+
+All sessions are resolved and their anatomical data downloaded with one SDK
+client, then runAntsCT_nonBIDS.pl jobs are scheduled across a local pool of
+worker processes. Per-session status is kept in a JSON state file so an
+interrupted batch can be resumed by running the same command again.
+
+Sessions with several T1w images are screened and ranked like in the gear
+(preflight.py): only the best image is processed, or with --multiple-t1w all
+each image is a job of its own, keyed <session id>/<file root> in the state
+file and written to <output dir>/<session id>/<file root>.
+"""
+import sys
+import re
+import json
+import time
+import logging
+import argparse
+import subprocess
+import threading
+from pathlib import PosixPath
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+from antsct_utils import bids_filters, find_anat, bids_prefix, build_command, plan_resources, thread_environment
+from bids_cache import DownloadCache, download_anat
+from bids_index import load_anat_index
+from checkpoint import stage_keys, resume, record, watch
+from preflight import choose_anat
+from regional_stats import regional_stats
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger('antsct-gear')
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMPLETE = 'complete'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class BatchState(object):
+    """Per-session status persisted to a JSON file after every change."""
+
+    def __init__(self, path):
+        self.path = PosixPath(path)
+        self.lock = threading.Lock()
+        self.sessions = {}
+        if self.path.exists():
+            with self.path.open() as f:
+                self.sessions = json.load(f)
+
+    def get(self, session_id):
+        return self.sessions.get(session_id, {})
+
+    def jobs(self, session_id):
+        """Entries of the jobs planned for a session: its own, or one per image processed."""
+        return [entry for key, entry in self.sessions.items()
+                if key == session_id or entry.get('session_id') == session_id]
+
+    def complete(self, session_id):
+        jobs = self.jobs(session_id)
+        return bool(jobs) and all(entry.get('status') == COMPLETE for entry in jobs)
+
+    def update(self, key, **fields):
+        with self.lock:
+            self.sessions.setdefault(key, {}).update(fields)
+            self._save()
+
+    def remove(self, key):
+        with self.lock:
+            if self.sessions.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w') as f:
+            json.dump(self.sessions, f, indent=2, sort_keys=True)
+        os.replace(str(tmp), str(self.path))
+
+    def summary(self):
+        counts = {}
+        for entry in self.sessions.values():
+            counts[entry.get('status')] = counts.get(entry.get('status'), 0) + 1
+        return counts
+
+
+def resolve_sessions(fw, project_label=None, session_ids=None, subject_filter=None, session_filter=None):
+    """Return (project_label, subject_label, session) tuples for every session to process."""
+    if session_ids:
+        sessions = [fw.get(session_id) for session_id in session_ids]
+    else:
+        project = fw.projects.find_first('label={}'.format(project_label))
+        if project is None:
+            raise ValueError("Project {} not found.".format(project_label))
+        sessions = fw.get_project_sessions(project.id)
+
+    resolved = []
+    project_labels = {}
+    for session in sessions:
+        subject_label = session.subject.label
+        if subject_filter and not re.search(subject_filter, subject_label):
+            continue
+        if session_filter and not re.search(session_filter, session.label):
+            continue
+        project_id = session.parents['project']
+        if project_id not in project_labels:
+            project_labels[project_id] = fw.get(project_id).label
+        resolved.append((project_labels[project_id], subject_label, session))
+
+    return resolved
+
+
+def download_inputs(fw, resolved, bids_dir, cache=None, workers=None):
+    """Download the anatomical BIDS data for all sessions, once per project."""
+    from fw_heudiconv.cli import export
+
+    by_project = {}
+    for project_label, subject_label, session in resolved:
+        subjects, sessions, session_ids = by_project.setdefault(project_label, (set(), set(), set()))
+        subjects.add(subject_label)
+        sessions.add(session.label)
+        session_ids.add(session.id)
+
+    bids_dir.mkdir(parents=True, exist_ok=True)
+    for project_label, (subjects, sessions, session_ids) in by_project.items():
+        logger.info("Downloading %d sessions from project %s", len(sessions), project_label)
+        downloads = export.gather_bids(fw, project_label, sorted(subjects), sorted(sessions))
+        download_anat(fw, downloads, bids_dir.resolve(), cache, workers=workers, session_ids=sorted(session_ids))
+
+    return bids_dir / 'bids_dataset'
+
+
+def plan_jobs(resolved, bids_root, state, args):
+    """Match each session to its anatomical images and record the jobs in the state file."""
+    layout = load_anat_index(bids_root)
+    jobs = []
+    for project_label, subject_label, session in resolved:
+        if state.complete(session.id):
+            logger.info("Session %s already complete, skipping.", session.id)
+            continue
+
+        filters = bids_filters([subject_label], [session.label], args.bids_subject, args.bids_session,
+                               args.bids_acq, args.bids_run)
+        anat_list = find_anat(layout, filters)
+        selected = choose_anat(anat_list, args.multiple_t1w, args.preflight) if anat_list else []
+        if not selected:
+            reason = "{} anatomical files found".format(len(anat_list)) if not anat_list else \
+                "no anatomical image passed the preflight checks"
+            logger.warning("Skipping session %s: %s", session.id, reason)
+            state.update(session.id, status=SKIPPED, reason=reason, subject=subject_label, session=session.label)
+            continue
+
+        settings = {'denoise': args.denoise, 'run_quick': args.run_quick, 'trim_neck': args.trim_neck}
+        if len(selected) > 1:
+            # the session's own entry gives way to one entry per image
+            state.remove(session.id)
+        for anat_input in selected:
+            prefix = bids_prefix(anat_input)
+            job_id, output_dir = session.id, PosixPath(args.output_dir) / session.id
+            if len(selected) > 1:
+                job_id = '{}/{}'.format(session.id, prefix.rstrip('_'))
+                output_dir = output_dir / prefix.rstrip('_')
+            if state.get(job_id).get('status') == COMPLETE:
+                continue
+            cmd = build_command(anat_input, output_dir, prefix, args.denoise, args.num_threads,
+                                args.run_quick, args.trim_neck)
+            state.update(job_id, status=PENDING, subject=subject_label, session=session.label, session_id=session.id,
+                         project=project_label, anat=str(anat_input), output_dir=str(output_dir),
+                         command=' '.join(cmd), prefix=prefix, settings=settings, num_threads=args.num_threads)
+            jobs.append(job_id)
+
+    return jobs
+
+
+def run_job(session_id, state):
+    """Run runAntsCT_nonBIDS.pl for one job (a session, or one image of it) and record the outcome."""
+    entry = state.get(session_id)
+    output_dir = PosixPath(entry['output_dir'])
+    output_dir.mkdir(parents=True, exist_ok=True)
+    state.update(session_id, status=RUNNING, started=time.time())
+    logger.info("Starting session %s", session_id)
+    # a failed or interrupted earlier attempt leaves its completed stages behind
+    resume(output_dir, entry['prefix'], stage_keys(entry['anat'], entry['settings']), entry['settings'])
+    stop = threading.Event()
+    watcher = threading.Thread(target=watch, args=(output_dir, 60, stop), daemon=True)
+    watcher.start()
+    with (output_dir / 'antsct_run.log').open('w') as log:
+        env = dict(os.environ, **thread_environment(entry['num_threads']))
+        returncode = subprocess.call(entry['command'], shell=True, stdout=log, stderr=subprocess.STDOUT, env=env)
+    stop.set()
+    watcher.join()
+    record(output_dir)
+    if returncode == 0:
+        try:
+            regional_stats(output_dir, entry['prefix'])
+        except Exception as e:
+            logger.warning("Regional statistics failed for session %s: %s", session_id, e)
+    status = COMPLETE if returncode == 0 else FAILED
+    state.update(session_id, status=status, returncode=returncode, finished=time.time())
+    logger.info("Session %s %s (exit %d)", session_id, status, returncode)
+    return returncode
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Run ANTs cortical thickness on many Flywheel sessions.')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--project', help='Label of the project to process.')
+    target.add_argument('--sessions-file', help='File listing one session id per line.')
+    parser.add_argument('--subject-filter', help='Regular expression matched against subject labels.')
+    parser.add_argument('--session-filter', help='Regular expression matched against session labels.')
+    parser.add_argument('--api-key', default=os.environ.get('FW_API_KEY'), help='Flywheel API key.')
+    parser.add_argument('--output-dir', required=True, help='Directory for downloads, outputs and state.')
+    parser.add_argument('--state-file', help='Batch state file (default: <output-dir>/batch_state.json).')
+    parser.add_argument('--cache-dir', help='Persistent download cache shared between batches.')
+    parser.add_argument('--cache-size-gb', type=float, default=50, help='Download cache size limit.')
+    parser.add_argument('--download-workers', type=int, default=8, help='Concurrent file downloads.')
+    parser.add_argument('--num-threads', type=int, default=1,
+                        help='Threads per ANTs-CT job; 0 shares the CPU quota between the jobs.')
+    parser.add_argument('--jobs', type=int, help='Concurrent jobs (default: as many as the CPU quota and memory '
+                                                 'limit of the container allow).')
+    parser.add_argument('--denoise', type=int, default=1)
+    parser.add_argument('--run-quick', type=int, default=0)
+    parser.add_argument('--trim-neck', type=int, default=1)
+    parser.add_argument('--bids-subject')
+    parser.add_argument('--bids-session')
+    parser.add_argument('--bids-acq')
+    parser.add_argument('--bids-run')
+    parser.add_argument('--preflight', type=int, default=1,
+                        help='Screen the T1w images before running; broken or unsuitable ones are skipped.')
+    parser.add_argument('--multiple-t1w', choices=['best', 'all'], default='best',
+                        help='With several T1w images in a session, process the best by SNR estimate or all.')
+    parser.add_argument('--dry-run', action='store_true', help='Resolve and download inputs without running.')
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    import flywheel
+    args.num_threads, workers = plan_resources(args.num_threads, args.jobs)
+
+    output_dir = PosixPath(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    state = BatchState(args.state_file or output_dir / 'batch_state.json')
+
+    fw = flywheel.Client(args.api_key)
+    session_ids = None
+    if args.sessions_file:
+        with open(args.sessions_file) as f:
+            session_ids = [line.strip() for line in f if line.strip()]
+    resolved = resolve_sessions(fw, args.project, session_ids, args.subject_filter, args.session_filter)
+    pending = set(s.id for _, _, s in resolved if not state.complete(s.id))
+    logger.info("Resolved %d sessions, %d left to process.", len(resolved), len(pending))
+    if not pending:
+        return 0
+
+    cache = None
+    if args.cache_dir:
+        cache = DownloadCache(args.cache_dir, int(args.cache_size_gb * 1024 ** 3))
+    bids_root = download_inputs(fw, [r for r in resolved if r[2].id in pending], output_dir / 'inputs', cache,
+                                args.download_workers)
+    jobs = plan_jobs(resolved, bids_root, state, args)
+    if args.dry_run:
+        logger.info("Dry run: %d jobs planned.", len(jobs))
+        return 0
+
+    logger.info("Running %d jobs with %d workers, %d threads each.", len(jobs), workers, args.num_threads)
+    failures = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_job, session_id, state) for session_id in jobs]
+        for future in as_completed(futures):
+            if future.result() != 0:
+                failures += 1
+
+    logger.info("Batch finished: %s", state.summary())
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
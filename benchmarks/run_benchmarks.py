@@ -0,0 +1,210 @@
+#!/usr/local/miniconda/bin/python
+"""Benchmarks for the gear's Python and packaging paths.
+
+Every case runs on synthetic data generated in a scratch directory:
+
+    download_index    download the anat files from a mock Flywheel client with
+                      simulated latency, index them and look up each session's T1w
+    index_warm        reload the persisted anat index and run the lookups again
+    organize          arrange ANTs-CT outputs into a BIDS derivatives tree
+    archive           stream the outputs into the zip and link the loose files
+
+Results are appended to a JSON lines history together with the git commit,
+and each case is compared with the latest result of a different commit.
+
+    python benchmarks/run_benchmarks.py --subjects 20 --sessions 2 --repeat 5
+"""
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+from pathlib import PosixPath
+
+REPO = PosixPath(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+sys.path.insert(0, str(REPO / 'benchmarks'))
+
+from antsct_utils import bids_filters, find_anat  # noqa: E402
+from bids_cache import download_anat  # noqa: E402
+from bids_index import load_anat_index, INDEX_FILE  # noqa: E402
+from bids_derivative import DirectorySink, organize  # noqa: E402
+from archive_outputs import ZipSink  # noqa: E402
+from mock_flywheel import MockClient  # noqa: E402
+import synthetic  # noqa: E402
+
+DEFAULT_HISTORY = REPO / 'benchmarks' / 'results.jsonl'
+
+
+def tree_bytes(path):
+    return sum(f.stat().st_size for f in PosixPath(path).rglob('*') if f.is_file())
+
+
+def gather(client):
+    """Use fw-heudiconv's gather_bids() when it is installed, else the equivalent listing."""
+    try:
+        from fw_heudiconv.cli import export
+    except ImportError:
+        return synthetic.gather_anat(client)
+    return export.gather_bids(client, 'mock')
+
+
+class Benchmarks(object):
+    """Generates the synthetic data once and times each case on it."""
+
+    def __init__(self, scratch, args):
+        self.scratch = PosixPath(scratch)
+        self.args = args
+        shape = (args.shape,) * 3
+        self.source = self.scratch / 'source_bids'
+        self.images = synthetic.make_bids_tree(self.source, args.subjects, args.sessions, args.runs, shape)
+        self.sessions = sorted(set((p.parts[-4][4:], p.parts[-3][4:]) for p in self.images))
+        self.prefix = 'sub-001_ses-01_'
+        self.outputs = synthetic.make_ants_outputs(self.scratch / 'ants_output', self.prefix, shape)
+        self.output_bytes = tree_bytes(self.outputs)
+        self.download_dir = self.scratch / 'download'
+
+    def _lookups(self, layout):
+        found = 0
+        for subject, session in self.sessions:
+            found += len(find_anat(layout, bids_filters([subject], [session])))
+        return found
+
+    def download_index(self):
+        if self.download_dir.exists():
+            shutil.rmtree(str(self.download_dir))
+        client = MockClient.from_bids(self.source, latency=self.args.latency)
+        project = client.projects.find_first('label="mock"')
+        session_ids = [session['id'] for session in client.get_project_sessions(project['id'])]
+        root = download_anat(client, gather(client), self.download_dir, workers=self.args.download_workers,
+                             session_ids=session_ids)
+        found = self._lookups(load_anat_index(root))
+        return {'files': found, 'requests': client.calls}
+
+    def index_warm(self):
+        root = self.download_dir / 'bids_dataset'
+        if not (root / INDEX_FILE).exists():
+            self.download_index()
+        return {'files': self._lookups(load_anat_index(root))}
+
+    def organize(self):
+        dest = self.scratch / 'ants-ct'
+        if dest.exists():
+            shutil.rmtree(str(dest))
+        sink = DirectorySink(dest)
+        organize(self.outputs, sink, self.prefix.rstrip('_'))
+        sink.close()
+        return {'bytes': self.output_bytes}
+
+    def archive(self):
+        zip_path = self.scratch / 'outputs.zip'
+        loose = self.scratch / 'loose'
+        if loose.exists():
+            shutil.rmtree(str(loose))
+        sink = ZipSink(zip_path, 'ants-ct', self.args.zip_workers, loose, ['csv', 'png', 'desc-thickness'])
+        organize(self.outputs, sink, self.prefix.rstrip('_'))
+        sink.close()
+        return {'bytes': self.output_bytes, 'zip_bytes': zip_path.stat().st_size}
+
+    CASES = ['download_index', 'index_warm', 'organize', 'archive']
+
+    def run(self, name, repeat):
+        times = []
+        info = {}
+        for _ in range(repeat):
+            start = time.time()
+            info = getattr(self, name)()
+            times.append(time.time() - start)
+        result = {'name': name, 'median_seconds': statistics.median(times), 'min_seconds': min(times),
+                  'runs': repeat}
+        result.update(info)
+        if 'bytes' in info:
+            result['mb_per_second'] = info['bytes'] / 1e6 / result['median_seconds']
+        if 'files' in info:
+            result['files_per_second'] = info['files'] / result['median_seconds']
+        return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(REPO),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_baseline(history, commit, config):
+    """Return the latest results recorded for another commit with the same configuration."""
+    if not history.exists():
+        return None
+    baseline = None
+    with history.open() as f:
+        for line in f:
+            entry = json.loads(line)
+            if entry['commit'] != commit and entry['config'] == config:
+                baseline = entry
+    return baseline
+
+
+def compare(results, baseline, threshold):
+    """Print each case next to the baseline; return the names of the cases that regressed."""
+    before = dict((r['name'], r) for r in (baseline or {}).get('results', []))
+    regressions = []
+    print('{:<18} {:>10} {:>10} {:>8}'.format('case', 'median s', 'baseline', 'ratio'))
+    for result in results:
+        old = before.get(result['name'])
+        if old:
+            ratio = result['median_seconds'] / max(old['median_seconds'], 1e-9)
+            flag = ' REGRESSION' if ratio > threshold else ''
+            if flag:
+                regressions.append(result['name'])
+            print('{:<18} {:>10.4f} {:>10.4f} {:>8.2f}{}'.format(result['name'], result['median_seconds'],
+                                                                  old['median_seconds'], ratio, flag))
+        else:
+            print('{:<18} {:>10.4f} {:>10} {:>8}'.format(result['name'], result['median_seconds'], '-', '-'))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the gear on synthetic data.')
+    parser.add_argument('--subjects', type=int, default=20)
+    parser.add_argument('--sessions', type=int, default=2)
+    parser.add_argument('--runs', type=int, default=1, help='T1w runs per session.')
+    parser.add_argument('--shape', type=int, default=48, help='Edge length of the synthetic images.')
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds per mock Flywheel request.')
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--zip-workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cases', nargs='+', choices=Benchmarks.CASES, default=Benchmarks.CASES)
+    parser.add_argument('--history', default=str(DEFAULT_HISTORY), help='JSON lines file of earlier results.')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Slowdown ratio reported as a regression.')
+    parser.add_argument('--no-save', action='store_true', help='Do not append the results to the history.')
+    parser.add_argument('--keep', help='Generate the data in this directory and keep it.')
+    args = parser.parse_args(argv)
+
+    config = dict((k, getattr(args, k)) for k in ['subjects', 'sessions', 'runs', 'shape', 'latency',
+                                                  'download_workers', 'zip_workers'])
+    scratch = args.keep or tempfile.mkdtemp(prefix='antsct-bench-')
+    try:
+        start = time.time()
+        bench = Benchmarks(scratch, args)
+        print('Generated {} images in {:.1f} s'.format(len(bench.images), time.time() - start))
+        results = [bench.run(name, args.repeat) for name in args.cases]
+    finally:
+        if not args.keep:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    commit = git_commit()
+    history = PosixPath(args.history)
+    regressions = compare(results, load_baseline(history, commit, config), args.threshold)
+    if not args.no_save:
+        with history.open('a') as f:
+            f.write(json.dumps({'commit': commit, 'time': time.time(), 'config': config, 'results': results}) + '\n')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""Synthetic inputs for the benchmarks: BIDS trees and ANTs-CT outputs.
+
+Images are written as valid NIfTI-1 files with the standard library only, so
+the benchmarks run without nibabel or numpy.
+"""
+import gzip
+import json
+import random
+import struct
+from pathlib import PosixPath
+
+from bids_derivative import RENAMES
+from label_registry import TISSUE_LABELS
+
+HEADER_FORMAT = '<i10s18sihcb8h3f4h8f3fhbb2f2f2i80s24s2h6f12f16s4s'
+# NIfTI datatype code and bits per voxel
+DATATYPES = {'uint8': (2, 8), 'int16': (4, 16), 'float32': (16, 32)}
+
+
+def nifti_header(shape, dtype='int16', zooms=(1.0, 1.0, 1.0)):
+    """Return a 352-byte NIfTI-1 header (with an empty extension block)."""
+    datatype, bitpix = DATATYPES[dtype]
+    dim = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    pixdim = [1.0] + list(zooms) + [1.0] * (7 - len(zooms))
+    srow = [zooms[0], 0, 0, 0, 0, zooms[1], 0, 0, 0, 0, zooms[2], 0]
+    header = struct.pack(HEADER_FORMAT, 348, b'', b'', 0, 0, b'r', 0, *dim, 0.0, 0.0, 0.0,
+                         0, datatype, bitpix, 0, *pixdim, 352.0, 1.0, 0.0, 0, 0, 10, 0.0, 0.0, 0.0, 0.0, 0, 0,
+                         b'synthetic', b'', 0, 1, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, *srow, b'', b'n+1\0')
+    return header + b'\0' * 4
+
+
+def voxel_bytes(shape, dtype='int16', seed=0, levels=64):
+    """Deterministic noise with a limited number of levels, so it compresses like real data."""
+    count = 1
+    for n in shape:
+        count *= n
+    rng = random.Random(seed)
+    block = min(count, 1 << 16)
+    values = rng.getrandbits(8 * block).to_bytes(block, 'little').translate(bytes(i % levels for i in range(256)))
+    data = (values * (count // len(values) + 1))[:count]
+    width = DATATYPES[dtype][1] // 8
+    if width == 1:
+        return data
+    # little-endian, upper bytes zero
+    voxels = bytearray(count * width)
+    voxels[0::width] = data
+    return bytes(voxels)
+
+
+def write_nifti(path, shape=(32, 32, 32), dtype='int16', seed=0, compress=True):
+    path = PosixPath(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = nifti_header(shape, dtype) + voxel_bytes(shape, dtype, seed)
+    if compress:
+        # the level nibabel and ITK write with
+        with gzip.open(str(path), 'wb', compresslevel=6) as f:
+            f.write(data)
+    else:
+        path.write_bytes(data)
+    return path
+
+
+def make_bids_tree(root, subjects=10, sessions=2, runs=1, shape=(32, 32, 32), extra_files=4):
+    """Write a BIDS dataset with T1w images and some non-anatomical files; return the T1w paths."""
+    root = PosixPath(root)
+    root.mkdir(parents=True, exist_ok=True)
+    with (root / 'dataset_description.json').open('w') as f:
+        json.dump({'Name': 'synthetic', 'BIDSVersion': '1.4.0'}, f)
+    images = []
+    for sub in range(1, subjects + 1):
+        for ses in range(1, sessions + 1):
+            ses_dir = root / 'sub-{:03d}'.format(sub) / 'ses-{:02d}'.format(ses)
+            for run in range(1, runs + 1):
+                stem = 'sub-{:03d}_ses-{:02d}_run-{:02d}_T1w'.format(sub, ses, run)
+                images.append(write_nifti(ses_dir / 'anat' / (stem + '.nii.gz'), shape, seed=sub * 100 + ses))
+                with (ses_dir / 'anat' / (stem + '.json')).open('w') as f:
+                    json.dump({'RepetitionTime': 2.4, 'EchoTime': 0.00224}, f)
+            # other data types the anat lookup has to skip
+            for i in range(extra_files):
+                func = ses_dir / 'func' / 'sub-{:03d}_ses-{:02d}_task-rest_run-{:02d}_bold.json'.format(sub, ses, i)
+                func.parent.mkdir(parents=True, exist_ok=True)
+                with func.open('w') as f:
+                    json.dump({'TaskName': 'rest'}, f)
+    return images
+
+
+def gather_anat(client, project_label='mock'):
+    """Build the download listing fw-heudiconv's gather_bids() returns, from a MockClient."""
+    project = client.projects.find_first('label="{}"'.format(project_label))
+    to_download = {'dataset_description': [{'name': 'dataset_description.json', 'data': project['info']['BIDS']}],
+                   'project': [], 'subject': [], 'session': [], 'acquisition': []}
+    for session in client.get_project_sessions(project['id']):
+        for acq in client.get_session_acquisitions(session['id']):
+            for f in acq['files']:
+                sidecar = dict(f['info'])
+                to_download['acquisition'].append({'name': f['name'], 'data': acq['id'],
+                                                   'BIDS': dict(sidecar['BIDS']), 'sidecar': sidecar})
+    return to_download
+
+
+def make_ants_outputs(root, prefix='sub-001_ses-01_', shape=(32, 32, 32), csv_rows=200):
+    """Write the files runAntsCT_nonBIDS.pl leaves in its output directory."""
+    root = PosixPath(root)
+    root.mkdir(parents=True, exist_ok=True)
+    for i, (suffix, _, _) in enumerate(RENAMES):
+        if suffix.endswith('.nii.gz'):
+            write_nifti(root / (prefix + suffix[1:]), shape, 'float32' if 'Warp' in suffix else 'int16', seed=i)
+        else:
+            (root / (prefix + suffix[1:])).write_bytes(bytes(range(256)) * 4)
+    for label in TISSUE_LABELS:
+        write_nifti(root / '{}BrainSegmentationPosteriors{}.nii.gz'.format(prefix, label), shape, 'float32',
+                    seed=100 + label)
+    for name in ['brainvols.csv', 'Lausanne_Scale250_mean.csv', 'DKT31_mean.csv']:
+        lines = ['label,value'] + ['{},{:.4f}'.format(i, i * 0.137) for i in range(csv_rows)]
+        (root / (prefix + name)).write_text('\n'.join(lines) + '\n')
+    for name in ['CorticalThicknessTiledMosaic.png', 'BrainSegmentationTiledMosaic.png']:
+        (root / (prefix + name)).write_bytes(b'\x89PNG\r\n\x1a\n' + random.Random(1).getrandbits(160000).to_bytes(20000, 'little'))
+    (root / (prefix + 'antsct_log.txt')).write_text('step\n' * 5000)
+    (root / 'antsct_run.sh').write_text('/opt/scripts/runAntsCT_nonBIDS.pl --output-file-root {}\n'.format(prefix))
+    return root
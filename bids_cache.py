@@ -0,0 +1,202 @@
+"""Content-addressed on-disk cache for BIDS files downloaded from Flywheel.
+
+Cached files are keyed by Flywheel file id and content hash, so a file is only
+fetched over the network once. Downloads are hard-linked from the cache into
+the BIDS tree, and the cache is kept under a size limit by evicting the least
+recently used objects.
+
+The listing from gather_bids() names each file by acquisition id and file
+name only. When the sessions are known, their acquisitions are listed with
+one request per session, which gives the current id and hash of every file,
+so cached files are linked without a request per file.
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import PosixPath
+from antsct_utils import link_or_copy
+
+logger = logging.getLogger('antsct-gear')
+
+# Environment variables used by the gear to locate and size the cache
+CACHE_DIR_ENV = 'ANTSCT_CACHE_DIR'
+CACHE_SIZE_ENV = 'ANTSCT_CACHE_SIZE_GB'
+DEFAULT_CACHE_SIZE_GB = 50
+DOWNLOAD_WORKERS_ENV = 'ANTSCT_DOWNLOAD_WORKERS'
+DEFAULT_DOWNLOAD_WORKERS = 4
+
+
+class DownloadCache(object):
+    """Size-bounded LRU store of downloaded files, safe to share between threads."""
+
+    def __init__(self, root, max_bytes):
+        self.root = PosixPath(root)
+        self.max_bytes = max_bytes
+        self.objects = self.root / 'objects'
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls):
+        """Return the cache configured in the environment, or None if caching is off."""
+        root = os.environ.get(CACHE_DIR_ENV)
+        if not root:
+            return None
+        size_gb = float(os.environ.get(CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE_GB))
+        return cls(root, int(size_gb * 1024 ** 3))
+
+    @staticmethod
+    def key(file_id, file_hash):
+        return hashlib.sha256('{}:{}'.format(file_id, file_hash).encode()).hexdigest()
+
+    def path(self, key):
+        return self.objects / key[:2] / key
+
+    def fetch(self, key, download, dest):
+        """Place the object for key at dest, calling download(path) on a cache miss."""
+        cached = self.path(key)
+        with self.lock:
+            if cached.exists():
+                logger.info("Cache hit for %s", dest)
+                os.utime(str(cached))
+                link_or_copy(cached, dest)
+                return
+
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cached.with_name('{}.{}.{}.tmp'.format(key, os.getpid(), threading.get_ident()))
+        download(str(tmp))
+        with self.lock:
+            os.replace(str(tmp), str(cached))
+            link_or_copy(cached, dest)
+            self.evict(keep=cached)
+
+    def evict(self, keep=None):
+        """Remove least recently used objects until the cache fits in max_bytes."""
+        entries = []
+        total = 0
+        for obj in self.objects.glob('*/*'):
+            if obj.name.endswith('.tmp'):
+                continue
+            stat = obj.stat()
+            entries.append((stat.st_mtime, stat.st_size, obj))
+            total += stat.st_size
+
+        for mtime, size, obj in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if obj == keep:
+                continue
+            logger.info("Evicting %s from download cache", obj.name)
+            obj.unlink()
+            total -= size
+
+
+def file_key(container, file_name):
+    """Return the (file id, hash) pair identifying a file attached to a container."""
+    for f in container.get('files') or []:
+        if f.name == file_name:
+            return f.get('file_id') or f.get('_id') or f.get('id'), f.get('hash')
+    return None, None
+
+
+def write_sidecar(data, path, remove_bids=True):
+    """Write a JSON sidecar the same way fw-heudiconv does."""
+    data = dict(data or {})
+    if remove_bids and 'BIDS' in data:
+        if data['BIDS'].get('Task'):
+            data['TaskName'] = data['BIDS']['Task']
+        del data['BIDS']
+    with open(str(path), 'w') as sidecar:
+        json.dump(data, sidecar, sort_keys=True, indent=4)
+
+
+def list_acquisitions(client, session_ids, workers=None):
+    """Return {acquisition id: acquisition} for the sessions, listed concurrently, one request per session."""
+    session_ids = list(session_ids)
+    if not session_ids:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(workers or download_workers(), len(session_ids))) as pool:
+        listings = list(pool.map(client.get_session_acquisitions, session_ids))
+    return dict((acq.id, acq) for listing in listings for acq in listing)
+
+
+def _download_one(client, fi, file_path, cache, acquisitions=None):
+    """Download a single acquisition file, through the cache when possible.
+
+    The acquisition comes from the session listing when it is there, else it
+    is looked up; either way the cache key is its current file id and hash.
+    """
+    acq = (acquisitions or {}).get(fi['data']) or client.get(fi['data'])
+    file_id, file_hash = file_key(acq, fi['name'])
+    if cache is None or file_id is None or file_hash is None:
+        tmp = file_path.with_name(file_path.name + '.part')
+        acq.download_file(fi['name'], str(tmp))
+        os.replace(str(tmp), str(file_path))
+    else:
+        cache.fetch(cache.key(file_id, file_hash), lambda dest: acq.download_file(fi['name'], dest), file_path)
+    return file_path
+
+
+def download_workers():
+    """Number of concurrent downloads configured in the environment."""
+    return int(os.environ.get(DOWNLOAD_WORKERS_ENV, DEFAULT_DOWNLOAD_WORKERS))
+
+
+def download_anat(client, to_download, root_path, cache=None, folders_to_download=('anat',),
+                  name='bids_dataset', workers=None, session_ids=()):
+    """Download the imaging files gathered by fw-heudiconv, reusing cached copies.
+
+    This mirrors export.download_bids for acquisition files and the dataset
+    description, but can be run repeatedly into the same directory. Files are
+    fetched by a bounded pool of threads sharing the client's connection pool.
+    With the ids of the gathered sessions, acquisitions are listed per session
+    instead of looked up per file.
+    """
+    root = PosixPath(root_path) / name
+    root.mkdir(parents=True, exist_ok=True)
+
+    if to_download['dataset_description']:
+        description = to_download['dataset_description'][0]
+        write_sidecar(description['data'], root / description['name'], remove_bids=False)
+
+    bidsignore = root / '.bidsignore'
+    if not bidsignore.exists():
+        with bidsignore.open('w') as f:
+            f.write('\n'.join(['perf/', 'qsm/', '**/fmap/*.bvec', '**/fmap/*.bval']))
+
+    pending = []
+    for fi in to_download['acquisition']:
+        bids = fi.get('BIDS') or {}
+        if not bids.get('Path') or bids.get('Folder') not in folders_to_download or bids.get('ignore'):
+            continue
+        if 'sidecar' not in fi:
+            continue
+
+        fname = bids['Filename']
+        download_path = root / bids['Path']
+        download_path.mkdir(parents=True, exist_ok=True)
+        file_path = download_path / fname
+        sidecar_name = fname
+        for x in ['nii.gz', 'bval', 'bvec']:
+            sidecar_name = sidecar_name.replace(x, 'json')
+        write_sidecar(fi['sidecar'], download_path / sidecar_name)
+
+        if file_path.exists():
+            logger.info("%s already downloaded", file_path)
+            continue
+        pending.append((fi, file_path))
+
+    if pending:
+        acquisitions = list_acquisitions(client, session_ids, workers)
+        workers = min(workers or download_workers(), len(pending))
+        logger.info("Downloading %d files with %d workers", len(pending), workers)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_download_one, client, fi, file_path, cache, acquisitions)
+                       for fi, file_path in pending]
+            for future in as_completed(futures):
+                future.result()
+
+    return root
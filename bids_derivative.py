@@ -0,0 +1,200 @@
+#!/usr/local/miniconda/bin/python
+"""Arrange ANTs-CT outputs into a BIDS derivatives dataset.
+
+https://bids-specification.readthedocs.io/en/latest/02-common-principles.html#storage-of-derived-datasets
+
+The input directory is scanned once and every file is matched against a
+declarative table that maps ANTs output suffixes to BIDS names. Matched files
+are hard-linked into place (copied only across file systems). Expected
+outputs that were not found are written to logs/missing_files.json.
+
+    bids_derivative.py <input dir> <output dir> <source entities>
+"""
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+from pathlib import PosixPath
+from antsct_utils import link_or_copy
+from label_registry import tissue_table
+
+logger = logging.getLogger('antsct-gear')
+
+# ANTs output suffix -> BIDS name (after the source entities), and whether it is a brain mask
+RENAMES = [
+    ('_BrainExtractionMask.nii.gz', '_space-orig_desc-brain_mask.nii.gz', True),
+    ('_BrainNormalizedToTemplate.nii.gz', '_space-{template}_T1w.nii.gz', False),
+    ('_NeckTrim.nii.gz', '_space-orig_desc-necktrim_T1w.nii.gz', False),
+    ('_BrainSegmentation0N4.nii.gz', '_space-orig_desc-corrected_T1w.nii.gz', False),
+    ('_ExtractedBrain0N4.nii.gz', '_space-orig_desc-correctedExtracted_T1w.nii.gz', False),
+    ('_BrainSegmentation.nii.gz', '_space-orig_dseg.nii.gz', False),
+    ('_CorticalThickness.nii.gz', '_space-orig_desc-thickness_T1w.nii.gz', False),
+    ('_CorticalThicknessNormalizedToTemplate.nii.gz', '_space-{template}_desc-thickness_T1w.nii.gz', False),
+    ('_CorticalMask.nii.gz', '_space-orig_desc-cortex_mask.nii.gz', True),
+    ('_RegistrationTemplateBrainMask.nii.gz', '_space-{template}_desc-brain_mask.nii.gz', True),
+    # transforms
+    ('_SubjectToTemplate1Warp.nii.gz', '_from-T1w_to-{template}_mode-image-xfm.nii.gz', False),
+    ('_SubjectToTemplate0GenericAffine.mat', '_from-T1w_to-{template}_mode-image-xfm.mat', False),
+    ('_TemplateToSubject0Warp.nii.gz', '_from-{template}_to-T1w_mode-image-xfm.nii.gz', False),
+    ('_TemplateToSubject1GenericAffine.mat', '_from-{template}_to-T1w_mode-image-xfm.mat', False),
+    ('_SubjectToTemplateLogJacobian.nii.gz', '_from-T1w_to-{template}_desc-logjacobian_T1w.nii.gz', False),
+]
+POSTERIOR_RE = re.compile(r'_BrainSegmentationPosteriors(?P<label>\d+)\.nii\.gz$')
+POSTERIOR_NAME = '_label-{label}_desc-posterior_probseg.nii.gz'
+
+# Groups of files copied under their own names: group -> pattern
+COPY_GROUPS = [
+    ('csv', re.compile(r'\.csv$')),
+    ('regionstats', re.compile(r'_regionstats\.tsv$')),
+    ('Lausanne', re.compile(r'Lausanne')),
+    ('DKT31', re.compile(r'DKT31')),
+    ('labels', re.compile(r'_space-orig_atlas-.+_dseg\.(nii\.gz|tsv)$')),
+    ('png', re.compile(r'\.png$')),
+    ('qc', re.compile(r'_qc\.html$')),
+]
+LOG_RE = re.compile(r'(\.txt|^antsct_run\.sh)$')
+
+
+def mask_sidecar(raw_source):
+    return {'RawSources': raw_source, 'Type': 'Brain'}
+
+
+def dseg_table(tissues=None):
+    """Return the TSV overriding the default BIDS tissue label scheme."""
+    return (tissues if tissues is not None else tissue_table()).tsv()
+
+
+def plan(input_dir, source_entities, template_name='template', tissues=None):
+    """Match the files of input_dir against the rename table in a single scan.
+
+    Returns (renames, copies, logs, missing, tissues), where renames is a list
+    of (source, BIDS name, is_mask) tuples and tissues the tissue class table.
+    Without tissues, there is one class per posterior, as the posteriors
+    match the template's priors.
+    """
+    renames = []
+    copies = []
+    logs = []
+    posteriors = []
+    found = set()
+    groups_found = set()
+    for entry in sorted(os.scandir(str(input_dir)), key=lambda e: e.name):
+        if not entry.is_file():
+            continue
+        name = entry.name
+        if LOG_RE.search(name):
+            logs.append(entry.path)
+            continue
+
+        for suffix, target, is_mask in RENAMES:
+            if name.endswith(suffix):
+                renames.append((entry.path, source_entities + target.format(template=template_name), is_mask))
+                found.add(suffix)
+                break
+        else:
+            posterior = POSTERIOR_RE.search(name)
+            if posterior:
+                posteriors.append((entry.path, int(posterior.group('label'))))
+                found.add('posteriors')
+                continue
+
+            matched = [group for group, pattern in COPY_GROUPS if pattern.search(name)]
+            if matched:
+                copies.append(entry.path)
+                groups_found.update(matched)
+
+    if tissues is None:
+        tissues = tissue_table(max([number for _, number in posteriors] + [0]) or None)
+    for path, number in posteriors:
+        label = tissues.get(number, 'abbr')
+        if label is None:
+            logger.warning("Label number %d does not match a known tissue class label.", number)
+            label = str(number)
+        renames.append((path, source_entities + POSTERIOR_NAME.format(label=label), False))
+
+    missing = [{'type': 'file', 'pattern': '*' + suffix,
+                'target': source_entities + target.format(template=template_name)}
+               for suffix, target, _ in RENAMES if suffix not in found]
+    if 'posteriors' not in found:
+        missing.append({'type': 'file', 'pattern': '*_BrainSegmentationPosteriors*',
+                        'target': source_entities + POSTERIOR_NAME.format(label='*')})
+    missing.extend({'type': 'group', 'pattern': pattern.pattern, 'group': group}
+                   for group, pattern in COPY_GROUPS if group not in groups_found)
+    return renames, copies, logs, missing, tissues
+
+
+class DirectorySink(object):
+    """Writes derivatives into a directory tree, hard-linking source files."""
+
+    def __init__(self, root):
+        self.root = PosixPath(root)
+
+    def _target(self, relpath):
+        path = self.root / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def add_file(self, source, relpath):
+        link_or_copy(source, self._target(relpath))
+
+    def add_text(self, text, relpath):
+        with self._target(relpath).open('w') as f:
+            f.write(text)
+
+    def close(self):
+        pass
+
+
+def organize(input_dir, sink, source_entities, template_name='template'):
+    """Send the derivatives to sink and return the list of missing outputs."""
+    input_dir = PosixPath(input_dir)
+
+    # derive subject and session name
+    subject_name = source_entities.split('_')[0]
+    session_name = source_entities.split('_')[1]
+    anat_dir = PosixPath(subject_name) / session_name / 'anat'
+    log_dir = PosixPath('logs')
+
+    renames, copies, logs, missing, tissues = plan(input_dir, source_entities, template_name)
+
+    raw_source = str(input_dir / '{}.nii.gz'.format(source_entities))
+    for source, target, is_mask in renames:
+        sink.add_file(source, anat_dir / target)
+        if is_mask:
+            sink.add_text(json.dumps(mask_sidecar(raw_source), indent=1),
+                          anat_dir / target.replace('.nii.gz', '.json'))
+    for source in copies:
+        sink.add_file(source, anat_dir / os.path.basename(source))
+    for source in logs:
+        sink.add_file(source, log_dir / os.path.basename(source))
+
+    sink.add_text(dseg_table(tissues), anat_dir / '{}_space-orig_dseg.tsv'.format(source_entities))
+
+    for item in missing:
+        logger.warning("Missing output: %s", item['pattern'])
+    sink.add_text(json.dumps({'source_entities': source_entities, 'missing': missing}, indent=2),
+                  log_dir / 'missing_files.json')
+
+    logger.info("Arranged %d outputs for %s (%d missing)", len(renames) + len(copies), source_entities, len(missing))
+    return missing
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Arrange ANTs-CT outputs into BIDS derivatives.')
+    parser.add_argument('input_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('source_entities', help='Output file root, e.g. sub-01_ses-01')
+    parser.add_argument('--template-name', default='template')
+    args = parser.parse_args(argv)
+
+    sink = DirectorySink(args.output_dir)
+    organize(args.input_dir, sink, args.source_entities, args.template_name)
+    sink.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""Minimal, persisted index of the anatomical images in a BIDS dataset.
+
+The gear only ever looks up T1w images by subject, session, acquisition and
+run, so instead of having pybids walk and validate the whole tree, only the
+``anat`` folders are scanned and the parsed entities are stored next to the
+data. The stored index is reused as long as the anat folders are unchanged.
+"""
+import os
+import re
+import json
+import hashlib
+import logging
+from pathlib import PosixPath
+
+logger = logging.getLogger('antsct-gear')
+
+INDEX_FILE = '.antsct_anat_index.json'
+INDEX_VERSION = 1
+
+# BIDS entity key -> pybids entity name
+ENTITIES = {'sub': 'subject', 'ses': 'session', 'acq': 'acquisition', 'ce': 'ceagent',
+            'rec': 'reconstruction', 'run': 'run'}
+FILENAME_RE = re.compile(r'^(?P<stem>[^.]+)(?P<extension>\..+)$')
+
+
+def anat_dirs(bids_root):
+    """Yield every sub-*/[ses-*/]anat directory in the dataset."""
+    for sub in sorted(PosixPath(bids_root).glob('sub-*')):
+        if (sub / 'anat').is_dir():
+            yield sub / 'anat'
+        for ses in sorted(sub.glob('ses-*')):
+            if (ses / 'anat').is_dir():
+                yield ses / 'anat'
+
+
+def scan(bids_root):
+    """Return the stat listing of all anat files and a fingerprint of it."""
+    listing = []
+    for anat in anat_dirs(bids_root):
+        for entry in os.scandir(str(anat)):
+            if entry.is_file():
+                stat = entry.stat()
+                listing.append((entry.path, stat.st_size, stat.st_mtime_ns))
+    listing.sort()
+    fingerprint = hashlib.sha1(json.dumps(listing).encode()).hexdigest()
+    return listing, fingerprint
+
+
+def parse_entities(path):
+    """Parse BIDS entities, suffix and extension from a file name."""
+    match = FILENAME_RE.match(os.path.basename(path))
+    if not match:
+        return None
+    parts = match.group('stem').split('_')
+    entities = {'suffix': parts[-1], 'extension': match.group('extension')}
+    for part in parts[:-1]:
+        key, _, value = part.partition('-')
+        if key in ENTITIES and value:
+            entities[ENTITIES[key]] = value
+    return entities
+
+
+def _normalize(value):
+    value = str(value)
+    return str(int(value)) if value.isdigit() else value
+
+
+def _matches(value, wanted):
+    if value is None:
+        return False
+    if not isinstance(wanted, (list, tuple, set)):
+        wanted = [wanted]
+    return _normalize(value) in set(_normalize(w) for w in wanted)
+
+
+class AnatIndex(object):
+    """Answers the subset of BIDSLayout.get() used to select anatomical inputs."""
+
+    def __init__(self, files):
+        self.files = files
+
+    def get(self, return_type='file', extension=None, **filters):
+        if return_type != 'file':
+            raise ValueError("AnatIndex only supports return_type='file'")
+        results = []
+        for path, entities in self.files:
+            if extension and entities['extension'] not in extension:
+                continue
+            if all(_matches(entities.get(key), wanted) for key, wanted in filters.items()):
+                results.append(path)
+        return results
+
+
+def load_anat_index(bids_root):
+    """Return an AnatIndex for bids_root, rebuilding the stored index if the anat files changed."""
+    bids_root = PosixPath(bids_root).resolve()
+    index_path = bids_root / INDEX_FILE
+    listing, fingerprint = scan(bids_root)
+
+    if index_path.exists():
+        try:
+            with index_path.open() as f:
+                stored = json.load(f)
+            if stored.get('version') == INDEX_VERSION and stored.get('fingerprint') == fingerprint:
+                logger.info("Using stored anat index for %s", bids_root)
+                return AnatIndex([tuple(item) for item in stored['files']])
+        except (ValueError, KeyError):
+            logger.warning("Ignoring unreadable anat index %s", index_path)
+
+    files = []
+    for path, _, _ in listing:
+        entities = parse_entities(path)
+        if entities is not None:
+            files.append((path, entities))
+
+    tmp = index_path.with_name(INDEX_FILE + '.tmp')
+    with tmp.open('w') as f:
+        json.dump({'version': INDEX_VERSION, 'fingerprint': fingerprint, 'files': files}, f)
+    os.replace(str(tmp), str(index_path))
+    logger.info("Indexed %d anat files in %s", len(files), bids_root)
+
+    return AnatIndex(files)
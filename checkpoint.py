@@ -0,0 +1,224 @@
+#!/usr/local/miniconda/bin/python
+"""Stage checkpoints for the ANTs-CT run.
+
+runAntsCT_nonBIDS.pl writes into a work directory that survives a failed or
+killed run. Each pipeline stage is identified by the output files it leaves
+there, and gets a key chained from the anatomical input checksum, the
+settings that affect it and the keys of the stages it depends on. When a
+stage is complete, its key and the signatures of its outputs are recorded in
+a marker file.
+
+Before a retry, stages whose key and outputs still match are kept and every
+other stage's outputs are removed. antsCorticalThickness.sh skips the stages
+whose outputs already exist, so only the invalid stages are recomputed.
+
+    checkpoint.py watch <work dir>             record stages as they finish
+    checkpoint.py record <work dir>            record complete stages once
+    checkpoint.py export <work dir> <out dir>  link the outputs into out dir
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from pathlib import PosixPath
+from antsct_utils import link_or_copy
+from template_cache import checksum, signature
+
+logger = logging.getLogger('antsct-gear')
+
+WORK_DIR_ENV = 'ANTSCT_WORK_DIR'
+MARKER = '.antsct_checkpoints.json'
+PLAN = '.antsct_checkpoint_plan.json'
+
+# stage, stages it depends on, settings it depends on, output patterns (after the file root)
+STAGES = [
+    ('necktrim', [], ['trim_neck'], ['NeckTrim.nii.gz']),
+    ('denoise', ['necktrim'], ['denoise'], ['Denoised*.nii.gz']),
+    ('brain_extraction', ['denoise'], ['template'], ['BrainExtractionMask.nii.gz']),
+    ('segmentation', ['brain_extraction'], ['template'],
+     ['BrainSegmentation.nii.gz', 'BrainSegmentation0N4.nii.gz', 'BrainSegmentationPosteriors*.nii.gz']),
+    ('thickness', ['segmentation'], [], ['CorticalThickness.nii.gz']),
+    ('registration', ['brain_extraction'], ['template', 'run_quick'],
+     ['SubjectToTemplate1Warp.nii.gz', 'SubjectToTemplate0GenericAffine.mat',
+      'TemplateToSubject0Warp.nii.gz', 'TemplateToSubject1GenericAffine.mat']),
+    ('normalization', ['registration', 'thickness'], [],
+     ['BrainNormalizedToTemplate.nii.gz', 'CorticalThicknessNormalizedToTemplate.nii.gz',
+      'SubjectToTemplateLogJacobian.nii.gz']),
+    ('labels', ['registration', 'thickness'], ['labels'], ['*Lausanne*', '*DKT31*']),
+]
+# Settings that switch a stage off
+OPTIONAL_STAGES = {'necktrim': 'trim_neck', 'denoise': 'denoise'}
+
+
+def work_dir(default):
+    """Return the work directory, moved under $ANTSCT_WORK_DIR when that is set."""
+    root = os.environ.get(WORK_DIR_ENV)
+    if root:
+        return PosixPath(root) / PosixPath(default).name
+    return PosixPath(default)
+
+
+def stage_keys(anat_input, settings):
+    """Return {stage: key} for an anatomical image and the run settings.
+
+    settings holds denoise, run_quick, trim_neck, template and labels (a list
+    of label image paths); the label images are hashed with their content.
+    """
+    settings = dict(settings)
+    settings['labels'] = sorted(checksum(p) for p in settings.get('labels') or [])
+    keys = {}
+    for name, depends, used, _ in STAGES:
+        upstream = [keys[d] for d in depends] or [checksum(anat_input)]
+        payload = [name, upstream, [(k, settings.get(k)) for k in used]]
+        keys[name] = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    return keys
+
+
+def _enabled(name, settings):
+    flag = OPTIONAL_STAGES.get(name)
+    return flag is None or bool(int(settings.get(flag) or 0))
+
+
+def _read(path):
+    if not path.exists():
+        return {}
+    try:
+        with path.open() as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def _write(path, data):
+    tmp = path.with_name(path.name + '.tmp')
+    with tmp.open('w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(str(tmp), str(path))
+
+
+def stage_outputs(work_dir, prefix, patterns):
+    """Return the files of a stage, or None if one of its patterns matches nothing."""
+    files = []
+    for pattern in patterns:
+        matched = [p for p in sorted(PosixPath(work_dir).glob(prefix + pattern)) if p.is_file()]
+        if not matched or any(p.stat().st_size == 0 for p in matched):
+            return None
+        files.extend(matched)
+    return files
+
+
+def resume(work_dir, prefix, keys, settings):
+    """Keep the valid stages of an earlier attempt and clear the rest; return the kept stages."""
+    work_dir = PosixPath(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    markers = _read(work_dir / MARKER)
+    valid = set()
+    # stages that are switched off or leave no files behind don't hold up the stages after them
+    passed = set()
+    for name, depends, _, patterns in STAGES:
+        marker = markers.get(name)
+        if not _enabled(name, settings) or (marker is None and not any(
+                list(work_dir.glob(prefix + pattern)) for pattern in patterns)):
+            passed.add(name)
+        ok = marker is not None and marker['key'] == keys[name] and \
+            all(d in valid or d in passed for d in depends)
+        if ok:
+            for output, sig in marker['outputs'].items():
+                path = work_dir / output
+                if not path.exists() or signature(path) != sig:
+                    ok = False
+                    break
+        if ok:
+            valid.add(name)
+            continue
+        markers.pop(name, None)
+        for pattern in patterns:
+            for path in work_dir.glob(prefix + pattern):
+                if path.is_file():
+                    path.unlink()
+
+    _write(work_dir / MARKER, markers)
+    _write(work_dir / PLAN, {'prefix': prefix, 'keys': keys, 'settings': settings})
+    kept = [name for name, _, _, _ in STAGES if name in valid]
+    if kept:
+        logger.info("Resuming in %s: keeping completed stages %s", work_dir, ', '.join(kept))
+    return kept
+
+
+def record(work_dir, previous=None):
+    """Mark the complete stages of the planned run.
+
+    With previous (the output signatures seen on an earlier call), a stage is
+    only marked when its outputs have not changed since then, so files that are
+    still being written are not recorded. Returns the current signatures.
+    """
+    work_dir = PosixPath(work_dir)
+    plan = _read(work_dir / PLAN)
+    if not plan:
+        return {}
+    markers = _read(work_dir / MARKER)
+    seen = {}
+    for name, _, _, patterns in STAGES:
+        files = stage_outputs(work_dir, plan['prefix'], patterns)
+        if files is None:
+            continue
+        outputs = dict((p.name, signature(p)) for p in files)
+        seen[name] = outputs
+        if markers.get(name, {}).get('key') == plan['keys'][name]:
+            continue
+        if previous is not None and previous.get(name) != outputs:
+            continue
+        markers[name] = {'key': plan['keys'][name], 'outputs': outputs, 'recorded': time.time()}
+        logger.info("Checkpoint: %s complete", name)
+    _write(work_dir / MARKER, markers)
+    return seen
+
+
+def watch(work_dir, interval=60, stop=None):
+    """Record stages as they complete, until stop is set or the process is killed."""
+    stop = stop or threading.Event()
+    previous = {}
+    while not stop.wait(interval):
+        previous = record(work_dir, previous)
+
+
+def export(work_dir, output_dir):
+    """Link the top-level outputs of the work directory into output_dir."""
+    count = 0
+    for entry in os.scandir(str(work_dir)):
+        if entry.is_file() and not entry.name.startswith('.'):
+            dest = PosixPath(output_dir) / entry.name
+            if dest.exists():
+                dest.unlink()
+            link_or_copy(entry.path, dest)
+            count += 1
+    logger.info("Exported %d files from %s", count, work_dir)
+    return count
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Checkpoint the stages of an ANTs-CT run.')
+    parser.add_argument('action', choices=['watch', 'record', 'export'])
+    parser.add_argument('work_dir')
+    parser.add_argument('output_dir', nargs='?')
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between checks (watch).')
+    args = parser.parse_args(argv)
+
+    if args.action == 'watch':
+        watch(args.work_dir, args.interval)
+    elif args.action == 'record':
+        record(args.work_dir)
+    else:
+        if not args.output_dir:
+            parser.error('export needs an output directory')
+        export(args.work_dir, args.output_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,240 @@
+#!/usr/local/miniconda/bin/python
+"""Warp MNI label images to subject space, one batched pass per image grid.
+
+The TemplateToSubject affine and warp of the ANTs-CT run are composed once
+into a single displacement field. Label images that share a grid are stacked
+into one 4D volume and warped together by a single antsApplyTransforms call
+with nearest-neighbour interpolation, and the stacks of different grids are
+warped in parallel. Cortical label sets are then propagated through the
+subject's cortical mask, also in parallel. Each set is written as
+<file root>space-orig_atlas-<name>_dseg.nii.gz, with its dseg.tsv from the
+label registry when one is found.
+
+Any number of label images can be given, on the command line or in a list
+written by prepare_run.py from the gear inputs.
+
+    label_propagation.py <ANTs output dir> <file root> [--labels IMAGE ...] [--cortical-labels IMAGE ...] [--list FILE]
+"""
+import os
+import re
+import sys
+import json
+import zipfile
+import logging
+import argparse
+import tempfile
+import subprocess
+from pathlib import PosixPath
+from concurrent.futures import ThreadPoolExecutor
+from antsct_utils import cpu_budget, thread_environment
+from label_registry import LabelRegistry, LABELS_CACHE, TISSUE_LABELS, label_entities
+
+logger = logging.getLogger('antsct-gear')
+
+LABEL_LIST = 'label_sets.json'
+LABEL_IMAGE_RE = re.compile(r'\.nii(\.gz)?$')
+# composed in the order antsCorticalThickness.sh applies them to the priors (after the file root)
+TRANSFORMS = ['TemplateToSubject1GenericAffine.mat', 'TemplateToSubject0Warp.nii.gz']
+REFERENCE = 'BrainSegmentation0N4.nii.gz'
+CORTICAL_MASK = 'CorticalMask.nii.gz'
+CORTEX_CLASS = [number for number, (label, _) in TISSUE_LABELS.items() if label == 'CGM'][0]
+
+
+def write_label_list(path, labels=(), cortical_labels=()):
+    """Write the label images to propagate, as [{'path': ..., 'cortical': ...}]."""
+    entries = [{'path': str(p), 'cortical': False} for p in labels]
+    entries.extend({'path': str(p), 'cortical': True} for p in cortical_labels)
+    path = PosixPath(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('w') as f:
+        json.dump(entries, f, indent=1)
+    return entries
+
+
+def read_label_list(path):
+    with open(str(path)) as f:
+        return [(entry['path'], entry['cortical']) for entry in json.load(f)]
+
+
+def extract_labels_zip(zip_path, dest_dir):
+    """Extract a zip of label images; returns (labels, cortical labels).
+
+    Images in a folder named cortical are cortical label sets. The dseg.tsv
+    tables in the zip are extracted next to their images.
+    """
+    dest_dir = PosixPath(dest_dir)
+    with zipfile.ZipFile(str(zip_path), 'r') as zip_ref:
+        zip_ref.extractall(str(dest_dir))
+    labels, cortical = [], []
+    for path in sorted(dest_dir.rglob('*')):
+        if path.is_file() and LABEL_IMAGE_RE.search(path.name) and not path.name.startswith('.'):
+            relative = path.relative_to(dest_dir).parts[:-1]
+            (cortical if 'cortical' in relative else labels).append(path)
+    logger.info("Extracted %d label images and %d cortical label images from %s", len(labels), len(cortical),
+                zip_path)
+    return labels, cortical
+
+
+def output_name(path, prefix, taken):
+    """Subject-space name of a label image, from its atlas/desc entities or its file name."""
+    entities = label_entities(path)
+    atlas = entities.get('atlas') or re.sub(r'[^a-zA-Z0-9]', '', os.path.basename(str(path)).split('.')[0])
+    desc = '_desc-' + entities['desc'] if 'desc' in entities else ''
+    name, count = 'atlas-' + atlas + desc, 1
+    while name in taken:
+        count += 1
+        name = 'atlas-{}{}{}'.format(atlas, count, desc)
+    taken.add(name)
+    return '{}space-orig_{}_dseg.nii.gz'.format(prefix, name)
+
+
+def grid_key(img):
+    import numpy as np
+    return img.shape[:3], tuple(np.round(img.affine, 4).ravel())
+
+
+def run_ants(cmd, threads):
+    """Run an ANTs command line limited to the given number of threads."""
+    logger.info(' '.join(cmd))
+    env = dict(os.environ, **thread_environment(threads))
+    subprocess.run(cmd, env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def compose(transforms, reference, dest, threads):
+    """Compose the transforms into one displacement field on the reference grid."""
+    cmd = ['antsApplyTransforms', '-d', '3', '-r', str(reference), '-o', '[{},1]'.format(dest)]
+    for transform in transforms:
+        cmd.extend(['-t', str(transform)])
+    run_ants(cmd, threads)
+    return dest
+
+
+def warp_stack(images, reference, field, tmp_dir, index, threads):
+    """Warp label images sharing one grid in a single pass; returns the warped 4D image."""
+    import numpy as np
+    import nibabel as nb
+    volumes = []
+    for img in images:
+        data = np.asanyarray(img.dataobj)
+        volumes.append(data if data.dtype.kind in 'iu' else np.rint(data))
+    stack = nb.Nifti1Image(np.stack(volumes, axis=3).astype(np.int32), images[0].affine)
+    stack.header.set_xyzt_units(xyz='mm')
+    source = PosixPath(tmp_dir) / 'stack{}.nii.gz'.format(index)
+    warped = PosixPath(tmp_dir) / 'stack{}_warped.nii.gz'.format(index)
+    stack.to_filename(str(source))
+    run_ants(['antsApplyTransforms', '-d', '3', '-e', '3', '-n', 'NearestNeighbor', '-u', 'int',
+              '-i', str(source), '-r', str(reference), '-o', str(warped), '-t', str(field)], threads)
+    return nb.load(str(warped))
+
+
+def write_labels(data, reference, path):
+    """Write a label volume in the smallest integer type that holds its labels."""
+    import numpy as np
+    import nibabel as nb
+    path = PosixPath(path)
+    top = int(data.max()) if data.size else 0
+    dtype = np.uint8 if top < 2 ** 8 else np.int16 if top < 2 ** 15 else np.int32
+    img = nb.Nifti1Image(data.astype(dtype), reference.affine, reference.header)
+    img.header.set_data_dtype(dtype)
+    img.header.set_slope_inter(None, None)
+    tmp = path.with_name('.propagate_' + path.name)
+    img.to_filename(str(tmp))
+    os.replace(str(tmp), str(path))
+
+
+def cortical_mask(output_dir, prefix, tmp_dir):
+    """The subject's cortical mask, or the cortex class of the segmentation."""
+    import nibabel as nb
+    mask = PosixPath(output_dir) / (prefix + CORTICAL_MASK)
+    if mask.exists():
+        return mask
+    segmentation = nb.load(str(PosixPath(output_dir) / (prefix + 'BrainSegmentation.nii.gz')))
+    mask = PosixPath(tmp_dir) / CORTICAL_MASK
+    write_labels(segmentation.get_fdata() == CORTEX_CLASS, segmentation, mask)
+    return mask
+
+
+def propagate(output_dir, prefix, label_sets, search_dirs=(), label_cache=None, threads=None):
+    """Warp (path, cortical) label sets to subject space; return the written images."""
+    import numpy as np
+    import nibabel as nb
+    output_dir = PosixPath(output_dir)
+    if not label_sets:
+        return []
+    threads = threads or cpu_budget()
+    reference = output_dir / (prefix + REFERENCE)
+    transforms = [output_dir / (prefix + name) for name in TRANSFORMS]
+    missing = [str(p) for p in [reference] + transforms if not p.exists()]
+    if missing:
+        raise IOError('Missing ANTs-CT outputs: {}'.format(', '.join(missing)))
+
+    taken = set()
+    groups = {}
+    for path, cortical in label_sets:
+        img = nb.load(str(path))
+        dest = output_dir / output_name(path, prefix, taken)
+        groups.setdefault(grid_key(img), []).append((img, path, cortical, dest))
+    groups = list(groups.values())
+    reference_img = nb.load(str(reference))
+    registry = LabelRegistry.load(list(search_dirs), label_cache)
+
+    with tempfile.TemporaryDirectory(dir=str(output_dir), prefix='.labels_') as tmp_dir:
+        field = compose(transforms, reference, PosixPath(tmp_dir) / 'TemplateToSubject.nii.gz', threads)
+        logger.info("Warping %d label images in %d batches", len(label_sets), len(groups))
+        # the cores are shared between the batches warped at the same time
+        per_call = max(1, threads // len(groups))
+
+        def warp(index):
+            return warp_stack([img for img, _, _, _ in groups[index]], reference, field, tmp_dir, index, per_call)
+
+        with ThreadPoolExecutor(max_workers=min(len(groups), threads)) as pool:
+            stacks = list(pool.map(warp, range(len(groups))))
+
+        mask = cortical_mask(output_dir, prefix, tmp_dir) if any(c for _, c in label_sets) else None
+        jobs = []
+        for group, stack in zip(groups, stacks):
+            data = np.asanyarray(stack.dataobj).reshape(stack.shape[:3] + (-1,))
+            for volume, (_, path, cortical, dest) in enumerate(group):
+                jobs.append((data[..., volume], path, cortical, dest))
+
+        def finish(job):
+            data, path, cortical, dest = job
+            write_labels(data, reference_img, dest)
+            if cortical:
+                run_ants(['ImageMath', '3', str(dest), 'PropagateLabelsThroughMask', str(mask), str(dest)], 1)
+            table = registry.for_image(path)
+            if table is not None:
+                dest.with_name(dest.name.split('.')[0] + '.tsv').write_text(table.tsv())
+            logger.info("Wrote %s", dest)
+            return dest
+
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            return list(pool.map(finish, jobs))
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Warp MNI label images to subject space.')
+    parser.add_argument('input_dir', help='Folder with the ANTs-CT outputs; the label images are written here.')
+    parser.add_argument('prefix', help='Output file root, e.g. sub-01_ses-01_')
+    parser.add_argument('--labels', nargs='+', default=[], help='Label images to warp.')
+    parser.add_argument('--cortical-labels', nargs='+', default=[],
+                        help='Cortical label images, propagated through the cortical mask after warping.')
+    parser.add_argument('--list', help='Label list written by prepare_run.py.')
+    parser.add_argument('--dseg-dir', action='append', default=[],
+                        help='Folder searched for dseg.tsv tables (default: TEMPLATEFLOW_HOME).')
+    parser.add_argument('--threads', type=int, help='Threads (default: the CPU quota).')
+    args = parser.parse_args(argv)
+
+    label_sets = [(p, False) for p in args.labels] + [(p, True) for p in args.cortical_labels]
+    if args.list:
+        label_sets.extend(read_label_list(args.list))
+    templateflow_home = os.environ.get('TEMPLATEFLOW_HOME')
+    search_dirs = args.dseg_dir or [d for d in [templateflow_home] if d]
+    label_cache = os.path.join(templateflow_home, LABELS_CACHE) if templateflow_home else None
+    propagate(args.input_dir, args.prefix, label_sets, search_dirs, label_cache, args.threads)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Label tables of the tissue classes and the template dseg.tsv files.
+
+Every dseg.tsv under the search folders (the bundled templates, the gear
+inputs) is parsed once into a LabelTable. A table holds lists indexed by
+label id, so mapping a label to its name, abbreviation, color or hemisphere
+is a single lookup, or one numpy take for a whole image. The parsed tables
+are cached as JSON next to the templates, keyed by each file's size and
+mtime, so later runs skip the parsing.
+
+    python label_registry.py --search-dir .templateflow --cache .templateflow/antsct_labels.json
+"""
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+from pathlib import PosixPath
+
+logger = logging.getLogger('antsct-gear')
+
+LABELS_CACHE = 'antsct_labels.json'
+ENTITY_RE = re.compile(r'(?:^|_)([a-zA-Z]+)-([a-zA-Z0-9+]+)')
+FIELDS = ['name', 'abbr', 'color', 'hemi']
+# part of each cached table's signature; bump when from_tsv parses differently
+TABLE_VERSION = 2
+
+# ANTs tissue class number -> (BIDS label, name), in the order antsCorticalThickness.sh numbers the priors
+TISSUE_LABELS = {
+    1: ('CSF', 'Cerebrospinal Fluid'),
+    2: ('CGM', 'Cortical Gray Matter'),
+    3: ('WM', 'White Matter'),
+    4: ('SGM', 'Subcortical Gray Matter'),
+    5: ('BS', 'Brain Stem'),
+    6: ('CBM', 'Cerebellum'),
+}
+TISSUE_COLORS = {'CSF': '#4682e6', 'CGM': '#e63c32', 'WM': '#f5f5f5', 'SGM': '#f0c828', 'BS': '#965ac8',
+                 'CBM': '#3cbe5a'}
+# prior labels some templates use for a tissue class
+TISSUE_ALIASES = {'SCGM': 'SGM'}
+
+
+def parse_color(value):
+    """Return an (r, g, b) tuple from '#rrggbb', or None."""
+    value = (value or '').strip()
+    if re.match(r'^#[0-9a-fA-F]{6}$', value):
+        return tuple(int(value[i:i + 2], 16) for i in (1, 3, 5))
+    return None
+
+
+def infer_hemi(name):
+    """Hemisphere from label names such as 17Networks_LH_... or Left-Hippocampus."""
+    tokens = set(re.split(r'[_\-\s]', name or ''))
+    if tokens & {'LH', 'L', 'Left', 'lh'}:
+        return 'L'
+    if tokens & {'RH', 'R', 'Right', 'rh'}:
+        return 'R'
+    return None
+
+
+class LabelTable(object):
+    """Label id -> name, abbreviation, color and hemisphere, stored in lists indexed by label id."""
+
+    def __init__(self, rows):
+        """rows are dicts with 'index' and any of 'name', 'abbr', 'color' (an RGB tuple) and 'hemi'."""
+        size = max([row['index'] for row in rows] + [0]) + 1
+        self.present = [False] * size
+        self.columns = dict((field, [None] * size) for field in FIELDS)
+        for row in rows:
+            self.present[row['index']] = True
+            for field in FIELDS:
+                if row.get(field) is not None:
+                    self.columns[field][row['index']] = tuple(row[field]) if field == 'color' else row[field]
+
+    @classmethod
+    def from_tsv(cls, path):
+        """Parse a dseg.tsv; the label id is in the index column, or in the label column when there is none."""
+        rows = []
+        with open(str(path)) as f:
+            header = [h.strip() for h in f.readline().rstrip('\n').split('\t')]
+            id_column = 'index' if 'index' in header else 'label'
+            for line in f:
+                values = dict(zip(header, [v.strip().strip('"') for v in line.rstrip('\n').split('\t')]))
+                values = dict((k, v) for k, v in values.items() if v and v != 'n/a')
+                if id_column not in values:
+                    continue
+                name = values.get('name') or (values.get('label') if id_column == 'index' else None)
+                rows.append({'index': int(float(values[id_column])), 'name': name, 'abbr': values.get('abbr'),
+                             'color': parse_color(values.get('color')),
+                             'hemi': values.get('hemi') or values.get('hemisphere') or infer_hemi(name)})
+        if not rows:
+            logger.warning("No labels found in %s", path)
+        return cls(rows)
+
+    def to_dict(self):
+        return {'rows': [dict([('index', i)] + [(f, self.columns[f][i]) for f in FIELDS])
+                         for i in self.indices()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['rows'])
+
+    def __len__(self):
+        return len(self.present)
+
+    def indices(self):
+        return [i for i, present in enumerate(self.present) if present]
+
+    def get(self, index, field='name', default=None):
+        if 0 <= index < len(self.present) and self.columns[field][index] is not None:
+            return self.columns[field][index]
+        return default
+
+    def mapping(self, field='name'):
+        """{label id: value} for the labels that have the field."""
+        return dict((i, self.columns[field][i]) for i in self.indices() if self.columns[field][i] is not None)
+
+    def lookup(self, labels, field='name'):
+        """Map an array of label ids to the field's values in one take; unknown labels give None."""
+        import numpy as np
+        values = np.array(self.columns[field] + [None], dtype=object)
+        labels = np.asarray(labels)
+        inside = (labels >= 0) & (labels < len(self.present))
+        return values[np.where(inside, labels, len(self.present))]
+
+    def color_lut(self, size=None):
+        """uint8 RGB per label id; labels without a color get reproducible distinct ones, 0 is black."""
+        import numpy as np
+        size = max(size or 0, len(self.present))
+        index = np.arange(size, dtype=np.uint32)
+        lut = np.stack([(index * 97) % 200 + 55, (index * 57) % 200 + 55, (index * 31) % 200 + 55], axis=1)
+        for i, color in enumerate(self.columns['color']):
+            if color is not None:
+                lut[i] = color
+        lut[0] = 0
+        return lut.astype(np.uint8)
+
+    def tsv(self, fields=('name',)):
+        """The table as dseg.tsv text."""
+        lines = ['\t'.join(('index',) + tuple(fields))]
+        for i in self.indices():
+            lines.append('\t'.join([str(i)] + ['' if self.columns[f][i] is None else str(self.columns[f][i])
+                                               for f in fields]))
+        return '\n'.join(lines) + '\n'
+
+
+def tissue_table(classes=None):
+    """The tissue classes of a segmentation.
+
+    classes is either the number of tissue priors (the first of the standard
+    classes), or the prior labels of a template; the classes are then numbered
+    in the standard order, so a template without a CSF prior has CGM as class 1.
+    Without classes, all six standard classes are returned.
+    """
+    standard = [label for _, (label, _) in sorted(TISSUE_LABELS.items())]
+    names = dict(TISSUE_LABELS.values())
+    if classes is None:
+        labels = standard
+    elif isinstance(classes, int):
+        labels = standard[:classes] + ['class{}'.format(i) for i in range(len(standard) + 1, classes + 1)]
+    else:
+        present = set(TISSUE_ALIASES.get(c, c) for c in classes if c != 'brain')
+        labels = [label for label in standard if label in present] + sorted(present - set(standard))
+    return LabelTable([{'index': i, 'abbr': label, 'name': names.get(label, label),
+                        'color': parse_color(TISSUE_COLORS.get(label))} for i, label in enumerate(labels, 1)])
+
+
+def label_entities(path):
+    return dict(ENTITY_RE.findall(os.path.basename(str(path)).split('.')[0]))
+
+
+def signature(path):
+    stat = os.stat(str(path))
+    return [stat.st_size, stat.st_mtime_ns, TABLE_VERSION]
+
+
+class LabelRegistry(object):
+    """All dseg.tsv tables under some folders, parsed once."""
+
+    def __init__(self, tables=None):
+        # path -> (entities, LabelTable)
+        self.tables = tables or {}
+
+    @classmethod
+    def load(cls, search_dirs, cache=None):
+        """Parse the dseg.tsv files under search_dirs, reusing the tables of a cache file that are unchanged."""
+        cached = {}
+        if cache and os.path.exists(str(cache)):
+            try:
+                with open(str(cache)) as f:
+                    cached = json.load(f)
+            except ValueError:
+                logger.warning("Ignoring unreadable label cache %s", cache)
+        # paths under the cache's folder are stored relative to it, so the cache can be moved with the templates
+        base = os.path.dirname(os.path.abspath(str(cache))) if cache else None
+        tables = {}
+        entries = {}
+        changed = False
+        for directory in search_dirs:
+            if not directory or not os.path.isdir(str(directory)):
+                continue
+            for path in sorted(PosixPath(directory).rglob('*_dseg.tsv')):
+                key = os.path.abspath(str(path))
+                if base and key.startswith(base + os.sep):
+                    key = os.path.relpath(key, base)
+                entry = cached.get(key)
+                if entry is None or entry['signature'] != signature(path):
+                    entry = {'signature': signature(path), 'table': LabelTable.from_tsv(path).to_dict()}
+                    changed = True
+                entries[key] = entry
+                tables[key] = (label_entities(path), LabelTable.from_dict(entry['table']))
+        if cache and (changed or set(entries) != set(cached)):
+            try:
+                tmp = str(cache) + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(entries, f)
+                os.replace(tmp, str(cache))
+            except OSError as e:
+                logger.info("Label cache %s not written: %s", cache, e)
+        return cls(tables)
+
+    def find(self, **entities):
+        """Return the first table whose file has all the given entities (None values must be absent)."""
+        for path in sorted(self.tables):
+            have, table = self.tables[path]
+            if all(have.get(k) == v for k, v in entities.items()):
+                return table
+        return None
+
+    def for_image(self, image):
+        """The table naming a label image: its sibling dseg.tsv, or the one with the same atlas and desc."""
+        image = PosixPath(image)
+        sibling = image.with_name(image.name.split('.')[0] + '.tsv')
+        if sibling.exists():
+            return LabelTable.from_tsv(sibling)
+        wanted = label_entities(image)
+        if 'atlas' not in wanted:
+            return None
+        return self.find(atlas=wanted['atlas'], desc=wanted.get('desc'))
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Parse dseg.tsv label tables into a cache.')
+    parser.add_argument('--search-dir', action='append',
+                        default=[], help='Folder searched for dseg.tsv files (default: TEMPLATEFLOW_HOME).')
+    parser.add_argument('--cache', help='Cache file (default: antsct_labels.json in the first search folder).')
+    args = parser.parse_args(argv)
+
+    search_dirs = args.search_dir or [os.environ.get('TEMPLATEFLOW_HOME', '.templateflow')]
+    registry = LabelRegistry.load(search_dirs, args.cache or os.path.join(search_dirs[0], LABELS_CACHE))
+    logger.info("Parsed %d label tables", len(registry.tables))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
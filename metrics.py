@@ -0,0 +1,187 @@
+#!/usr/local/miniconda/bin/python
+"""Resource metrics for the phases of a gear run.
+
+Each phase of the run script (setup, the ANTs-CT run, export, packaging) is
+run through this module. It samples the process tree from /proc for CPU time
+and peak resident memory and appends the phase to a JSON report in the
+output folder. For the ANTs-CT run, per-stage wall times are inferred from
+when each stage's outputs appeared in the work directory.
+
+    metrics.py run --name antsct --report antsct_metrics.json [--work-dir DIR] -- bash antsct_run.sh
+
+prepare_run.py adds the timings of its own phases (Flywheel lookups,
+downloads, indexing, the template index) to the same report.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import subprocess
+from pathlib import PosixPath
+from checkpoint import STAGES, PLAN
+
+logger = logging.getLogger('antsct-gear')
+
+REPORT = 'antsct_metrics.json'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def _proc_stat(pid):
+    """Return (parent pid, cpu seconds including reaped children, rss bytes) of a process, or None."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return None
+    # the command name may contain spaces, the fields after it don't
+    fields = stat[stat.rindex(')') + 2:].split()
+    cpu = sum(int(v) for v in fields[11:15]) / CLOCK_TICKS
+    return int(fields[1]), cpu, int(fields[21]) * PAGE_SIZE
+
+
+def process_tree(pid):
+    """Return {pid: (cpu seconds, rss bytes)} for pid and all its descendants."""
+    stats = {}
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            stat = _proc_stat(entry)
+            if stat is not None:
+                stats[int(entry)] = stat
+                children.setdefault(stat[0], []).append(int(entry))
+    tree = {}
+    wanted = [pid]
+    while wanted:
+        current = wanted.pop()
+        if current in stats and current not in tree:
+            tree[current] = stats[current][1:]
+            wanted.extend(children.get(current, []))
+    return tree
+
+
+class ResourceSampler(object):
+    """Samples CPU time and total resident memory of a process tree in a background thread."""
+
+    def __init__(self, pid, interval=1.0):
+        self.pid = pid
+        self.interval = interval
+        self.cpu_seconds = 0.0
+        self.peak_rss = 0
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        tree = process_tree(self.pid)
+        if tree:
+            # reaped children are counted in their parent's totals, so the sum only grows
+            self.cpu_seconds = max(self.cpu_seconds, sum(cpu for cpu, _ in tree.values()))
+            self.peak_rss = max(self.peak_rss, sum(rss for _, rss in tree.values()))
+
+    def _run(self):
+        while True:
+            self.sample()
+            if self.stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+
+
+def stage_times(work_dir, start):
+    """Infer per-stage wall times from the modification times of the stage outputs.
+
+    A stage ends when its last output was written and starts when the last of
+    its dependencies ended (or when the run started).
+    """
+    work_dir = PosixPath(work_dir)
+    if not (work_dir / PLAN).exists():
+        return []
+    with (work_dir / PLAN).open() as f:
+        prefix = json.load(f)['prefix']
+    ends = {}
+    stages = []
+    for name, depends, _, patterns in STAGES:
+        files = [p for pattern in patterns for p in work_dir.glob(prefix + pattern)]
+        if not files:
+            continue
+        end = max(p.stat().st_mtime for p in files)
+        begin = max([ends[d] for d in depends if d in ends] + [start])
+        ends[name] = end
+        # outputs restored from a checkpoint predate this run
+        stages.append({'name': name, 'seconds': max(0.0, end - begin), 'reused': end < start})
+    return stages
+
+
+def update_report(path, phase=None, **sections):
+    """Append a phase, or set other sections, in the JSON report at path."""
+    path = PosixPath(path)
+    report = {'phases': []}
+    if path.exists():
+        with path.open() as f:
+            report = json.load(f)
+    if phase is not None:
+        report['phases'].append(phase)
+    report.update(sections)
+    report['total_seconds'] = sum(p.get('seconds', 0) for p in report['phases'])
+    tmp = path.with_name(path.name + '.tmp')
+    with tmp.open('w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(str(tmp), str(path))
+    return report
+
+
+def run_phase(name, command, report=None, work_dir=None, interval=1.0):
+    """Run command as a named phase, record its metrics and return its exit code."""
+    start = time.time()
+    process = subprocess.Popen(command)
+    with ResourceSampler(process.pid, interval) as sampler:
+        # wait4 also returns the exact totals of the command and its reaped children
+        _, status, usage = os.wait4(process.pid, 0)
+    # a command killed by a signal exits with 128 + the signal number, as in the shell
+    returncode = 128 + os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    process.returncode = returncode
+    phase = {'name': name, 'seconds': time.time() - start,
+             'cpu_seconds': max(sampler.cpu_seconds, usage.ru_utime + usage.ru_stime),
+             'peak_rss_bytes': max(sampler.peak_rss, usage.ru_maxrss * 1024), 'exit_code': returncode}
+    if work_dir:
+        phase['stages'] = stage_times(work_dir, start)
+    logger.info("Metrics: %s took %.1f s, %.1f s cpu, peak rss %.1f MB", name, phase['seconds'],
+                phase['cpu_seconds'], phase['peak_rss_bytes'] / 1e6)
+    for stage in phase.get('stages', []):
+        logger.info("Metrics:   %-20s %8.1f s%s", stage['name'], stage['seconds'],
+                    ' (reused)' if stage['reused'] else '')
+    if report:
+        update_report(report, phase)
+    return returncode
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Record the metrics of a phase of the gear run.')
+    parser.add_argument('action', choices=['run'])
+    parser.add_argument('--name', required=True, help='Phase name in the report.')
+    parser.add_argument('--report', help='JSON report to append the phase to.')
+    parser.add_argument('--work-dir', help='ANTs-CT work directory, for per-stage times.')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between samples.')
+    argv = sys.argv[1:] if argv is None else argv
+    if '--' not in argv:
+        parser.error('give the command to run after --')
+    split = argv.index('--')
+    args = parser.parse_args(argv[:split])
+    command = argv[split + 1:]
+    if not command:
+        parser.error('no command given')
+    return run_phase(args.name, command, args.report, args.work_dir, args.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+#!/usr/local/miniconda/bin/python
+"""Offline stand-in for the Flywheel SDK client.
+
+MockClient serves project, subject, session, acquisition and analysis
+containers built from a local BIDS directory, with an optional per-request
+latency. It implements the subset of flywheel.Client used by this gear and by
+fw-heudiconv's gather_bids(), and keeps call statistics so the concurrency of
+lookups and downloads can be checked without network access.
+"""
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+from pathlib import PosixPath
+from shutil import copyfile
+
+logger = logging.getLogger('antsct-gear')
+
+
+class Container(dict):
+    """Dictionary with attribute access, like the SDK's container models."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __hash__(self):
+        return hash(self['id'])
+
+    def download_file(self, name, dest):
+        self['_client'].download(self, name, dest)
+
+
+class _Finder(object):
+    def __init__(self, containers):
+        self.containers = containers
+
+    def find_first(self, query):
+        key, _, value = query.partition('=')
+        value = value.strip('"')
+        for container in self.containers():
+            if str(container.get(key)) == value:
+                return container
+        return None
+
+
+class MockClient(object):
+    """In-memory Flywheel client backed by files on local disk."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.containers = {}
+        self.paths = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.projects = _Finder(lambda: self._of_type('project'))
+
+    def _request(self):
+        """Simulate one API round trip."""
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _of_type(self, container_type):
+        return [c for c in self.containers.values() if c['container_type'] == container_type]
+
+    def add(self, container_type, label, parents=None, **fields):
+        """Create a container and return it."""
+        container_id = hashlib.sha1('{}/{}/{}'.format(container_type, label, sorted((parents or {}).items()))
+                                    .encode()).hexdigest()[:24]
+        container = Container(id=container_id, _id=container_id, label=label, container_type=container_type,
+                              parents=dict(parents or {}), files=[], info={}, _client=self, **fields)
+        self.containers[container_id] = container
+        return container
+
+    def add_file(self, container, path, info=None):
+        """Attach a local file to a container."""
+        path = PosixPath(path)
+        with path.open('rb') as f:
+            file_hash = hashlib.sha256(f.read()).hexdigest()
+        file_id = hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:24]
+        entry = Container(name=path.name, file_id=file_id, hash=file_hash, type='nifti', size=path.stat().st_size,
+                          info=info or {}, parent=container)
+        container['files'].append(entry)
+        self.paths[file_id] = path
+        return entry
+
+    def add_analysis(self, session):
+        """Create an analysis attached to a session, as the gear's destination."""
+        parents = dict(session['parents'], session=session['id'])
+        return self.add('analysis', 'antsct {}'.format(session['label']), parents,
+                        parent={'type': 'session', 'id': session['id']})
+
+    @classmethod
+    def from_bids(cls, bids_root, project_label='mock', latency=0.0):
+        """Build a client whose single project mirrors the anat data of a BIDS tree."""
+        client = cls(latency)
+        bids_root = PosixPath(bids_root)
+        project = client.add('project', project_label, {'group': 'mock'})
+        description = bids_root / 'dataset_description.json'
+        if description.exists():
+            with description.open() as f:
+                project['info']['BIDS'] = json.load(f)
+        else:
+            project['info']['BIDS'] = {'Name': project_label, 'BIDSVersion': '1.4.0'}
+
+        for sub_dir in sorted(bids_root.glob('sub-*')):
+            subject = client.add('subject', sub_dir.name[4:], {'group': 'mock', 'project': project['id']})
+            ses_dirs = sorted(sub_dir.glob('ses-*')) or [sub_dir]
+            for ses_dir in ses_dirs:
+                session_label = ses_dir.name[4:] if ses_dir != sub_dir else subject['label']
+                session = client.add('session', session_label, dict(subject['parents'], subject=subject['id']),
+                                     subject=subject)
+                for image in sorted((ses_dir / 'anat').glob('*.nii*')):
+                    acq = client.add('acquisition', image.name.split('.')[0],
+                                     dict(session['parents'], session=session['id']))
+                    sidecar = image.with_name(image.name.split('.')[0] + '.json')
+                    info = {}
+                    if sidecar.exists():
+                        with sidecar.open() as f:
+                            info = json.load(f)
+                    info['BIDS'] = {'Path': str(ses_dir.relative_to(bids_root) / 'anat'), 'Folder': 'anat',
+                                    'Filename': image.name}
+                    client.add_file(acq, image, info)
+        return client
+
+    # flywheel.Client API
+    def get(self, container_id):
+        self._request()
+        return self.containers[container_id]
+
+    def get_acquisition(self, acquisition_id):
+        return self.get(acquisition_id)
+
+    def get_project_sessions(self, project_id):
+        self._request()
+        return [c for c in self._of_type('session') if c['parents'].get('project') == project_id]
+
+    def get_session_acquisitions(self, session_id):
+        self._request()
+        return [c for c in self._of_type('acquisition') if c['parents'].get('session') == session_id]
+
+    def download(self, container, name, dest):
+        self._request()
+        for f in container['files']:
+            if f['name'] == name:
+                copyfile(str(self.paths[f['file_id']]), str(dest))
+                return
+        raise KeyError(name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time gather/download against a mock Flywheel client.')
+    parser.add_argument('bids_dir', help='Local BIDS dataset to serve.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds per simulated request.')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent downloads.')
+    args = parser.parse_args(argv)
+
+    from fw_heudiconv.cli import export
+    from bids_cache import download_anat
+
+    for workers in (1, args.workers):
+        client = MockClient.from_bids(args.bids_dir, latency=args.latency)
+        start = time.time()
+        downloads = export.gather_bids(client, 'mock')
+        with tempfile.TemporaryDirectory() as tmp:
+            download_anat(client, downloads, tmp, workers=workers)
+        print('workers={:<3d} requests={:<5d} max_in_flight={:<3d} seconds={:.3f}'.format(
+            workers, client.calls, client.max_in_flight, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+#!/usr/local/miniconda/bin/python
+"""Screen anatomical inputs before the ANTs-CT command is written.
+
+Only the NIfTI header, the gzip trailer and a strided subsample of the
+(memory-mapped, for .nii) voxel data are read, so a candidate is checked in
+milliseconds instead of failing hours into runAntsCT_nonBIDS.pl. The checks:
+
+- corruption: the header loads, the file is at least as long as the header
+  says (for .nii.gz, the uncompressed size in the gzip trailer matches, or
+  else the last slice can be read), and the subsample can be read;
+- dimensions: one 3D volume with enough voxels along each axis;
+- voxel size: finite, positive, not too coarse or anisotropic (localizers);
+- orientation: a finite, invertible affine, with a known sform or qform;
+- intensity: finite values, not constant, with enough distinct levels;
+- the path has no spaces.
+
+Errors reject a candidate and warnings are only logged. The candidates that
+pass are ranked by the SNR estimate of anat_qc.py, taken from the same
+subsample.
+
+    preflight.py sub-01_ses-01_run-1_T1w.nii.gz [sub-01_ses-01_run-2_T1w.nii.gz ...]
+"""
+import os
+import sys
+import struct
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from antsct_utils import cpu_budget
+from anat_qc import sample_snr, rank_anat, STEP
+
+logger = logging.getLogger('antsct-gear')
+
+MIN_SHAPE = 64
+MAX_VOXEL_MM = 3.0
+MIN_VOXEL_MM = 0.1
+MAX_ANISOTROPY = 4.0
+MIN_LEVELS = 16
+MAX_ZERO_FRACTION = 0.95
+
+
+class Report(object):
+    """Errors, warnings and SNR estimate of one candidate."""
+
+    def __init__(self, path):
+        self.path = path
+        self.errors = []
+        self.warnings = []
+        self.score = 0.0
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def log(self):
+        for error in self.errors:
+            logger.warning("Preflight: %s: %s", self.path, error)
+        for warning in self.warnings:
+            logger.info("Preflight: %s: %s", self.path, warning)
+        if self.ok:
+            logger.info("Preflight: %s passed (SNR estimate %.2f)", self.path, self.score)
+
+
+def expected_bytes(img):
+    """Length of the uncompressed file: the header, its extensions and the voxel data."""
+    import numpy as np
+    header = img.header
+    return int(img.dataobj.offset) + int(np.prod(header.get_data_shape())) * header.get_data_dtype().itemsize
+
+
+def gzip_size(path):
+    """Uncompressed size modulo 2**32 recorded in the gzip trailer."""
+    with open(str(path), 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def check_length(path, img, report):
+    """Reject a file shorter than its header says; trailing bytes are allowed.
+
+    The last four bytes of a .nii.gz are only the uncompressed size when the
+    stream is complete, and then only of the last gzip member modulo 2**32.
+    Unless they match the expected size exactly, the last slice is read, which
+    decompresses the stream up to the end of the voxel data.
+    """
+    expected = expected_bytes(img)
+    if str(path).endswith('.gz'):
+        if gzip_size(path) == expected % 2 ** 32:
+            return
+        try:
+            img.dataobj[(slice(None), slice(None), -1) + (0,) * (len(img.shape) - 3)]
+        except Exception as e:
+            report.errors.append('the gzip stream is truncated or does not match the header: {}'.format(e))
+    elif os.path.getsize(str(path)) < expected:
+        report.errors.append('the file is shorter than its header says ({} < {} bytes)'.format(
+            os.path.getsize(str(path)), expected))
+
+
+def check_geometry(img, report):
+    import numpy as np
+    shape = img.shape
+    if len(shape) > 3 and int(np.prod(shape[3:])) > 1:
+        report.errors.append('{}D image with {} volumes, one 3D volume is needed'.format(
+            len(shape), int(np.prod(shape[3:]))))
+    if len(shape) < 3 or min(shape[:3]) < MIN_SHAPE:
+        report.errors.append('too few voxels {}, at least {} along each axis'.format(shape[:3], MIN_SHAPE))
+
+    zooms = np.array(img.header.get_zooms()[:3], dtype=float)
+    if not np.all(np.isfinite(zooms)) or np.any(zooms <= 0):
+        report.errors.append('invalid voxel size {}'.format(zooms.tolist()))
+    else:
+        size = 'x'.join('{:.3g}'.format(z) for z in zooms)
+        if zooms.max() > MAX_VOXEL_MM or zooms.min() < MIN_VOXEL_MM:
+            report.errors.append('voxel size {} mm outside {}-{} mm'.format(size, MIN_VOXEL_MM, MAX_VOXEL_MM))
+        if zooms.max() / zooms.min() > MAX_ANISOTROPY:
+            report.errors.append('voxels too anisotropic ({} mm)'.format(size))
+
+    affine = img.affine
+    if not np.all(np.isfinite(affine)) or abs(np.linalg.det(affine[:3, :3])) < 1e-6:
+        report.errors.append('the affine is not invertible')
+    sform_code, qform_code = int(img.header['sform_code']), int(img.header['qform_code'])
+    if sform_code == 0 and qform_code == 0:
+        report.warnings.append('no sform or qform, the orientation is unknown')
+    elif sform_code and qform_code and not np.allclose(img.header.get_sform(), img.header.get_qform(), atol=1e-2):
+        report.warnings.append('sform and qform disagree, the sform is used')
+
+
+def check_intensity(sample, report):
+    import numpy as np
+    if not np.all(np.isfinite(sample)):
+        report.errors.append('NaN or infinite intensities')
+        sample = sample[np.isfinite(sample)]
+    if not sample.size or sample.min() == sample.max():
+        report.errors.append('constant intensity')
+        return
+    if np.count_nonzero(sample == 0) > MAX_ZERO_FRACTION * sample.size:
+        report.errors.append('more than {:.0%} of the voxels are zero'.format(MAX_ZERO_FRACTION))
+    if len(np.unique(sample)) < MIN_LEVELS:
+        report.errors.append('fewer than {} intensity levels'.format(MIN_LEVELS))
+    if sample.min() < 0:
+        report.warnings.append('negative intensities (minimum {:.4g})'.format(float(sample.min())))
+
+
+def screen(path, step=STEP):
+    """Check one candidate; returns its Report."""
+    import numpy as np
+    import nibabel as nb
+    report = Report(path)
+    if ' ' in str(path):
+        report.errors.append('the path contains spaces')
+    try:
+        img = nb.load(str(path), mmap='r', keep_file_open=True)
+    except Exception as e:
+        report.errors.append('unreadable header: {}'.format(e))
+        return report
+    try:
+        check_length(path, img, report)
+    except (OSError, struct.error) as e:
+        report.errors.append('unreadable file: {}'.format(e))
+    check_geometry(img, report)
+    if report.errors:
+        return report
+
+    try:
+        index = tuple([slice(None, None, step)] * 3 + [0] * (len(img.shape) - 3))
+        sample = np.asarray(img.dataobj[index], dtype=np.float32)
+    except Exception as e:
+        report.errors.append('unreadable voxel data: {}'.format(e))
+        return report
+    check_intensity(sample, report)
+    if report.ok:
+        report.score = sample_snr(sample)
+    return report
+
+
+def preflight(paths, step=STEP):
+    """Screen the candidates in parallel; returns (passed reports best first, rejected reports)."""
+    paths = list(paths)
+    if not paths:
+        return [], []
+    with ThreadPoolExecutor(max_workers=min(len(paths), cpu_budget())) as pool:
+        reports = list(pool.map(lambda p: screen(p, step), paths))
+    for report in reports:
+        report.log()
+    passed = sorted([r for r in reports if r.ok], key=lambda r: -r.score)
+    return passed, [r for r in reports if not r.ok]
+
+
+def choose_anat(paths, multiple_t1w='best', checks=True, step=STEP):
+    """Return the images to process: the one with the best SNR estimate, or all of them sorted.
+
+    With checks, images failing the preflight checks are left out, and [] is
+    returned when none passes. Without, a single image is returned unscored.
+    """
+    paths = list(paths)
+    if checks:
+        passed, _ = preflight(paths, step)
+        if not passed:
+            logger.warning("No anatomical image passed the preflight checks.")
+            return []
+        ranked = [(report.score, report.path) for report in passed]
+    elif len(paths) < 2:
+        return paths
+    else:
+        ranked = rank_anat(paths, step)
+    if len(ranked) == 1:
+        return [ranked[0][1]]
+    if multiple_t1w == 'all':
+        logger.info("Processing all %d anatomical images", len(ranked))
+        return sorted(path for _, path in ranked)
+    score, best = ranked[0]
+    logger.info("%d anatomical images found, using the one with the best SNR estimate (%.2f)", len(ranked), score)
+    return [best]
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Screen anatomical images before running ANTs-CT.')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--step', type=int, default=STEP, help='Voxel stride of the intensity subsample.')
+    args = parser.parse_args(argv)
+
+    passed, rejected = preflight(args.images, args.step)
+    for report in passed:
+        print('{:.3f}\t{}'.format(report.score, report.path))
+    return 1 if rejected else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
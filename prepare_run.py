@@ -1,279 +1,341 @@
 #!/usr/local/miniconda/bin/python
 import sys
 import logging
-from zipfile import ZipFile
 from pathlib import PosixPath
-from templateflow import api as tflow
-from shutil import copy2
-from fw_heudiconv.cli import export
-from bids import BIDSLayout
-import flywheel
+from concurrent.futures import ThreadPoolExecutor
 import os
+from antsct_utils import bids_filters, find_anat, bids_prefix, manual_prefix, build_command, \
+    cached_property, PhaseTimer, thread_count, thread_environment, cgroup_memory_limit, plan_resources, \
+    MEMORY_PER_JOB
+from preflight import choose_anat
+from bids_cache import DownloadCache, download_anat
+from bids_index import load_anat_index
+from checkpoint import work_dir, stage_keys, resume
+from result_store import ResultStore, result_key
+from metrics import update_report, REPORT
+from template_cache import checksum
+from template_index import load_index
+from label_propagation import write_label_list, extract_labels_zip, LABEL_LIST
 
 # logging stuff
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('antsct-gear')
-logger.info("=======: ANTs Cortical Thickness :=======")
-
-# Gather variables that will be shared across functions
-with flywheel.GearContext() as context:
-    # Setup basic logging
-    context.init_logging()
-    # Log the configuration for this job
-    # context.log_config()
-    config = context.config
-    analysis_id = context.destination['id']
-    gear_output_dir = PosixPath(context.output_dir)
-    antsct_script = gear_output_dir / "antsct_run.sh"
-    output_root = gear_output_dir / analysis_id
-    working_dir = PosixPath(str(output_root.resolve()) + "_work")
-    bids_dir = output_root
-    bids_root = output_root / 'bids_dataset'
-
-    # Get relevant container objects
-    fw = flywheel.Client(context.get_input('api_key')['key'])
-    analysis_container = fw.get(analysis_id)
-    project_container = fw.get(analysis_container.parents['project'])
-    session_container = fw.get(analysis_container.parent['id'])
-    subject_container = fw.get(session_container.parents['subject'])
-
-    project_label = project_container.label
-
-    # get T1 input if it exists
-    manual_t1 = context.get_input('t1_anatomy')
-    manual_t1_path_config = None if manual_t1 is None else \
-        PosixPath(context.get_input_path('t1_anatomy'))
-
-    # replace any spaces in the string
-    if ' ' in str(manual_t1_path_config):
+
+# Phase timings for the startup report
+timer = PhaseTimer()
+
+
+def input_path(context, name):
+    """Return the path of an optional gear input, or None if it was not provided."""
+    if context.get_input(name) is None:
+        return None
+    return PosixPath(context.get_input_path(name))
+
+
+class GearRun(object):
+    """Configuration, inputs and Flywheel containers of a gear run.
+
+    Everything that needs the Flywheel API is resolved on first use, so code
+    paths that don't need a container never pay for the lookup.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.config = context.config
+        self.analysis_id = context.destination['id']
+        self.gear_output_dir = PosixPath(context.output_dir)
+        self.antsct_script = self.gear_output_dir / "antsct_run.sh"
+        self.output_root = self.gear_output_dir / self.analysis_id
+        # runAntsCT_nonBIDS.pl writes here, so a retry can resume from the completed stages
+        self.working_dir = work_dir(str(self.output_root.resolve()) + "_work")
+        self.bids_dir = self.output_root
+        self.bids_root = self.output_root / 'bids_dataset'
+
+        # get T1 input if it exists
+        self.manual_t1 = context.get_input('t1_anatomy')
+
+        self.mni_cort_labels_path_list = [str(input_path(context, 'mni-cortical-labels-{}'.format(i)))
+                                          for i in range(1, 4)
+                                          if context.get_input('mni-cortical-labels-{}'.format(i))]
+        self.mni_labels_path_list = [str(input_path(context, 'mni-labels-{}'.format(i)))
+                                     for i in range(1, 4)
+                                     if context.get_input('mni-labels-{}'.format(i))]
+        # any number of label images, warped after the run by label_propagation.py
+        self.mni_labels_zip_path = input_path(context, 'mni-labels-zip')
+        self.label_list = self.output_root / LABEL_LIST
+
+        # Get template zip
+        self.template_zip_path = input_path(context, 'template-zip')
+
+        # configs, use int() to translate the booleans to 0 or 1
+        self.denoise = int(self.config.get('denoise'))
+        self.num_threads = self.config.get('num-threads')
+        self.run_quick = int(self.config.get('run-quick'))
+        self.trim_neck = int(self.config.get('trim-neck'))
+        self.bids_acq = self.config.get('BIDS-acq')
+        self.bids_run = self.config.get('BIDS-run')
+        self.bids_sub = self.config.get('BIDS-subject')
+        self.bids_ses = self.config.get('BIDS-session')
+        # 'best' or 'all' of the T1w images matching the filters
+        self.multiple_t1w = self.config.get('multiple-t1w', 'best')
+        self.preflight = self.config.get('preflight', True)
+
+    @cached_property
+    def manual_t1_path(self):
+        """Path of the t1_anatomy input, renamed so that it contains no spaces."""
+        manual_t1_path_config = input_path(self.context, 't1_anatomy')
+        if manual_t1_path_config is None or ' ' not in str(manual_t1_path_config):
+            return manual_t1_path_config
         manual_t1_path = PosixPath(str(manual_t1_path_config).replace(' ', '_'))
         # rename the actual file
-        os.rename(manual_t1_path_config, manual_t1_path)
+        os.rename(str(manual_t1_path_config), str(manual_t1_path))
+        return manual_t1_path
+
+    def run_working_dir(self, prefix):
+        """Work directory of one of several T1w images processed together."""
+        return work_dir('{}_{}work'.format(self.output_root.resolve(), prefix))
+
+    @cached_property
+    def fw(self):
+        with timer.phase('sdk login'):
+            import flywheel
+            return flywheel.Client(self.context.get_input('api_key')['key'])
+
+    @cached_property
+    def analysis_container(self):
+        with timer.phase('get analysis'):
+            return self.fw.get(self.analysis_id)
+
+    @cached_property
+    def project_container(self):
+        project_id = self.analysis_container.parents['project']
+        with timer.phase('get project'):
+            return self.fw.get(project_id)
+
+    @cached_property
+    def session_container(self):
+        session_id = self.analysis_container.parent['id']
+        with timer.phase('get session'):
+            return self.fw.get(session_id)
+
+    @cached_property
+    def subject_container(self):
+        subject_id = self.session_container.parents['subject']
+        with timer.phase('get subject'):
+            return self.fw.get(subject_id)
+
+    def prefetch_containers(self, *names):
+        """Look up several parent containers of the analysis concurrently."""
+        analysis = self.analysis_container
+        ids = {'project_container': analysis.parents['project'],
+               'session_container': analysis.parent['id'],
+               'subject_container': analysis.parents.get('subject')}
+        wanted = dict((name, ids[name]) for name in names if ids[name] and name not in self.__dict__)
+        if not wanted:
+            return
+        with timer.phase('container lookups'), ThreadPoolExecutor(max_workers=len(wanted)) as pool:
+            futures = dict((name, pool.submit(self.fw.get, container_id)) for name, container_id in wanted.items())
+            for name, future in futures.items():
+                self.__dict__[name] = future.result()
+
+
+def resume_checkpoints(gear, anat_input, prefix, working_dir):
+    """Keep the stages a previous attempt completed in the work directory."""
+    if gear.template_zip_path:
+        template = 'zip:' + checksum(gear.template_zip_path)
     else:
-        manual_t1_path = manual_t1_path_config
-
-    mni_cort_labels_1 = context.get_input('mni-cortical-labels-1')
-    mni_cort_labels_1_path = None if mni_cort_labels_1 is None else \
-        PosixPath(context.get_input_path('mni-cortical-labels-1'))
-
-    mni_cort_labels_2 = context.get_input('mni-cortical-labels-2')
-    mni_cort_labels_2_path = None if mni_cort_labels_2 is None else \
-        PosixPath(context.get_input_path('mni-cortical-labels-2'))
-
-    mni_cort_labels_3 = context.get_input('mni-cortical-labels-3')
-    mni_cort_labels_3_path = None if mni_cort_labels_3 is None else \
-        PosixPath(context.get_input_path('mni-cortical-labels-3'))
-
-    # create space separated list (str)
-    mni_cort_labels_path_list = [mni_cort_labels_1_path, mni_cort_labels_2_path, mni_cort_labels_3_path]
-    # use list comprehension to remove None values
-    mni_cort_labels_path_list = [str(i) for i in mni_cort_labels_path_list if i]
-    mni_cort_labels_paths_str = " ".join(mni_cort_labels_path_list)
-
-    mni_labels_1 = context.get_input('mni-labels-1')
-    mni_labels_1_path = None if mni_labels_1 is None else \
-        PosixPath(context.get_input_path('mni-labels-1'))
-
-    mni_labels_2 = context.get_input('mni-labels-2')
-    mni_labels_2_path = None if mni_labels_2 is None else \
-        PosixPath(context.get_input_path('mni-labels-2'))
-
-    mni_labels_3 = context.get_input('mni-labels-3')
-    mni_labels_3_path = None if mni_labels_3 is None else \
-        PosixPath(context.get_input_path('mni-labels-3'))
-
-    # create space separated list (str)
-    mni_labels_path_list = [mni_labels_1_path, mni_labels_2_path, mni_labels_3_path]
-    # use list comprehension to remove None values
-    mni_labels_path_list = [str(i) for i in mni_labels_path_list if i]
-    mni_labels_paths_str = " ".join(mni_labels_path_list)
-
-    logger.info("manual_t1: %s" % manual_t1)
-    logger.info("manual_t1_path: %s" % manual_t1_path)
-
-    # Get template zip
-    template_zip = context.get_input('template-zip')
-    template_zip_path = None if template_zip is None else \
-        PosixPath(context.get_input_path('template-zip'))
-
-    # configs, use int() to translate the booleans to 0 or 1
-    # output_prefix = config.get('output-file-root')
-    denoise = int(config.get('denoise'))
-    num_threads = config.get('num-threads')
-    run_quick = int(config.get('run-quick'))
-    trim_neck = int(config.get('trim-neck'))
-    bids_acq = config.get('BIDS-acq')
-    bids_run = config.get('BIDS-run')
-    bids_sub = config.get('BIDS-subject')
-    bids_ses = config.get('BIDS-session')
-
-
-def write_command(anat_input, prefix):  # , template_dir):
-    """Create a command script."""
-    with flywheel.GearContext() as context:
-        cmd = ['/opt/scripts/runAntsCT_nonBIDS.pl',
-               '--anatomical-image {}'.format(anat_input),
-               '--output-dir {}'.format(gear_output_dir),
-               '--output-file-root {}'.format(prefix),
-               '--denoise {}'.format(denoise),
-               '--num-threads {}'.format(num_threads),
-               '--run-quick {}'.format(run_quick),
-               '--trim-neck {}'.format(trim_neck)
-               ]
-        if mni_cort_labels_paths_str:
-            cmd.append('--mni-cortical-labels {}'.format(mni_cort_labels_paths_str))
-
-        if mni_labels_paths_str:
-            cmd.append('--mni-labels {}'.format(mni_labels_paths_str))
-
-    logger.info(' '.join(cmd))
-    with antsct_script.open('w') as f:
-        f.write(' '.join(cmd))
-
-    return antsct_script.exists()
-
-
-def fw_heudiconv_download():
+        template = gear.config.get('template')
+    # the label inputs are warped after the run, so they don't invalidate any stage
+    settings = {'denoise': gear.denoise, 'run_quick': gear.run_quick, 'trim_neck': gear.trim_neck,
+                'template': template}
+    with timer.phase('checkpoints'):
+        keys = stage_keys(anat_input, settings)
+        resume(working_dir, prefix, keys, settings)
+    return keys
+
+
+def restore_result(keys, prefix, working_dir):
+    """Link the outputs of an identical earlier analysis into the work directory, if there is one."""
+    store = ResultStore.from_environment()
+    if store is None:
+        return False
+    with timer.phase('result lookup'):
+        return store.restore(result_key(keys), working_dir, prefix)
+
+
+def write_command(gear, jobs):
+    """Create a command script for jobs of (anatomical image, prefix, work directory, cached).
+
+    Several jobs run concurrently, as many at a time as the CPU quota and
+    memory allow, sharing the cores. For a cached result the command is
+    written commented out, so the run script still finds the file root and
+    work directory but runs nothing.
+    """
+    if len(jobs) > 1:
+        _, fit = plan_resources(gear.num_threads)
+        concurrent = min(len(jobs), fit)
+        num_threads, _ = plan_resources(gear.num_threads, concurrent)
+        logger.info("Running %d ANTs-CT jobs, %d at a time with %d threads each", len(jobs), concurrent,
+                    num_threads)
+    else:
+        # num-threads 0 sizes the run from the container's CPU quota
+        concurrent = 1
+        num_threads = thread_count(gear.num_threads)
+        memory = cgroup_memory_limit()
+        if memory is not None and memory < MEMORY_PER_JOB:
+            logger.warning("Only %.1f GB of memory available, ANTs-CT may run out of memory.", memory / 1024 ** 3)
+
+    with gear.antsct_script.open('w') as f:
+        for name, value in sorted(thread_environment(num_threads).items()):
+            f.write('export {}={}\n'.format(name, value))
+        for anat_input, prefix, working_dir, cached in jobs:
+            if cached:
+                cmd = build_command(anat_input, working_dir, prefix, gear.denoise, num_threads, gear.run_quick,
+                                    gear.trim_neck)
+                f.write('# outputs restored from the result store\n# {}\n'.format(' '.join(cmd)))
+        running = [job for job in jobs if not job[3]]
+        for start in range(0, len(running), concurrent):
+            for anat_input, prefix, working_dir, _ in running[start:start + concurrent]:
+                cmd = build_command(anat_input, working_dir, prefix, gear.denoise, num_threads, gear.run_quick,
+                                    gear.trim_neck)
+                logger.info(' '.join(cmd))
+                if len(jobs) > 1:
+                    f.write('{} &\npids="$pids $!"\n'.format(' '.join(cmd)))
+                else:
+                    f.write(' '.join(cmd) + '\n')
+            if len(jobs) > 1:
+                f.write('for pid in $pids; do wait $pid || status=1; done\npids=\n')
+        if len(jobs) > 1:
+            f.write('exit ${status:-0}\n')
+
+    return gear.antsct_script.exists()
+
+
+def select_anat(gear, anat_list):
+    """Return the T1w images to process: the best by its SNR estimate, or all of them.
+
+    The preflight checks reject broken or unsuitable images first, from their
+    headers and a voxel subsample, before hours are spent on them.
+    """
+    if not gear.preflight and len(anat_list) < 2:
+        return anat_list
+    with timer.phase('preflight' if gear.preflight else 'anat qc'):
+        return choose_anat(anat_list, gear.multiple_t1w, gear.preflight)
+
+
+def write_labels(gear):
+    """List the label inputs for label_propagation.py, extracting the label zip."""
+    labels = list(gear.mni_labels_path_list)
+    cortical_labels = list(gear.mni_cort_labels_path_list)
+    if gear.mni_labels_zip_path:
+        with timer.phase('label zip'):
+            zip_labels, zip_cortical = extract_labels_zip(gear.mni_labels_zip_path, gear.output_root / 'mni-labels')
+        labels.extend(zip_labels)
+        cortical_labels.extend(zip_cortical)
+    if labels or cortical_labels:
+        write_label_list(gear.label_list, labels, cortical_labels)
+        logger.info("%d label images to warp to subject space", len(labels) + len(cortical_labels))
+
+
+def fw_heudiconv_download(gear):
     """Use fw-heudiconv to download BIDS data."""
-    subjects = [subject_container.label]
-    sessions = [session_container.label]
+    if gear.manual_t1 is not None:
+        gear.prefetch_containers('session_container', 'subject_container')
+    else:
+        gear.prefetch_containers('project_container', 'session_container', 'subject_container')
+    subjects = [gear.subject_container.label]
+    sessions = [gear.session_container.label]
 
     # Use manually specified T1 if it exists
-    if manual_t1 is not None:
-        anat_input = manual_t1_path
-        subject_label = subject_container.label.replace('_', 'x')
-        session_label = session_container.label.replace('_', 'x')
-        prefix = 'sub-{}_ses-{}_'.format(subject_label, session_label)
-        return True, anat_input, prefix
+    if gear.manual_t1 is not None:
+        anat_input = gear.manual_t1_path
+        logger.info("manual_t1_path: %s" % anat_input)
+        prefix = manual_prefix(gear.subject_container.label, gear.session_container.label)
+        if not select_anat(gear, [anat_input]):
+            return False, []
+        return True, [(anat_input, prefix)]
 
     # Do the download!
+    from fw_heudiconv.cli import export
+    bids_root = gear.bids_root
     bids_root.parent.mkdir(parents=True, exist_ok=True)
-    downloads = export.gather_bids(fw, project_label, subjects, sessions)
-    export.download_bids(fw, downloads, str(bids_dir.resolve()), dry_run=False, folders_to_download=['anat'])
+    with timer.phase('gather_bids'):
+        downloads = export.gather_bids(gear.fw, gear.project_container.label, subjects, sessions)
+    with timer.phase('download_bids'):
+        download_anat(gear.fw, downloads, gear.bids_dir.resolve(), DownloadCache.from_environment(),
+                      session_ids=[gear.session_container.id])
 
-    layout = BIDSLayout(bids_root)
+    with timer.phase('index anat'):
+        layout = load_anat_index(bids_root)
 
     # Get subject and session label
     # subject_label = layout.get(return_type='id', target='subject')[0].strip("[']")
     # session_label = layout.get(return_type='id', target='session')[0].strip("[']")
 
-    filters = {}
-    if bids_sub:
-        filters["subject"] = [bids_sub]
-    else:
-        filters["subject"] = subjects
-    if bids_ses:
-        filters["session"] = [bids_ses]
-    else:
-        filters["session"] = sessions
-
-    if bids_acq:
-        filters["acquisition"] = bids_acq
-
-    if bids_run:
-        filters["run"] = bids_run
+    filters = bids_filters(subjects, sessions, gear.bids_sub, gear.bids_ses, gear.bids_acq, gear.bids_run)
+    anat_list = find_anat(layout, filters)
 
-    anat_list = layout.get(return_type='file', extension=['.nii', '.nii.gz'], **filters)
-
-    # if there are multiple files or no files, error out
-    # otherwise just use the one
-    if len(anat_list) > 1:
-        logger.warning("Multiple anatomical files found in %s. If you want to process multiple images, use the longtidunal gear.",
-                       bids_root)
-        return False
-    elif not len(anat_list) or len(anat_list) == 0:
+    if not anat_list:
         logger.warning("No anatomical files found in %s", bids_root)
-        return False
-    else:
-        anat_input = anat_list[0]
-
-    logger.info("Using {} as input anatomical image.".format(anat_input))
-
-    # Generate prefix from bids layout
-    basename = os.path.basename(anat_input).split('.')[0]
-    prefix = basename.replace('_T1w', '') + '_'
+        return False, []
+
+    anat_inputs = [(anat_input, bids_prefix(anat_input)) for anat_input in select_anat(gear, anat_list)]
+    if not anat_inputs:
+        return False, []
+    for anat_input, prefix in anat_inputs:
+        logger.info("Using {} as input anatomical image.".format(anat_input))
+    return True, anat_inputs
+
+
+def check_template(gear):
+    """Warn up front when the configured template lacks files, from the template index."""
+    if gear.template_zip_path:
+        return
+    template = gear.config.get('template')
+    with timer.phase('template index'):
+        index = load_index()
+    if index.name(template) is None:
+        logger.warning("Template %s is not in TEMPLATEFLOW_HOME.", template)
+        return
+    missing = index.missing_priors(template)
+    if missing:
+        logger.warning("Template %s has no tissue prior for: %s", template, ', '.join(missing))
 
-    return True, anat_input, prefix
 
+def main():
+    with timer.phase('import flywheel'):
+        import flywheel
+    logger.info("=======: ANTs Cortical Thickness :=======")
 
-def get_template():
-    """Return path to folder containing custom template files."""
-    # Inputting a template zip files overrides the template configuration selection.
-    if template_zip_path:
-        basename = os.path.splitext(os.basename(template_zip_path))
-        # make a directory to feed into perl run script
-        template_dir_path = '/flywheel/v0/tpl-' + basename
-        os.makedirs(template_dir_path, exist_ok=True)
-
-        import zipfile
-        with zipfile.ZipFile(template_zip_path, "r") as zip_ref:
-            zip_ref.extractall(template_dir_path)
-
-    else:
-        template = config.get('template')
-        template_list = []
-        orig = tflow.get(template, resolution=1, desc=None, suffix='T1w')
-        if not orig:
-            logger.warning("Unable to find original T1w image.")
-        elif type(orig) == list:
-            logger.warning("Unable to resolve T1w file.")
-        else:
-            template_list.append(orig)
-
-        brain_extracted = tflow.get(template, resolution=1, desc='brain', suffix='T1w')
-        if not brain_extracted.exists():
-            logger.warning("Unable to find brain-extracted T1w image.")
-            return 1
-        elif type(brain_extracted) == list:
-            logger.warning("Unable to resolve brain-extracted T1w file.")
+    # Gather variables that will be shared across functions
+    with flywheel.GearContext() as context:
+        # Setup basic logging
+        context.init_logging()
+        gear = GearRun(context)
+
+        check_template(gear)
+        download_ok, anat_inputs = fw_heudiconv_download(gear)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if not download_ok:
+            logger.warning("Critical error while trying to download or check the anatomical data.")
             return 1
-        else:
-            template_list.append(brain_extracted)
 
-        reg_mask = tflow.get(template, resolution=1, desc='BrainCerebellumRegistration', suffix='mask')
-        if not reg_mask.exists():
-            logger.warning("Unable to find registration mask.")
-            return 1
-        elif type(reg_mask) == list:
-            logger.warning("Unable to resolve registration mask file.")
-            return 1
-        else:
-            template_list.append(reg_mask)
-
-        # get all the tissue priors (including the brain probability)
-        tissue_probs = tflow.get(template, resolution=1, suffix='probseg')
-        if len(tissue_probs) < 7:
-            logger.warning("Unable to find one or more tissue priors:")
-            print(tissue_probs)
+        # several T1w images are processed side by side, each in its own work directory
+        jobs = []
+        for anat_input, prefix in anat_inputs:
+            working_dir = gear.working_dir if len(anat_inputs) == 1 else gear.run_working_dir(prefix)
+            keys = resume_checkpoints(gear, anat_input, prefix, working_dir)
+            jobs.append((anat_input, prefix, working_dir, restore_result(keys, prefix, working_dir)))
+        command_ok = write_command(gear, jobs)
+        write_labels(gear)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if not command_ok:
+            logger.warning("Critical error while trying to write ANTs-CT command.")
             return 1
-        else:
-            for t in tissue_probs:
-                template_list.append(t)
 
-        # make a directory to feed into perl run script
-        template_dir_path = '/flywheel/v0/tpl-'+template
-        os.makedirs(template_dir_path, exist_ok=True)
-        for file in template_list:
-            copy2(file, template_dir_path)
-
-    return template_dir_path
-
-
-def main():
-    # template_dir = get_template()
-    download_ok, anat_input, prefix = fw_heudiconv_download()
-    sys.stdout.flush()
-    sys.stderr.flush()
-    if not download_ok:
-        logger.warning("Critical error while trying to download BIDS data.")
-        return 1
-
-    command_ok = write_command(anat_input, prefix)  # , template_dir)
-    sys.stdout.flush()
-    sys.stderr.flush()
-    if not command_ok:
-        logger.warning("Critical error while trying to write ANTs-CT command.")
-        return 1
+        update_report(gear.gear_output_dir / REPORT, prepare=timer.report(logger))
 
     return 0
 
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Build a TEMPLATEFLOW_HOME that holds only the files the gear can use.
+
+The needed set is derived from the template choices in manifest.json and the
+lookups in template_index.py (GEAR_QUERIES, LABEL_QUERIES). Matching files,
+plus each template's metadata, are copied to the output directory, and the
+entity index of exactly those files is written next to them.
+
+    python prune_templateflow.py --templateflow-home .templateflow --output /tmp/templateflow
+"""
+import os
+import sys
+import shutil
+import logging
+import argparse
+from pathlib import PosixPath
+from template_index import GEAR_QUERIES, LABEL_QUERIES, TemplateIndex, build_index, write_index, \
+    manifest_templates, resolve_template_dirs
+from label_registry import LabelRegistry, LABELS_CACHE
+
+logger = logging.getLogger('antsct-gear')
+
+# Per-template files templateflow and the licenses need
+METADATA_FILES = ['template_description.json', 'CHANGES', 'LICENSE']
+
+
+def needed_files(templateflow_home, names, queries=GEAR_QUERIES + LABEL_QUERIES):
+    """Return (template folder, [paths]) for every template the gear may use."""
+    index = TemplateIndex(templateflow_home, build_index(templateflow_home, names, checksums=False))
+    selected = []
+    for folder in resolve_template_dirs(templateflow_home, names):
+        files = [folder / m for m in METADATA_FILES if (folder / m).exists()]
+        files.extend(sorted(set(p for q in queries for p in index.find(folder.name[4:], **q))))
+        selected.append((folder, files))
+    return selected
+
+
+def tree_size(path):
+    return sum(f.stat().st_size for f in PosixPath(path).rglob('*') if f.is_file())
+
+
+def prune(templateflow_home, output, names):
+    """Copy the needed files to output and write the index; return the index."""
+    output = PosixPath(output)
+    for folder, files in needed_files(templateflow_home, names):
+        dest_dir = output / folder.name
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        for path in files:
+            shutil.copy2(str(path), str(dest_dir / path.name))
+    index = write_index(output)
+    LabelRegistry.load([output], output / LABELS_CACHE)
+
+    before = tree_size(templateflow_home)
+    after = tree_size(output)
+    logger.info("Kept %d files from %d templates", len(index['files']), len(index['templates']))
+    logger.info("TEMPLATEFLOW_HOME: %d bytes -> %d bytes (%d bytes saved)", before, after, before - after)
+    return index
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Prune TEMPLATEFLOW_HOME to the files used by the gear.')
+    parser.add_argument('--templateflow-home', default=os.environ.get('TEMPLATEFLOW_HOME', '.templateflow'))
+    parser.add_argument('--output', required=True, help='Directory for the pruned TEMPLATEFLOW_HOME.')
+    parser.add_argument('--manifest', default=str(PosixPath(__file__).parent / 'manifest.json'))
+    parser.add_argument('--templates', nargs='+', help='Templates to keep (default: manifest choices).')
+    args = parser.parse_args(argv)
+
+    names = args.templates or manifest_templates(args.manifest)
+    prune(args.templateflow_home, args.output, names)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
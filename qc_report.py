@@ -0,0 +1,252 @@
+#!/usr/local/miniconda/bin/python
+"""Render the QC mosaics of an ANTs-CT run into a single HTML report.
+
+Each figure reads only the slices it shows from the (memory-mapped or
+sequentially decompressed) NIfTI files. It maps them through a colormap
+lookup table and writes the mosaic as a PNG with zlib, so no external
+renderer is launched. Figures are rendered in parallel threads and
+embedded in <file root>qc.html:
+
+- the tissue segmentation on the bias-corrected T1w
+- the cortical thickness map
+- the brain extraction mask outline
+- the normalized brain with the template brain mask outline, as the registration check
+
+    qc_report.py <ANTs output dir> <file root> [--slices 12] [--columns 6]
+"""
+import sys
+import html
+import time
+import zlib
+import base64
+import struct
+import logging
+import argparse
+from pathlib import PosixPath
+from concurrent.futures import ThreadPoolExecutor
+from antsct_utils import cpu_budget
+from label_registry import tissue_table
+
+logger = logging.getLogger('antsct-gear')
+
+REPORT_SUFFIX = 'qc.html'
+# name -> (caption, background images (first found is used), overlay image, overlay style, views)
+FIGURES = [
+    ('segmentation', 'Tissue segmentation on the bias-corrected T1w',
+     ['_BrainSegmentation0N4.nii.gz'], '_BrainSegmentation.nii.gz', 'labels', ['axial']),
+    ('thickness', 'Cortical thickness (0 to 5 mm)',
+     ['_BrainSegmentation0N4.nii.gz'], '_CorticalThickness.nii.gz', 'hot', ['axial']),
+    ('brainmask', 'Brain extraction mask',
+     ['_NeckTrim.nii.gz', '_BrainSegmentation0N4.nii.gz'], '_BrainExtractionMask.nii.gz', 'outline', ['axial']),
+    ('registration', 'Normalized brain with the template brain mask',
+     ['_BrainNormalizedToTemplate.nii.gz'], '_RegistrationTemplateBrainMask.nii.gz', 'outline',
+     ['axial', 'coronal', 'sagittal']),
+]
+# view -> (sliced world axis, world axis shown top to bottom, world axis shown left to right)
+VIEWS = {'axial': ('z', 'y', 'x'), 'coronal': ('y', 'z', 'x'), 'sagittal': ('x', 'z', 'y')}
+# orientation codes of the world axes, and the code that should end up at the top or right of the picture
+WORLD_AXES = {'L': 'x', 'R': 'x', 'P': 'y', 'A': 'y', 'I': 'z', 'S': 'z'}
+UPPER = {'x': 'R', 'y': 'A', 'z': 'S'}
+OUTLINE_COLOR = (255, 40, 40)
+OVERLAY_ALPHA = 0.5
+THICKNESS_MAX = 5.0
+
+
+def gray_lut():
+    import numpy as np
+    return np.repeat(np.arange(256, dtype=np.uint8)[:, None], 3, axis=1)
+
+
+def hot_lut():
+    import numpy as np
+    x = np.linspace(0, 1, 256)
+    return (np.clip(np.stack([3 * x, 3 * x - 1, 3 * x - 2], axis=1), 0, 1) * 255).astype(np.uint8)
+
+
+def write_png(rgb):
+    """Encode an (height, width, 3) uint8 array as PNG bytes."""
+    import numpy as np
+    height, width, _ = rgb.shape
+    # every scanline starts with filter type 0 (none)
+    raw = np.concatenate([np.zeros((height, 1), np.uint8), rgb.reshape(height, width * 3)], axis=1)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)) + chunk(b'IEND', b''))
+
+
+def view_axes(img, view):
+    """Return (slice axis, row axis, column axis, flip rows, flip columns) of a view in array terms."""
+    import nibabel as nb
+    codes = nb.aff2axcodes(img.affine)
+    axis_of = dict((WORLD_AXES[code], i) for i, code in enumerate(codes))
+    sliced, rows, columns = VIEWS[view]
+    # array index 0 is drawn at the top, so rows pointing to the upper end are flipped
+    return (axis_of[sliced], axis_of[rows], axis_of[columns], codes[axis_of[rows]] == UPPER[rows],
+            codes[axis_of[columns]] != UPPER[columns])
+
+
+def read_slices(img, axis, positions):
+    """Read evenly spaced slices along an axis; returns an array with the sliced axis last."""
+    import numpy as np
+    index = [slice(None)] * 3
+    index[axis] = slice(positions[0], positions[-1] + 1, max(1, positions[1] - positions[0]) if len(positions) > 1
+                        else 1)
+    if len(img.shape) > 3:
+        index.append(0)
+    data = np.asarray(img.dataobj[tuple(index)])
+    return np.moveaxis(data, axis, -1)
+
+
+def slice_positions(length, count, margin=0.15):
+    """Evenly spaced slice indices, skipping the margins where there is usually no brain."""
+    start = int(length * margin)
+    stop = max(start + 1, int(length * (1 - margin)))
+    step = max(1, (stop - start) // max(1, count))
+    return list(range(start, stop, step))[:count]
+
+
+def scale(data, low=1, high=99):
+    """Window an image at the given percentiles of its nonzero voxels into uint8."""
+    import numpy as np
+    values = data[data > 0]
+    if not values.size:
+        return np.zeros(data.shape, np.uint8)
+    vmin, vmax = np.percentile(values, [low, high])
+    return (np.clip((data - vmin) / max(vmax - vmin, 1e-6), 0, 1) * 255).astype(np.uint8)
+
+
+def outline(mask):
+    """Voxels of a boolean stack of slices that have a 4-neighbour outside the mask."""
+    inner = mask.copy()
+    inner[1:] &= mask[:-1]
+    inner[:-1] &= mask[1:]
+    inner[:, 1:] &= mask[:, :-1]
+    inner[:, :-1] &= mask[:, 1:]
+    return mask & ~inner
+
+
+def overlay(background, data, style):
+    """Blend an overlay onto a uint8 background stack; returns RGB stacks."""
+    import numpy as np
+    rgb = gray_lut()[background]
+    if style == 'labels':
+        labels = np.clip(data, 0, 255).astype(np.uint8)
+        shown = labels > 0
+        colors = tissue_table().color_lut(256)[labels]
+    elif style == 'hot':
+        shown = data > 0
+        colors = hot_lut()[(np.clip(data / THICKNESS_MAX, 0, 1) * 255).astype(np.uint8)]
+    else:
+        shown = outline(data > 0)
+        colors = np.empty_like(rgb)
+        colors[...] = OUTLINE_COLOR
+        rgb[shown] = colors[shown]
+        return rgb
+    blended = (1 - OVERLAY_ALPHA) * rgb[shown] + OVERLAY_ALPHA * colors[shown]
+    rgb[shown] = blended.astype(np.uint8)
+    return rgb
+
+
+def mosaic(stack, columns):
+    """Tile an RGB stack of shape (rows, columns, slices, 3) into one picture."""
+    import numpy as np
+    height, width, count, _ = stack.shape
+    rows = -(-count // columns)
+    canvas = np.zeros((rows * height, columns * width, 3), np.uint8)
+    for i in range(count):
+        r, c = divmod(i, columns)
+        canvas[r * height:(r + 1) * height, c * width:(c + 1) * width] = stack[:, :, i]
+    return canvas
+
+
+def render(background_path, overlay_path, style, views, slices=12, columns=6):
+    """Render one figure; returns PNG bytes."""
+    import numpy as np
+    import nibabel as nb
+    background_img = nb.load(str(background_path), mmap='r', keep_file_open=True)
+    overlay_img = nb.load(str(overlay_path), mmap='r', keep_file_open=True)
+    panels = []
+    for view in views:
+        axis, row_axis, column_axis, flip_rows, flip_columns = view_axes(background_img, view)
+        positions = slice_positions(background_img.shape[axis], slices if len(views) == 1 else columns)
+        background = read_slices(background_img, axis, positions)
+        data = read_slices(overlay_img, axis, positions)
+        # remaining array axes, in order, are the first two of the stack
+        remaining = [a for a in range(3) if a != axis]
+        if remaining.index(row_axis) != 0:
+            background, data = background.swapaxes(0, 1), data.swapaxes(0, 1)
+        if flip_rows:
+            background, data = background[::-1], data[::-1]
+        if flip_columns:
+            background, data = background[:, ::-1], data[:, ::-1]
+        rgb = overlay(scale(background.astype(np.float32)), data, style)
+        panels.append(mosaic(rgb, columns))
+    width = max(p.shape[1] for p in panels)
+    picture = np.concatenate([np.pad(p, ((0, 0), (0, width - p.shape[1]), (0, 0))) for p in panels], axis=0)
+    return write_png(picture)
+
+
+def find_figures(input_dir, prefix):
+    """Return [(name, caption, background, overlay, style, views)] for the figures whose images exist."""
+    input_dir = PosixPath(input_dir)
+    found = []
+    for name, caption, backgrounds, overlay_suffix, style, views in FIGURES:
+        background = next((input_dir / (prefix + s[1:]) for s in backgrounds
+                           if (input_dir / (prefix + s[1:])).exists()), None)
+        overlay_path = input_dir / (prefix + overlay_suffix[1:])
+        if background is None or not overlay_path.exists():
+            logger.warning("Skipping the %s figure: images not found", name)
+            continue
+        found.append((name, caption, background, overlay_path, style, views))
+    return found
+
+
+def write_report(path, title, figures):
+    """Write the HTML report with the PNGs embedded; figures is [(name, caption, png bytes)]."""
+    parts = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8"><title>{}</title>'.format(html.escape(title)),
+             '<style>body{font-family:sans-serif;background:#111;color:#eee}img{max-width:100%}</style>',
+             '</head><body>', '<h1>{}</h1>'.format(html.escape(title))]
+    for name, caption, png in figures:
+        parts.append('<h2 id="{}">{}</h2>'.format(name, html.escape(caption)))
+        parts.append('<img alt="{}" src="data:image/png;base64,{}">'.format(name, base64.b64encode(png).decode()))
+    parts.append('</body></html>')
+    with open(str(path), 'w') as f:
+        f.write('\n'.join(parts) + '\n')
+
+
+def qc_report(input_dir, prefix, output_dir=None, slices=12, columns=6, workers=None):
+    """Render all figures in parallel and write the report; returns its path."""
+    output_dir = PosixPath(output_dir or input_dir)
+    figures = find_figures(input_dir, prefix)
+    with ThreadPoolExecutor(max_workers=workers or min(len(figures) or 1, cpu_budget())) as pool:
+        futures = [(name, caption, pool.submit(render, background, overlay_path, style, views, slices, columns))
+                   for name, caption, background, overlay_path, style, views in figures]
+        rendered = [(name, caption, future.result()) for name, caption, future in futures]
+    path = output_dir / (prefix + REPORT_SUFFIX)
+    write_report(path, 'ANTs-CT QC: {}'.format(prefix.rstrip('_')), rendered)
+    logger.info("Wrote %s with %d figures", path, len(rendered))
+    return path
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Render the ANTs-CT QC mosaics into an HTML report.')
+    parser.add_argument('input_dir', help='Folder with the ANTs-CT outputs.')
+    parser.add_argument('prefix', help='Output file root, e.g. sub-01_ses-01_')
+    parser.add_argument('--output-dir', help='Where to write the report (default: input dir).')
+    parser.add_argument('--slices', type=int, default=12, help='Slices in the single-view mosaics.')
+    parser.add_argument('--columns', type=int, default=6, help='Slices per mosaic row.')
+    parser.add_argument('--workers', type=int, help='Figures rendered in parallel (default: the CPU quota).')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    qc_report(args.input_dir, args.prefix, args.output_dir, args.slices, args.columns, args.workers)
+    logger.info("QC report took %.1f s", time.time() - start)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,237 @@
+#!/usr/local/miniconda/bin/python
+"""Regional statistics over the label images in subject space.
+
+The cortical thickness map, the segmentation posteriors and every label image
+are read once, slab by slab along the last axis, from memory-mapped (or
+sequentially decompressed) NIfTI files. For every label set at the same time,
+the per-label sums are accumulated with np.bincount:
+
+- volume,
+- mean, median and standard deviation of the cortical thickness,
+- mean posterior probability of each tissue class.
+
+Each label set is written as a tidy TSV with one row per label. Names come
+from the matching dseg.tsv table in the label registry.
+
+    regional_stats.py <ANTs output dir> <file root> [--labels NAME=IMAGE[:TSV]] [--dseg-dir DIR]
+"""
+import os
+import re
+import sys
+import logging
+import argparse
+from pathlib import PosixPath
+from label_registry import LabelRegistry, LabelTable, LABELS_CACHE, tissue_table, label_entities
+
+logger = logging.getLogger('antsct-gear')
+
+# Label images the pipeline leaves next to its outputs (after the file root)
+LABEL_PATTERNS = ['*Lausanne*.nii.gz', '*DKT31*.nii.gz', '*Labels*.nii.gz', '*_dseg.nii.gz']
+STATS_SUFFIX = '_regionstats.tsv'
+COLUMNS = ['label_set', 'index', 'name', 'voxels', 'volume_mm3', 'thickness_voxels', 'thickness_mean',
+           'thickness_median', 'thickness_std']
+
+
+def load(path):
+    """Open a NIfTI image for slab reads without decompressing it more than once."""
+    import nibabel as nb
+    return nb.load(str(path), mmap='r', keep_file_open=True)
+
+
+def label_set_name(path, prefix):
+    """Short name of a label set, taken from its atlas/desc entities or its file name."""
+    entities = label_entities(path)
+    if 'atlas' in entities:
+        return ''.join('{}-{}_'.format(k, entities[k]) for k in ('atlas', 'desc') if k in entities).rstrip('_')
+    name = os.path.basename(str(path)).split('.')[0]
+    return name[len(prefix):] if name.startswith(prefix) else name
+
+
+def find_label_sets(input_dir, prefix, registry, tissues=None):
+    """Return [(name, image, {index: name})] for the tissue segmentation and each label image found."""
+    input_dir = PosixPath(input_dir)
+    sets = []
+    segmentation = input_dir / (prefix + 'BrainSegmentation.nii.gz')
+    if segmentation.exists():
+        sets.append(('tissue', segmentation, (tissues if tissues is not None else tissue_table()).mapping()))
+    seen = set()
+    for pattern in LABEL_PATTERNS:
+        for image in sorted(input_dir.glob(prefix + pattern)):
+            if image in seen or 'BrainSegmentation' in image.name:
+                continue
+            seen.add(image)
+            table = registry.for_image(image)
+            sets.append((label_set_name(image, prefix), image, table.mapping() if table else {}))
+    return sets
+
+
+def _slabs(shape, size):
+    for start in range(0, shape[2], size):
+        yield slice(start, min(start + size, shape[2]))
+
+
+def compute(thickness_path, posterior_paths, label_sets, slab_size=16):
+    """Accumulate the regional statistics of every label set in one pass over the images.
+
+    posterior_paths maps tissue labels to posterior images. Returns
+    {label set name: {'counts', 'thickness_count', 'thickness_sum', 'thickness_sq',
+    'medians', 'tissue': {label: sums}, 'voxel_volume'}}, with per-label numpy arrays.
+    """
+    import numpy as np
+
+    thickness_img = load(thickness_path) if thickness_path else None
+    posteriors = dict((label, load(path)) for label, path in posterior_paths.items())
+    labels = [(name, load(path)) for name, path, _ in label_sets]
+    if not labels:
+        return {}
+    shape = labels[0][1].shape[:3]
+    voxel_volume = float(np.prod(labels[0][1].header.get_zooms()[:3]))
+
+    # labels are accumulated into arrays grown as higher label values turn up
+    totals = dict((name, {'counts': np.zeros(1), 'thickness_count': np.zeros(1), 'thickness_sum': np.zeros(1),
+                          'thickness_sq': np.zeros(1), 'tissue': dict((t, np.zeros(1)) for t in posteriors),
+                          'pairs': []}) for name, _ in labels)
+
+    def add(target, key, values):
+        if len(values) > len(target[key]):
+            target[key] = np.concatenate([target[key], np.zeros(len(values) - len(target[key]))])
+        target[key][:len(values)] += values
+
+    for z in _slabs(shape, slab_size):
+        thickness = None
+        if thickness_img is not None:
+            thickness = np.asarray(thickness_img.dataobj[:, :, z], dtype=np.float64).ravel()
+        tissue = dict((t, np.asarray(img.dataobj[:, :, z], dtype=np.float64).ravel()) for t, img in posteriors.items())
+        for name, img in labels:
+            lab = np.asarray(img.dataobj[:, :, z]).ravel().astype(np.int64)
+            np.clip(lab, 0, None, out=lab)
+            total = totals[name]
+            add(total, 'counts', np.bincount(lab).astype(np.float64))
+            for t, values in tissue.items():
+                add(total['tissue'], t, np.bincount(lab, weights=values))
+            if thickness is not None:
+                cortex = thickness > 0
+                lab_c, t_c = lab[cortex], thickness[cortex]
+                add(total, 'thickness_count', np.bincount(lab_c).astype(np.float64))
+                add(total, 'thickness_sum', np.bincount(lab_c, weights=t_c))
+                add(total, 'thickness_sq', np.bincount(lab_c, weights=t_c * t_c))
+                total['pairs'].append((lab_c, t_c.astype(np.float32)))
+
+    for name, total in totals.items():
+        total['voxel_volume'] = voxel_volume
+        total['medians'] = _medians(total.pop('pairs'), len(total['counts']))
+    return totals
+
+
+def _medians(pairs, size):
+    """Per-label medians of the thickness values, from one sort of all (label, value) pairs."""
+    import numpy as np
+    medians = np.full(size, np.nan)
+    if not pairs:
+        return medians
+    lab = np.concatenate([p[0] for p in pairs])
+    values = np.concatenate([p[1] for p in pairs])
+    if not len(lab):
+        return medians
+    order = np.lexsort((values, lab))
+    lab, values = lab[order], values[order]
+    present, starts, counts = np.unique(lab, return_index=True, return_counts=True)
+    low = values[starts + (counts - 1) // 2]
+    high = values[starts + counts // 2]
+    medians[present] = (low.astype(np.float64) + high) / 2
+    return medians
+
+
+def rows(name, total, names):
+    """Yield one tidy row per label (label 0, the background, is skipped)."""
+    import numpy as np
+    size = len(total['counts'])
+    indices = sorted(set(i for i in range(1, size) if total['counts'][i] > 0) | set(i for i in names if i > 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for i in indices:
+            count = total['counts'][i] if i < size else 0
+            t_count = total['thickness_count'][i] if i < len(total['thickness_count']) else 0
+            t_sum = total['thickness_sum'][i] if i < len(total['thickness_sum']) else 0
+            t_sq = total['thickness_sq'][i] if i < len(total['thickness_sq']) else 0
+            mean = t_sum / t_count if t_count else np.nan
+            std = np.sqrt(max(t_sq / t_count - mean * mean, 0)) if t_count else np.nan
+            row = [name, i, names.get(i, str(i)), int(count), count * total['voxel_volume'], int(t_count), mean,
+                   total['medians'][i] if i < len(total['medians']) and t_count else np.nan, std]
+            for t in sorted(total['tissue']):
+                sums = total['tissue'][t]
+                row.append(sums[i] / count if count and i < len(sums) else np.nan)
+            yield row
+
+
+def write_tsv(path, name, total, names, tissues):
+    tissue_columns = ['fraction_{}'.format(tissues.get(t, 'abbr', str(t))) for t in sorted(total['tissue'])]
+    with open(str(path), 'w') as f:
+        f.write('\t'.join(COLUMNS + tissue_columns) + '\n')
+        for row in rows(name, total, names):
+            f.write('\t'.join('n/a' if isinstance(v, float) and v != v else
+                              '{:.6g}'.format(v) if isinstance(v, float) else str(v) for v in row) + '\n')
+
+
+def regional_stats(input_dir, prefix, output_dir=None, extra_sets=(), search_dirs=(), slab_size=16, label_cache=None):
+    """Compute and write the stats of all label sets; return the TSV paths."""
+    input_dir = PosixPath(input_dir)
+    output_dir = PosixPath(output_dir or input_dir)
+    posterior_paths = {}
+    for path in input_dir.glob(prefix + 'BrainSegmentationPosteriors*.nii.gz'):
+        number = re.search(r'Posteriors(\d+)', path.name)
+        if number:
+            posterior_paths[int(number.group(1))] = path
+    # one tissue class per posterior, as for the derivatives
+    tissues = tissue_table(max(posterior_paths) if posterior_paths else None)
+
+    registry = LabelRegistry.load(search_dirs, label_cache)
+    label_sets = find_label_sets(input_dir, prefix, registry, tissues) + list(extra_sets)
+    if not label_sets:
+        logger.warning("No label images found in %s", input_dir)
+        return []
+
+    thickness = input_dir / (prefix + 'CorticalThickness.nii.gz')
+
+    totals = compute(thickness if thickness.exists() else None, posterior_paths, label_sets, slab_size)
+    written = []
+    for name, _, names in label_sets:
+        path = output_dir / '{}{}{}'.format(prefix, name, STATS_SUFFIX)
+        write_tsv(path, name, totals[name], names, tissues)
+        written.append(path)
+        logger.info("Wrote %s", path)
+    return written
+
+
+def parse_label_arg(value):
+    """Parse NAME=IMAGE[:TSV] into a label set tuple."""
+    name, _, rest = value.partition('=')
+    image, _, table = rest.partition(':')
+    if not name or not image:
+        raise argparse.ArgumentTypeError('expected NAME=IMAGE[:TSV], got {}'.format(value))
+    return name, PosixPath(image), LabelTable.from_tsv(table).mapping() if table else {}
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Regional volume, thickness and tissue statistics.')
+    parser.add_argument('input_dir', help='Folder with the ANTs-CT outputs.')
+    parser.add_argument('prefix', help='Output file root, e.g. sub-01_ses-01_')
+    parser.add_argument('--output-dir', help='Where to write the TSVs (default: input dir).')
+    parser.add_argument('--labels', type=parse_label_arg, action='append', default=[],
+                        help='Additional label image in subject space, as NAME=IMAGE[:TSV].')
+    parser.add_argument('--dseg-dir', action='append', default=[],
+                        help='Folder searched for dseg.tsv tables (default: TEMPLATEFLOW_HOME).')
+    parser.add_argument('--slab', type=int, default=16, help='Slices read at a time.')
+    parser.add_argument('--label-cache', help='Parsed label table cache (default: {} in TEMPLATEFLOW_HOME).'
+                        .format(LABELS_CACHE))
+    args = parser.parse_args(argv)
+
+    templateflow_home = os.environ.get('TEMPLATEFLOW_HOME')
+    search_dirs = args.dseg_dir or [d for d in [templateflow_home] if d]
+    label_cache = args.label_cache or (os.path.join(templateflow_home, LABELS_CACHE) if templateflow_home else None)
+    regional_stats(args.input_dir, args.prefix, args.output_dir, args.labels, search_dirs, args.slab, label_cache)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
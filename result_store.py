@@ -0,0 +1,199 @@
+#!/usr/local/miniconda/bin/python
+"""Store of completed ANTs-CT results, keyed on everything that determines them.
+
+The key combines the checkpoint keys of every pipeline stage: the anatomical
+input checksum, the template, the label images and the settings that change
+the outputs. When an identical analysis is launched again, its outputs are
+linked from the store and runAntsCT_nonBIDS.pl is not run.
+
+The store is a directory (a shared volume, or any local directory when
+testing) holding one folder per result. Output names are stored without
+their file root, so a result can be restored under a different prefix. The
+store is kept under a size limit by evicting the least recently used results.
+
+    result_store.py save <work dir>       add the finished run in work dir
+    result_store.py list                  show the stored results
+    result_store.py verify                check the stored files' checksums
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+from pathlib import PosixPath
+from antsct_utils import link_or_copy
+from template_cache import checksum
+from checkpoint import PLAN
+
+logger = logging.getLogger('antsct-gear')
+
+# Environment variables used by the gear to locate and size the store
+STORE_DIR_ENV = 'ANTSCT_RESULT_STORE'
+STORE_SIZE_ENV = 'ANTSCT_RESULT_STORE_SIZE_GB'
+DEFAULT_STORE_SIZE_GB = 100
+MANIFEST = 'result.json'
+
+
+def result_key(stage_keys):
+    """Combine the per-stage checkpoint keys into the key of the whole result."""
+    return hashlib.sha256(json.dumps(sorted(stage_keys.items())).encode()).hexdigest()
+
+
+class ResultStore(object):
+    """Size-bounded LRU store of finished runs."""
+
+    def __init__(self, root, max_bytes):
+        self.root = PosixPath(root)
+        self.max_bytes = max_bytes
+        self.results = self.root / 'results'
+        self.results.mkdir(parents=True, exist_ok=True)
+
+    @classmethod
+    def from_environment(cls):
+        """Return the store configured in the environment, or None if memoization is off."""
+        root = os.environ.get(STORE_DIR_ENV)
+        if not root:
+            return None
+        size_gb = float(os.environ.get(STORE_SIZE_ENV, DEFAULT_STORE_SIZE_GB))
+        return cls(root, int(size_gb * 1024 ** 3))
+
+    def path(self, key):
+        return self.results / key
+
+    def manifest(self, key):
+        """Return the manifest of a complete stored result, or None."""
+        manifest = self.path(key) / MANIFEST
+        if not manifest.exists():
+            return None
+        with manifest.open() as f:
+            return json.load(f)
+
+    def restore(self, key, dest_dir, prefix):
+        """Link the stored outputs for key into dest_dir under prefix; return False on a miss."""
+        manifest = self.manifest(key)
+        if manifest is None:
+            return False
+        result_dir = self.path(key)
+        for name, entry in manifest['files'].items():
+            stored = result_dir / name
+            if not stored.exists() or stored.stat().st_size != entry['size']:
+                logger.warning("Stored result %s is damaged or incomplete (%s), ignoring it", key[:12], name)
+                return False
+
+        dest_dir = PosixPath(dest_dir)
+        dest_dir.mkdir(parents=True, exist_ok=True)
+        for name in manifest['files']:
+            dest = dest_dir / name.replace('{prefix}', prefix)
+            if dest.exists():
+                dest.unlink()
+            link_or_copy(result_dir / name, dest)
+        os.utime(str(result_dir / MANIFEST))
+        logger.info("Restored %d outputs of %s from the result store", len(manifest['files']), key[:12])
+        return True
+
+    def save(self, key, work_dir, prefix):
+        """Add the top-level outputs in work_dir to the store under key."""
+        if self.manifest(key) is not None:
+            os.utime(str(self.path(key) / MANIFEST))
+            return self.path(key)
+
+        tmp = self.results / '{}.{}.tmp'.format(key, os.getpid())
+        if tmp.exists():
+            shutil.rmtree(str(tmp))
+        tmp.mkdir()
+        files = {}
+        for entry in sorted(os.scandir(str(work_dir)), key=lambda e: e.name):
+            if not entry.is_file() or entry.name.startswith('.'):
+                continue
+            name = entry.name
+            if name.startswith(prefix):
+                name = '{prefix}' + name[len(prefix):]
+            link_or_copy(entry.path, tmp / name)
+            files[name] = {'size': entry.stat().st_size, 'sha256': checksum(entry.path)}
+        with (tmp / MANIFEST).open('w') as f:
+            json.dump({'key': key, 'prefix': prefix, 'files': files, 'created': time.time()}, f, indent=2,
+                      sort_keys=True)
+        try:
+            os.replace(str(tmp), str(self.path(key)))
+        except OSError:
+            # another run stored the same result first
+            shutil.rmtree(str(tmp))
+        logger.info("Stored %d outputs as result %s", len(files), key[:12])
+        self.evict(keep=key)
+        return self.path(key)
+
+    def entries(self):
+        """Return (last used, size, key) for every stored result."""
+        entries = []
+        for result_dir in self.results.iterdir():
+            manifest = result_dir / MANIFEST
+            if result_dir.name.endswith('.tmp') or not manifest.exists():
+                continue
+            with manifest.open() as f:
+                size = sum(e['size'] for e in json.load(f)['files'].values())
+            entries.append((manifest.stat().st_mtime, size, result_dir.name))
+        return entries
+
+    def evict(self, keep=None):
+        """Remove least recently used results until the store fits in max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            logger.info("Evicting result %s from the result store", key[:12])
+            shutil.rmtree(str(self.path(key)))
+            total -= size
+
+    def verify(self, key):
+        """Return the names of stored files whose checksum does not match the manifest."""
+        manifest = self.manifest(key)
+        return [name for name, entry in manifest['files'].items()
+                if not (self.path(key) / name).exists() or checksum(self.path(key) / name) != entry['sha256']]
+
+
+def save_run(store, work_dir):
+    """Store the finished run planned in work_dir by checkpoint.resume()."""
+    with (PosixPath(work_dir) / PLAN).open() as f:
+        plan = json.load(f)
+    return store.save(result_key(plan['keys']), work_dir, plan['prefix'])
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Manage the store of finished ANTs-CT results.')
+    parser.add_argument('action', choices=['save', 'list', 'verify'])
+    parser.add_argument('work_dir', nargs='?')
+    parser.add_argument('--store', default=os.environ.get(STORE_DIR_ENV), help='Result store directory.')
+    parser.add_argument('--size-gb', type=float, default=float(os.environ.get(STORE_SIZE_ENV, DEFAULT_STORE_SIZE_GB)))
+    args = parser.parse_args(argv)
+
+    if not args.store:
+        logger.info("No result store configured.")
+        return 0
+    store = ResultStore(args.store, int(args.size_gb * 1024 ** 3))
+    if args.action == 'save':
+        if not args.work_dir:
+            parser.error('save needs the work directory')
+        save_run(store, args.work_dir)
+    elif args.action == 'list':
+        for mtime, size, key in sorted(store.entries(), reverse=True):
+            print('{}  {:>12d}  {}'.format(key, size, time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime))))
+    else:
+        damaged = 0
+        for _, _, key in store.entries():
+            bad = store.verify(key)
+            if bad:
+                damaged += 1
+                logger.warning("Result %s: %s", key[:12], ', '.join(bad))
+        return 1 if damaged else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""Sanitize templateflow images with one engine and per-template rule tables.
+
+This replaces the tpl-*/scripts/sanitize.py loops (and NKI's fix_dtype.py and
+fix_ras.py). Every template has a rule table that sets:
+
+- the data type of each BIDS suffix,
+- canonical (RAS+) reorientation,
+- the sform/qform codes,
+- clipping of negative values and binarization,
+- intensity normalization and the calibration range.
+
+Files are processed in a process pool. Voxels are read in their stored data
+type through the array proxy, without promotion to float64 (float32 is used
+only when the header scales them). A file is rewritten only when its header
+or voxels change.
+
+    python sanitize_templates.py --templateflow-home .templateflow [--templates WHS fsLR] [--dry-run]
+"""
+import os
+import sys
+import logging
+import argparse
+from pathlib import PosixPath
+from concurrent.futures import ProcessPoolExecutor
+from antsct_utils import cpu_budget
+from template_index import resolve_template_dirs
+
+logger = logging.getLogger('antsct-gear')
+
+DEFAULTS = {
+    'pattern': 'tpl-*.nii.gz',
+    # BIDS suffix -> data type; other files get 'dtype' (None keeps the stored, or scaled float32, type)
+    'dtypes': {'mask': 'uint8', 'probseg': 'float32'},
+    'dtype': 'int16',
+    'canonical': True,
+    'squeeze': False,
+    # code of the sform and qform, both set to the affine (None leaves them)
+    'xform_code': 4,
+    'binarize': (),
+    'clip_negative': (),
+    # maximum the files stored with the default dtype are rescaled to
+    'normalize': None,
+    # BIDS suffix -> (cal_min, cal_max)
+    'cal_range': {},
+}
+RULES = {
+    'MNI152Lin': {'dtypes': {'brainmask': 'uint8', 'roi': 'uint8', 'atlas': 'uint8', 'mask': 'uint8',
+                             'probseg': 'float32'},
+                  'canonical': False},
+    'MNI152NLin2009cSym': {},
+    'MNI152NLin6Asym': {},
+    'MNI152NLin6Sym': {'dtypes': {'mask': 'uint8', 'dseg': 'uint8', 'probseg': 'float32'}, 'normalize': 1e4},
+    'MNIInfant': {'pattern': 'tpl-*_res-2_*.nii.gz', 'squeeze': True, 'binarize': ('mask',),
+                  'clip_negative': ('probseg', 'T1w', 'T2w', 'PD'), 'cal_range': {'probseg': (0.0, 1.0)}},
+    'MNIPediatricAsym': {'pattern': 'cohort-*/tpl-*_res-2_*.nii.gz', 'squeeze': True, 'binarize': ('mask',),
+                         'clip_negative': ('probseg', 'T1w', 'T2w', 'PD'), 'cal_range': {'probseg': (0.0, 1.0)}},
+    'NKI': {'dtypes': {}, 'dtype': None, 'xform_code': None},
+    'WHS': {'pattern': 'tpl-WHS_res-2_*.nii.gz'},
+    'fsLR': {'dtypes': {'mask': 'uint8', 'dseg': 'uint8', 'probseg': 'float32'}},
+}
+
+
+def template_rules(name):
+    """Return the rule table of a template, or None if it has none."""
+    if name not in RULES:
+        return None
+    return dict(DEFAULTS, **RULES[name])
+
+
+def bids_suffix(path):
+    return PosixPath(path).name.split('.')[0].split('_')[-1]
+
+
+def sanitized(img, suffix, rules):
+    """Return the sanitized image and whether its header or voxels changed."""
+    import numpy as np
+    import nibabel as nb
+    from nibabel.orientations import io_orientation, apply_orientation, inv_ornt_aff
+
+    raw = np.asanyarray(img.dataobj.get_unscaled())
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    data = raw
+    if slope != 1 or inter != 0:
+        data = raw.astype(np.float32) * np.float32(slope) + np.float32(inter)
+    affine = img.affine
+
+    if rules['squeeze']:
+        shape = data.shape
+        while len(shape) > 3 and shape[-1] == 1:
+            shape = shape[:-1]
+        data = data.reshape(shape)
+    if rules['canonical']:
+        ornt = io_orientation(affine)
+        if not (ornt == [[0, 1], [1, 1], [2, 1]]).all():
+            data = apply_orientation(data, ornt)
+            affine = affine.dot(inv_ornt_aff(ornt, img.shape[:3]))
+
+    dtype = np.dtype(rules['dtypes'].get(suffix, rules['dtype']) or data.dtype)
+    if suffix in rules['binarize']:
+        data = data > 0
+    if suffix in rules['clip_negative'] and data.dtype.kind in 'if':
+        data = np.maximum(data, data.dtype.type(0))
+    if rules['normalize'] and suffix not in rules['dtypes'] and data.max() > 0:
+        data = data.astype(np.float32) * np.float32(rules['normalize'] / float(data.max()))
+    data = data.astype(dtype, copy=False)
+
+    header = img.header.copy()
+    header.set_data_dtype(dtype)
+    # the values are final, so the header must not scale them again
+    header.set_slope_inter(None, None)
+    if suffix in rules['cal_range']:
+        header['cal_min'], header['cal_max'] = rules['cal_range'][suffix]
+    new = nb.Nifti1Image(data, affine, header)
+    if rules['xform_code'] is not None:
+        new.header.set_sform(affine, rules['xform_code'])
+        new.header.set_qform(affine, rules['xform_code'])
+    new.header.set_xyzt_units(xyz='mm')
+    new.update_header()
+
+    changed = (new.header.binaryblock != img.header.binaryblock or data.dtype != raw.dtype or
+               data.shape != raw.shape or not np.array_equal(data, raw))
+    return new, changed
+
+
+def sanitize_file(path, rules, dry_run=False):
+    """Sanitize one file in place; returns (path, changed)."""
+    import nibabel as nb
+    path = PosixPath(path)
+    new, changed = sanitized(nb.load(str(path)), bids_suffix(path), rules)
+    if changed and not dry_run:
+        tmp = path.with_name('.sanitize_' + path.name)
+        new.to_filename(str(tmp))
+        os.replace(str(tmp), str(path))
+    return str(path), changed
+
+
+def sanitize(templateflow_home, names, dry_run=False, workers=None):
+    """Sanitize the files of the named templates; return the paths that were (or would be) rewritten."""
+    jobs = []
+    for folder in resolve_template_dirs(templateflow_home, names):
+        rules = template_rules(folder.name[4:])
+        if rules is None:
+            logger.warning("No sanitize rules for %s, skipping", folder.name)
+            continue
+        jobs.extend((path, rules) for path in sorted(folder.glob(rules['pattern'])))
+
+    changed = []
+    with ProcessPoolExecutor(max_workers=workers or cpu_budget()) as pool:
+        futures = [pool.submit(sanitize_file, path, rules, dry_run) for path, rules in jobs]
+        for future in futures:
+            path, was_changed = future.result()
+            if was_changed:
+                changed.append(path)
+                logger.info("%s %s", 'Would rewrite' if dry_run else 'Rewrote', path)
+    logger.info("%d of %d files %s", len(changed), len(jobs), 'need changes' if dry_run else 'rewritten')
+    return changed
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Sanitize templateflow images in place.')
+    parser.add_argument('--templateflow-home', default=os.environ.get('TEMPLATEFLOW_HOME', '.templateflow'))
+    parser.add_argument('--templates', nargs='+', default=sorted(RULES), help='Templates to sanitize.')
+    parser.add_argument('--dry-run', action='store_true', help='Only report the files that would change.')
+    parser.add_argument('--workers', type=int, help='Worker processes (default: the CPU quota).')
+    args = parser.parse_args(argv)
+
+    sanitize(args.templateflow_home, args.templates, args.dry_run, args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,23 @@
+"""Checksums and cheap change signatures of template and input files.
+
+The checkpoints, the result store and the template index key files by their
+sha256, and use the size and mtime signature to tell when it must be
+recomputed.
+"""
+import os
+import hashlib
+
+
+def checksum(path, block_size=1 << 20):
+    """Return the sha256 of a file."""
+    digest = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def signature(path):
+    """Cheap change detector for a source file."""
+    stat = os.stat(str(path))
+    return [stat.st_size, stat.st_mtime_ns]
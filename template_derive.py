@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""Derive template masks and segmentations slab by slab.
+
+These replace the whole-volume derivation scripts in .templateflow
+(tpl-MNI152Lin/scripts/headmask.py,
+tpl-MNI152NLin2009cAsym/scripts/softbrainmask.py and
+tpl-WHS/scripts/cerebrum_dseg.py).
+
+The source image is read in slabs along its last axis. Each slab is padded
+with a halo of neighbouring slices wide enough for the morphology and
+Gaussian filtering, so the results match whole-volume processing. Every
+slice is decompressed once. Arrays are bool, uint8 or float32, and outputs
+are streamed into their .nii.gz files one slab at a time, so high-resolution
+templates fit in a small worker's memory.
+
+    python template_derive.py headmask tpl-MNI152Lin_res-01_T1w.nii.gz tpl-MNI152Lin_res-01_desc-head_mask.nii.gz
+    python template_derive.py softbrainmask <brain mask> <brain probseg>
+    python template_derive.py cerebrum-dseg tpl-WHS_atlas-v3_dseg.nii.gz <output dir>
+"""
+import os
+import sys
+import gzip
+import logging
+import argparse
+from pathlib import PosixPath
+
+logger = logging.getLogger('antsct-gear')
+
+SLAB_SIZE = 32
+# Gaussian kernels are cut off at this many sigmas (scipy's default)
+TRUNCATE = 4.0
+# WHS v3 atlas labels of each cerebrum tissue class (1: GM, 2: WM, 3: CSF)
+WHS_TISSUES = [
+    ('GM', 1, [2, 3, 10, 30, 31, 32, 39, 40, 43, 48, 50, 51, 55, 64, 65, 66, 71, 77, 81, 82, 92, 93, 94, 95, 96, 97,
+               98, 99, 100, 108, 109, 110, 112, 113, 114, 115, 143, 145, 147, 148, 149, 150, 151, 152, 153, 164]),
+    ('WM', 2, [6, 34, 36, 37, 38, 46, 52, 53, 54, 59, 60, 61, 62, 63, 67, 68, 69, 73, 80, 83, 146, 157]),
+    ('CSF', 3, [33]),
+]
+
+
+def read_slabs(img, slab_size=SLAB_SIZE, halo=0, dtype=None):
+    """Yield (start, stop, block, offset) along the last axis.
+
+    block holds slices start - halo to stop + halo (clipped to the volume) and
+    the core slices start to stop begin at block[..., offset]. Slices shared
+    with the previous block are kept in memory, so a compressed file is read
+    front to back once.
+    """
+    import numpy as np
+    length = img.shape[2]
+    block = None
+    block_start = 0
+    for start in range(0, length, slab_size):
+        stop = min(length, start + slab_size)
+        low, high = max(0, start - halo), min(length, stop + halo)
+        read_from = block_start + block.shape[2] if block is not None else low
+        new = np.asarray(img.dataobj[:, :, read_from:high])
+        if dtype is not None:
+            new = new.astype(dtype, copy=False)
+        block = new if block is None else np.concatenate([block[:, :, low - block_start:], new], axis=2)
+        block_start = low
+        yield start, stop, block, start - low
+
+
+class SlabWriter(object):
+    """Streams slabs along the last axis into a .nii.gz with the geometry of a reference image."""
+
+    def __init__(self, path, reference, dtype):
+        self.path = PosixPath(path)
+        self.header = reference.header.copy()
+        self.header.set_data_dtype(dtype)
+        self.header.set_slope_inter(None, None)
+        self.header['vox_offset'] = 352
+        self.dtype = self.header.get_data_dtype()
+        self.tmp = self.path.with_name('.derive_' + self.path.name)
+        self.file = gzip.open(str(self.tmp), 'wb', compresslevel=6)
+        # the 348-byte header and an empty extension flag
+        self.file.write(self.header.binaryblock + b'\0' * 4)
+
+    def write(self, data):
+        # slabs along the last axis are contiguous in NIfTI (Fortran) order
+        self.file.write(data.astype(self.dtype, copy=False).tobytes(order='F'))
+
+    def close(self):
+        self.file.close()
+        os.replace(str(self.tmp), str(self.path))
+        logger.info("Wrote %s", self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(str(self.tmp))
+
+
+def derive(source, outputs, function, halo, dtype=None, slab_size=SLAB_SIZE):
+    """Apply function to padded slabs of source and stream its results.
+
+    outputs maps result names to (path, dtype); function takes a block and
+    returns {name: array with the shape of the block}.
+    """
+    import nibabel as nb
+    img = nb.load(str(source), mmap='r', keep_file_open=True)
+    writers = dict((name, SlabWriter(path, img, out_dtype)) for name, (path, out_dtype) in outputs.items())
+    try:
+        for start, stop, block, offset in read_slabs(img, slab_size, halo, dtype):
+            for name, result in function(block).items():
+                writers[name].write(result[:, :, offset:offset + stop - start])
+    except BaseException:
+        for writer in writers.values():
+            writer.abort()
+        raise
+    for writer in writers.values():
+        writer.close()
+
+
+def headmask(source, dest, threshold=270, radius=3, slab_size=SLAB_SIZE):
+    """Head mask: intensities above threshold, opened with a ball of the given radius."""
+    from scipy import ndimage
+    structure = ndimage.iterate_structure(ndimage.generate_binary_structure(3, 2), radius)
+
+    def function(block):
+        return {'mask': ndimage.binary_opening(block > threshold, structure)}
+
+    # erosion and dilation each reach radius slices
+    derive(source, {'mask': (dest, 'uint8')}, function, 2 * radius, 'float32', slab_size)
+
+
+def softbrainmask(source, dest, sigma=1.0, slab_size=SLAB_SIZE):
+    """Soft brain mask: 1 in the mask dilated once, 0.95 in the second dilation, smoothed."""
+    import numpy as np
+    from scipy import ndimage
+    ball = ndimage.generate_binary_structure(3, 1)
+
+    def function(block):
+        dilate1 = ndimage.binary_dilation(block > 0, ball)
+        soft = ndimage.binary_dilation(dilate1, ball).astype(np.float32)
+        soft *= np.float32(0.95)
+        soft[dilate1] = 1.0
+        return {'probseg': ndimage.gaussian_filter(soft, sigma, truncate=TRUNCATE)}
+
+    halo = 2 + int(TRUNCATE * sigma + 0.5)
+    derive(source, {'probseg': (dest, 'float32')}, function, halo, slab_size=slab_size)
+
+
+def tissue_lookup(tissues=WHS_TISSUES):
+    """uint8 table mapping atlas labels to tissue classes; the last entry catches labels beyond the table."""
+    import numpy as np
+    size = max(label for _, _, labels in tissues for label in labels) + 2
+    lut = np.zeros(size, np.uint8)
+    for _, value, labels in tissues:
+        lut[labels] = value
+    return lut
+
+
+def cerebrum_dseg(source, output_dir, template='WHS', tissues=WHS_TISSUES, slab_size=SLAB_SIZE):
+    """Cerebrum tissue masks, label mask and segmentation from an atlas, in one label lookup per slab."""
+    import numpy as np
+    from scipy import ndimage
+    output_dir = PosixPath(output_dir)
+    lut = tissue_lookup(tissues)
+
+    def name(desc, suffix):
+        return (output_dir / 'tpl-{}_desc-{}_{}.nii.gz'.format(template, desc, suffix), 'uint8')
+
+    outputs = dict((tissue, name(tissue + 'Cerebrum', 'dseg')) for tissue, _, _ in tissues)
+    outputs['labels_mask'] = name('CerebrumTissueLabels', 'mask')
+    outputs['labels_dseg'] = name('CerebrumTissueLabels', 'dseg')
+
+    def function(block):
+        labels = np.clip(block, 0, len(lut) - 1).astype(np.intp, copy=False)
+        dseg = lut[labels]
+        results = {'labels_dseg': dseg, 'labels_mask': dseg > 0}
+        for tissue, value, _ in tissues:
+            results[tissue] = ndimage.binary_opening(dseg == value)
+        return results
+
+    # the default opening reaches one slice each way
+    derive(source, outputs, function, 2, slab_size=slab_size)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Derive template masks and segmentations slab by slab.')
+    parser.add_argument('--slab', type=int, default=SLAB_SIZE, help='Slices processed at a time.')
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('headmask', help='Head mask from a T1w template.')
+    command.add_argument('input_file')
+    command.add_argument('output_file')
+    command.add_argument('--threshold', type=float, default=270)
+    command = commands.add_parser('softbrainmask', help='Soft brain probseg from a brain mask.')
+    command.add_argument('input_file')
+    command.add_argument('output_file')
+    command = commands.add_parser('cerebrum-dseg', help='WHS cerebrum tissue images from the v3 atlas.')
+    command.add_argument('input_file')
+    command.add_argument('output_dir')
+    args = parser.parse_args(argv)
+
+    if args.command == 'headmask':
+        headmask(args.input_file, args.output_file, args.threshold, slab_size=args.slab)
+    elif args.command == 'softbrainmask':
+        softbrainmask(args.input_file, args.output_file, slab_size=args.slab)
+    elif args.command == 'cerebrum-dseg':
+        cerebrum_dseg(args.input_file, args.output_dir, slab_size=args.slab)
+    else:
+        parser.error('choose a command')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
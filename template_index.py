@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""Entity index of the bundled templateflow templates.
+
+The index lists every file of the tpl-* folders with its templateflow
+entities (template, res, desc, label, suffix, ...), size and checksum. It is
+written to TEMPLATEFLOW_HOME when the image is built. The gear then loads it
+once and answers all template and prior lookups from memory, without
+templateflow rescanning the tree for every query. Tissue priors missing from
+a template are recorded in the index and reported when it is loaded.
+
+    python template_index.py --templateflow-home /flywheel/v0/.templateflow
+"""
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+from pathlib import PosixPath
+from label_registry import TISSUE_LABELS, TISSUE_ALIASES
+from template_cache import checksum
+
+logger = logging.getLogger('antsct-gear')
+
+INDEX_FILE = 'antsct_index.json'
+ENTITY_RE = re.compile(r'^(?P<key>[a-zA-Z]+)-(?P<value>[a-zA-Z0-9+]+)$')
+# The template files antsCorticalThickness.sh uses; None means the entity must be absent
+GEAR_QUERIES = [
+    {'res': 1, 'desc': None, 'suffix': 'T1w'},
+    {'res': 1, 'desc': 'brain', 'suffix': 'T1w'},
+    {'res': 1, 'desc': 'BrainCerebellumRegistration', 'suffix': 'mask'},
+    {'res': 1, 'suffix': 'probseg'},
+]
+# probseg labels antsCorticalThickness.sh needs: the brain and one prior per tissue class
+PRIOR_LABELS = ['brain'] + [label for label, _ in TISSUE_LABELS.values()]
+# label tables, for naming the labels of the atlases
+LABEL_QUERIES = [{'suffix': 'dseg', 'extension': '.tsv'}]
+
+_loaded = {}
+
+
+def manifest_templates(manifest='manifest.json'):
+    """Return the template names offered by the gear configuration."""
+    with open(str(manifest)) as f:
+        return json.load(f)['config']['template']['enum']
+
+
+def resolve_template_dirs(templateflow_home, names):
+    """Map template names to tpl-* folders, ignoring case as the manifest does."""
+    folders = dict((p.name[4:].lower(), p) for p in PosixPath(templateflow_home).glob('tpl-*') if p.is_dir())
+    resolved = []
+    for name in names:
+        folder = folders.get(name.lower())
+        if folder is None:
+            logger.warning("Template %s not found in %s", name, templateflow_home)
+        else:
+            resolved.append(folder)
+    return resolved
+
+
+def parse_template_file(path):
+    """Return the entities, suffix and extension of a templateflow file name, or None."""
+    name = os.path.basename(str(path))
+    stem, dot, extension = name.partition('.')
+    parts = stem.split('_')
+    if len(parts) < 2 or not parts[0].startswith('tpl-'):
+        return None
+    entities = {'suffix': parts[-1], 'extension': dot + extension}
+    for part in parts[:-1]:
+        match = ENTITY_RE.match(part)
+        if not match:
+            return None
+        entities[match.group('key')] = match.group('value')
+    return entities
+
+
+def matches(entities, query):
+    for key, wanted in query.items():
+        value = entities.get(key)
+        if wanted is None:
+            if value is not None:
+                return False
+        elif key == 'res':
+            if value is None or not value.isdigit() or int(value) != wanted:
+                return False
+        elif value != wanted:
+            return False
+    return True
+
+
+def missing_priors(entries, res=1):
+    """Return the prior labels without a probseg at the given resolution."""
+    present = set()
+    for entry in entries:
+        if matches(entry, {'res': res, 'suffix': 'probseg'}) and entry['extension'].startswith('.nii'):
+            present.add(TISSUE_ALIASES.get(entry.get('label'), entry.get('label')))
+    return [label for label in PRIOR_LABELS if label not in present]
+
+
+def build_index(templateflow_home, names=None, checksums=True):
+    """Scan the tpl-* folders (all of them, or the named ones) and return the index."""
+    templateflow_home = PosixPath(templateflow_home)
+    wanted = set(n.lower() for n in names) if names else None
+    index = {'templates': {}, 'files': [], 'missing_priors': {}}
+    for folder in sorted(templateflow_home.glob('tpl-*')):
+        name = folder.name[4:]
+        if not folder.is_dir() or (wanted is not None and name.lower() not in wanted):
+            continue
+        index['templates'][name] = folder.name
+        entries = []
+        for path in sorted(folder.rglob('tpl-*')):
+            entities = parse_template_file(path)
+            if entities is None or not path.is_file():
+                continue
+            entry = {'path': str(path.relative_to(templateflow_home)), 'size': path.stat().st_size}
+            if checksums:
+                entry['checksum'] = checksum(path)
+            entry.update(entities)
+            entries.append(entry)
+        missing = missing_priors(entries)
+        if missing:
+            index['missing_priors'][name] = missing
+        index['files'].extend(entries)
+    return index
+
+
+def write_index(templateflow_home, names=None):
+    index = build_index(templateflow_home, names)
+    with (PosixPath(templateflow_home) / INDEX_FILE).open('w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    for name, missing in sorted(index['missing_priors'].items()):
+        logger.warning("Template %s has no tissue prior for: %s", name, ', '.join(missing))
+    return index
+
+
+class TemplateIndex(object):
+    """In-memory lookups over the index of one TEMPLATEFLOW_HOME."""
+
+    def __init__(self, root, index):
+        self.root = PosixPath(root)
+        self.templates = dict((name.lower(), name) for name in index['templates'])
+        self.missing = index.get('missing_priors', {})
+        self.by_template = {}
+        for entry in index['files']:
+            self.by_template.setdefault(entry['tpl'].lower(), []).append(entry)
+
+    def name(self, template):
+        """The template's own spelling of a name, matched ignoring case as the manifest does."""
+        return self.templates.get(template.lower())
+
+    def find(self, template, **query):
+        """Return the sorted paths of a template's files matching the query.
+
+        Only images are returned unless the query names an extension.
+        """
+        found = []
+        for entry in self.by_template.get(template.lower(), []):
+            if 'extension' not in query and not entry['extension'].startswith('.nii'):
+                continue
+            if matches(entry, query):
+                found.append(self.root / entry['path'])
+        return sorted(found)
+
+    def get(self, template, **query):
+        """Return the single file matching the query, or None when there is none or more than one."""
+        found = self.find(template, **query)
+        if len(found) > 1:
+            logger.warning("%d files of %s match %s", len(found), template, query)
+        return found[0] if len(found) == 1 else None
+
+    def missing_priors(self, template):
+        name = self.name(template)
+        return self.missing.get(name, []) if name else list(PRIOR_LABELS)
+
+
+def load_index(templateflow_home=None):
+    """Load the index of TEMPLATEFLOW_HOME once per process; scan the tree if it has no index."""
+    root = PosixPath(templateflow_home or os.environ.get('TEMPLATEFLOW_HOME', '.templateflow'))
+    if root not in _loaded:
+        if (root / INDEX_FILE).exists():
+            with (root / INDEX_FILE).open() as f:
+                index = json.load(f)
+        else:
+            logger.info("No %s in %s, scanning the templates", INDEX_FILE, root)
+            index = build_index(root, checksums=False)
+        _loaded[root] = TemplateIndex(root, index)
+        for name, missing in sorted(_loaded[root].missing.items()):
+            logger.info("Template %s has no tissue prior for: %s", name, ', '.join(missing))
+    return _loaded[root]
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Write the entity index of a TEMPLATEFLOW_HOME.')
+    parser.add_argument('--templateflow-home', default=os.environ.get('TEMPLATEFLOW_HOME', '.templateflow'))
+    parser.add_argument('--templates', nargs='+', help='Templates to index (default: all tpl-* folders).')
+    args = parser.parse_args(argv)
+
+    index = write_index(args.templateflow_home, args.templates)
+    logger.info("Indexed %d files of %d templates", len(index['files']), len(index['templates']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
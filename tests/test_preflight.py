@@ -0,0 +1,64 @@
+"""Regression tests of the preflight length checks on real .nii.gz files.
+
+    python -m unittest discover tests
+"""
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+from pathlib import PosixPath
+
+sys.path.insert(0, str(PosixPath(__file__).resolve().parent.parent))
+
+from preflight import screen  # noqa: E402
+
+
+class CheckLengthTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        import numpy as np
+        import nibabel as nb
+        cls.tmp = PosixPath(tempfile.mkdtemp())
+        rng = np.random.RandomState(0)
+        data = (rng.normal(100, 20, (128, 128, 128)) + np.linspace(0, 500, 128)).astype(np.int16)
+        img = nb.Nifti1Image(data, np.diag([1.0, 1.0, 1.0, 1.0]))
+        img.header.set_qform(img.affine, 1)
+        img.to_filename(str(cls.tmp / 'good.nii.gz'))
+        cls.raw = gzip.decompress((cls.tmp / 'good.nii.gz').read_bytes())
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(str(cls.tmp))
+
+    def write(self, name, data):
+        path = self.tmp / name
+        path.write_bytes(data)
+        return path
+
+    def test_complete_file_passes(self):
+        self.assertEqual(screen(self.tmp / 'good.nii.gz').errors, [])
+
+    def test_truncated_download_fails(self):
+        compressed = (self.tmp / 'good.nii.gz').read_bytes()
+        for fraction in (0.999, 0.99, 0.98, 0.95):
+            path = self.write('truncated.nii.gz', compressed[:int(len(compressed) * fraction)])
+            self.assertFalse(screen(path).ok, 'truncated to {:.1%}'.format(fraction))
+
+    def test_trailing_bytes_pass(self):
+        path = self.write('padded.nii.gz', gzip.compress(self.raw + b'\0' * 1000))
+        self.assertEqual(screen(path).errors, [])
+
+    def test_multi_member_stream_passes(self):
+        half = len(self.raw) // 2
+        path = self.write('multi.nii.gz', gzip.compress(self.raw[:half]) + gzip.compress(self.raw[half:]))
+        self.assertEqual(screen(path).errors, [])
+
+    def test_short_stream_fails(self):
+        path = self.write('short.nii.gz', gzip.compress(self.raw[:-5000]))
+        self.assertFalse(screen(path).ok)
+
+
+if __name__ == '__main__':
+    unittest.main()